@@ -1,17 +1,33 @@
+import os
 from urllib.parse import urljoin
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.options
 import tornado.auth
 import tornado.gen
 import tornado.concurrent
 import tornado.web
 
-from config import PORT, TORNADO_SETTINGS, API_BASE_URL, STATIC_BASE_URL
+from config import PORT, TORNADO_SETTINGS, API_BASE_URL, STATIC_BASE_URL, WORKERS, SHARED_MEMORY_DIR, HTTP_MAX_CLIENTS, \
+    LOCK_JOURNAL_DIR, API_SPEC_ENABLED
 from spec import append_spec_endpoint, append_swagger_ui_endpoint
+from services.selenium_grid import selenium_grid_service, open_lock_managers, restore_service_state
+from services.cluster import cluster_service
+from services.diagnostics import diagnostics_service
+from utils.shared_memory import LeaderElection, SharedCapabilitySnapshot
+from utils.clients import configure_http_client
 
-from handlers.selenium_grid import CapabilityListHandler, CapabilityLockListHandler, CapabilityLockDetailHandler
+from handlers.selenium_grid import CapabilityListHandler, CapabilityLockListHandler, CapabilityLockDetailHandler, \
+    CapabilityQueryCacheHandler, CapabilityLockWaitHandler, CapabilityEventStreamHandler, CapabilityLockBatchHandler, \
+    HubStatusListHandler, HubListHandler, HubDetailHandler, AppiumNodeStatusListHandler, BackgroundJobStatusListHandler, \
+    PlacementStatusHandler, CapabilityLockQueueHandler
+from handlers.metrics import MetricsHandler
+from handlers.cluster import ClusterStatusHandler
+from handlers.diagnostics import LoopStatusHandler, ProfileHandler
+from handlers.health import ReadinessHandler, LivenessHandler
 
 
 def set_base_url(api_endpoints, base_url):
@@ -19,25 +35,70 @@ def set_base_url(api_endpoints, base_url):
                 for path, handler in api_endpoints)
 
 
-def main():
+def make_app():
     # NOTE: path here will be join with base_url later
     # NOTE: path here should end with /?$ for compatibility
     # NOTE: use named group so that apispec could generate proper path pattern
     api_endpoints = [
         (r"capabilities/?$", CapabilityListHandler),
+        (r"capabilities-cache/?$", CapabilityQueryCacheHandler),
+        (r"capabilities-events/?$", CapabilityEventStreamHandler),
         (r"capabilities-lock/?$", CapabilityLockListHandler),
+        (r"capabilities-lock-wait/?$", CapabilityLockWaitHandler),
+        (r"capabilities-lock-batch/?$", CapabilityLockBatchHandler),
+        (r"capabilities-lock-queue/?$", CapabilityLockQueueHandler),
+        (r"hubs/?$", HubListHandler),
+        (r"hubs/(?P<hub_id>\d+)/?$", HubDetailHandler),
+        (r"hubs-status/?$", HubStatusListHandler),
+        (r"appium-nodes-status/?$", AppiumNodeStatusListHandler),
+        (r"jobs-status/?$", BackgroundJobStatusListHandler),
+        (r"placement-status/?$", PlacementStatusHandler),
+        (r"cluster-status/?$", ClusterStatusHandler),
         (r"capabilities-lock/(?P<token>[^/]+)/?$", CapabilityLockDetailHandler),
+        (r"metrics/?$", MetricsHandler),
+        (r"loop-status/?$", LoopStatusHandler),
+        (r"debug/profile/?$", ProfileHandler),
+        (r"health/ready/?$", ReadinessHandler),
+        (r"health/live/?$", LivenessHandler),
     ]
     # add spec endpoint
-    append_spec_endpoint(api_endpoints)
+    if API_SPEC_ENABLED:
+        append_spec_endpoint(api_endpoints)
     endpoints = set_base_url(api_endpoints, API_BASE_URL)
 
     # add swagger ui endpoint
     append_swagger_ui_endpoint(endpoints, STATIC_BASE_URL)
 
-    application = tornado.web.Application(endpoints, **TORNADO_SETTINGS)
-    http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(PORT)
+    return tornado.web.Application(endpoints, **TORNADO_SETTINGS)
+
+
+def main():
+    configure_http_client(HTTP_MAX_CLIENTS)
+    open_lock_managers(selenium_grid_service)
+    if not LOCK_JOURNAL_DIR:
+        # this process starts the worker group, shared lock tables of the last run are dropped like the snapshot below,
+        # unless locks are persisted, then the tables are kept in the journal directory
+        selenium_grid_service.clear_shared_locks()
+    # state on disk is restored before forking, so that every worker starts with it
+    restore_service_state(selenium_grid_service)
+    application = make_app()
+    if WORKERS == 1:
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.listen(PORT)
+        selenium_grid_service.start_background_jobs()
+    else:
+        # NOTE: IOLoop should not be created or referenced before forking, and autoreload (debug mode) is not supported
+        snapshot = SharedCapabilitySnapshot(os.path.join(SHARED_MEMORY_DIR, 'capabilities.json'))
+        snapshot.clear()
+        sockets = tornado.netutil.bind_sockets(PORT)
+        tornado.process.fork_processes(WORKERS)
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.add_sockets(sockets)
+        election = LeaderElection(os.path.join(SHARED_MEMORY_DIR, 'leader'))
+        selenium_grid_service.start_background_jobs(election=election, snapshot=snapshot)
+    if cluster_service is not None:
+        cluster_service.start_background_jobs()
+    diagnostics_service.start_background_jobs()
     tornado.ioloop.IOLoop.current().start()
 
 
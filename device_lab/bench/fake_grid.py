@@ -0,0 +1,122 @@
+"""
+stand-ins of selenium grid hubs and appium nodes for benchmark
+
+every hub and node is given its own loopback address (127.0.0.0/8) on the same port, so that one server
+plays the whole fleet and the service sees as many distinct hub and appium urls as a real one
+"""
+import json
+import random
+
+import tornado.ioloop
+import tornado.web
+
+PLATFORMS = (
+    ('ios', ('iPhone 8', 'iPhone X', 'iPhone 11', 'iPad Air'), ('11.4', '12.1', '12.4', '13.3')),
+    ('android', ('Pixel 2', 'Pixel 3', 'Galaxy S9', 'Galaxy S10', 'Mate 20'), ('7.1', '8.0', '8.1', '9', '10')),
+)
+
+
+def get_address(index, first_octet):
+    # last octet is kept away from 0 and 255
+    high, low = divmod(index, 254)
+    return '127.{}.{}.{}'.format(first_octet + high // 256, high % 256, low + 1)
+
+
+def get_hub_urls(devices, devices_per_node, nodes_per_hub, port):
+    node_count = (devices + devices_per_node - 1) // devices_per_node
+    hub_count = (node_count + nodes_per_hub - 1) // nodes_per_hub
+    return list('http://{}:{}/'.format(get_address(index, 1), port) for index in range(hub_count))
+
+
+class FakeFleet(object):
+    """
+    devices generated from a seed, grouped into appium nodes and hubs
+
+    :param busy_ratio: ratio of nodes having a session, they are reported by `wd/hub/sessions`
+    """
+
+    def __init__(self, devices=1000, devices_per_node=1, nodes_per_hub=500, busy_ratio=0.1, port=4444, seed=0):
+        rand = random.Random(seed)
+        self.port = port
+        self.devices = devices
+        self._hub_urls = get_hub_urls(devices, devices_per_node, nodes_per_hub, port)
+        self._hubs = {}  # k: hub address, v: encoded ShowAllNodesServlet payload
+        self._sessions = {}  # k: node address, v: encoded wd/hub/sessions payload
+        node_count = (devices + devices_per_node - 1) // devices_per_node
+        nodes_by_hub = {}
+        for node_index in range(node_count):
+            node_address = get_address(node_index, 2)
+            caps = []
+            for device_index in range(node_index * devices_per_node, min(devices, (node_index + 1) * devices_per_node)):
+                platform_name, device_names, versions = rand.choice(PLATFORMS)
+                caps.append({
+                    'capabilities': {
+                        'platformName': platform_name,
+                        'deviceName': rand.choice(device_names),
+                        'version': rand.choice(versions),
+                        'UDID': 'udid-{:06d}'.format(device_index),
+                    },
+                    'browserName': '',
+                    'maxInstances': 1,
+                })
+            node = {
+                'id': 'http://{}:{}'.format(node_address, port),
+                'protocols': {'web_driver': {'browsers': {'': {'name': '', 'version': '', '': caps}}}},
+            }
+            nodes_by_hub.setdefault(get_address(node_index // nodes_per_hub, 1), []).append(node)
+            sessions = []
+            if rand.random() < busy_ratio:
+                sessions.append({'id': 'session-{}'.format(node_index), 'capabilities': caps[0]['capabilities']})
+            self._sessions[node_address] = json.dumps({'status': 0, 'value': sessions}).encode()
+        for hub_address, nodes in nodes_by_hub.items():
+            self._hubs[hub_address] = json.dumps({'success': True, 'nodes': nodes}).encode()
+
+    def get_hub_urls(self):
+        return self._hub_urls
+
+    def get_hub_payload(self, address):
+        return self._hubs.get(address)
+
+    def get_sessions_payload(self, address):
+        return self._sessions.get(address)
+
+    def make_app(self):
+        return tornado.web.Application([
+            (r'/grid/admin/ShowAllNodesServlet', FakeHubHandler, dict(fleet=self)),
+            (r'/wd/hub/sessions', FakeAppiumSessionsHandler, dict(fleet=self)),
+        ])
+
+
+class _FakeHandler(tornado.web.RequestHandler):
+    def initialize(self, fleet):
+        self.fleet = fleet  # type: FakeFleet
+
+    def send_payload(self, payload):
+        if payload is None:
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(payload)
+
+    def get_address(self):
+        return self.request.host.rsplit(':', 1)[0]
+
+
+class FakeHubHandler(_FakeHandler):
+    def get(self):
+        self.send_payload(self.fleet.get_hub_payload(self.get_address()))
+
+
+class FakeAppiumSessionsHandler(_FakeHandler):
+    def get(self):
+        self.send_payload(self.fleet.get_sessions_payload(self.get_address()))
+
+
+def serve_fake_grid(fleet_options, port, ready):
+    """
+    serve a fleet until the process is terminated, run it in a child process
+    :param ready: multiprocessing.Event set once it listens
+    """
+    fleet = FakeFleet(port=port, **fleet_options)
+    fleet.make_app().listen(port)
+    ready.set()
+    tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,304 @@
+"""
+load benchmark of device lab against a fake fleet
+
+    python -m bench.run --devices 10000 --clients 50 --duration 30 --output result.json
+
+the service is started by `app.py` in a child process with the environment of this one, so that database
+(DB_HOST, DB_USER, ...) and lock backend are configured as usual, hubs of the fake fleet are registered
+through the hubs API and removed when done
+
+NOTE: fake fleet listens on all addresses of the port, since hubs and nodes are told apart by loopback address
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import multiprocessing
+from urllib.parse import urljoin, urlencode
+
+import tornado.gen
+import tornado.ioloop
+from tornado.httpclient import AsyncHTTPClient
+
+from bench.fake_grid import get_hub_urls, serve_fake_grid
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLATFORM_NAMES = ('ios', 'android')
+
+
+def get_percentile(sorted_values, percent):
+    """
+    nearest-rank percentile
+    """
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(percent / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def parse_metrics(text):
+    """
+    :return: k: sample name with labels as rendered, v: value
+    """
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        name, value = line.rsplit(' ', 1)
+        samples[name] = float(value)
+    return samples
+
+
+def get_mean(samples, name, labels=''):
+    count = samples.get('{}_count{}'.format(name, labels))
+    if not count:
+        return None
+    return samples['{}_sum{}'.format(name, labels)] / count
+
+
+def get_memory(pid):
+    """
+    :return: resident set size and its peak in bytes, read from procfs, None if not available
+    """
+    memory = {'rss': None, 'peak_rss': None}
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in ('VmRSS', 'VmHWM'):
+                    memory['rss' if key == 'VmRSS' else 'peak_rss'] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return memory
+
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=APP_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class LatencyRecorder(object):
+    def __init__(self):
+        self._latencies = {}  # k: operation, v: seconds of successful calls
+        self._counts = {}  # k: (operation, outcome), v: number of calls
+
+    def add(self, operation, seconds, outcome='ok'):
+        if outcome == 'ok':
+            self._latencies.setdefault(operation, []).append(seconds)
+        key = (operation, outcome)
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    def summarize(self, duration):
+        summary = {}
+        for operation in sorted(set(op for op, _ in self._counts)):
+            latencies = sorted(self._latencies.get(operation, ()))
+            summary[operation] = {
+                'outcomes': dict((outcome, count) for (op, outcome), count in self._counts.items() if op == operation),
+                'throughput': len(latencies) / duration,
+                'p50': get_percentile(latencies, 50),
+                'p99': get_percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            }
+        return summary
+
+
+class Benchmark(object):
+    def __init__(self, options):
+        self.options = options
+        self.base_url = 'http://127.0.0.1:{}{}'.format(options.port, options.api_base_url)
+        self.fleet_options = dict(devices=options.devices, devices_per_node=options.devices_per_node,
+                                  nodes_per_hub=options.nodes_per_hub, busy_ratio=options.busy_ratio,
+                                  seed=options.seed)
+        self.recorder = LatencyRecorder()
+        self._rand = random.Random(options.seed)
+        self._http = None  # type: AsyncHTTPClient
+
+    def run(self):
+        ready = multiprocessing.Event()
+        fake_grid = multiprocessing.Process(target=serve_fake_grid, daemon=True,
+                                            args=(self.fleet_options, self.options.fake_port, ready))
+        fake_grid.start()
+        ready.wait()
+        env = dict(os.environ, PORT=str(self.options.port), API_BASE_URL=self.options.api_base_url)
+        with open(self.options.app_log, 'ab') as log:
+            service = subprocess.Popen([sys.executable, 'app.py'], cwd=APP_DIR, env=env, stdout=log, stderr=log)
+        try:
+            return tornado.ioloop.IOLoop.current().run_sync(lambda: self._run(service.pid))
+        finally:
+            service.terminate()
+            service.wait()
+            fake_grid.terminate()
+
+    @tornado.gen.coroutine
+    def _run(self, pid):
+        AsyncHTTPClient.configure(None, max_clients=self.options.clients + 2)
+        self._http = AsyncHTTPClient()
+        yield self._wait_for_service()
+        memory_idle = get_memory(pid)
+        hub_urls = get_hub_urls(self.options.devices, self.options.devices_per_node, self.options.nodes_per_hub,
+                                self.options.fake_port)
+        hub_ids = yield self._register_hubs(hub_urls)
+        try:
+            refresh_time = yield self._wait_for_capabilities()
+            memory_loaded = get_memory(pid)
+            started = time.time()
+            yield [self._run_client(started + self.options.duration) for _ in range(self.options.clients)]
+            duration = time.time() - started
+            memory_done = get_memory(pid)
+            samples = yield self._get_metrics()
+        finally:
+            yield self._unregister_hubs(hub_ids)
+        return {
+            'version': get_version(),
+            'options': vars(self.options),
+            'hubs': len(hub_urls),
+            'refresh': {
+                'first_full_refresh': refresh_time,
+                'mean_hub_fetch': get_mean(samples, 'device_lab_hub_fetch_duration_seconds'),
+                'mean_appium_tick': get_mean(samples, 'device_lab_background_job_duration_seconds',
+                                             '{job="refresh_capabilities_from_remote"}'),
+                'mean_lock_sweep': get_mean(samples, 'device_lab_background_job_duration_seconds',
+                                            '{job="release_expired_locks"}'),
+            },
+            'operations': self.recorder.summarize(duration),
+            'memory': {'idle': memory_idle, 'loaded': memory_loaded, 'done': memory_done},
+        }
+
+    @tornado.gen.coroutine
+    def _fetch(self, path, method='GET', body=None, timeout=60):
+        started = time.perf_counter()
+        res = yield self._http.fetch(urljoin(self.base_url, path), method=method, raise_error=False,
+                                     body=None if body is None else json.dumps(body), request_timeout=timeout,
+                                     allow_nonstandard_methods=True)
+        return res, time.perf_counter() - started
+
+    @tornado.gen.coroutine
+    def _get_metrics(self):
+        res, _ = yield self._fetch('metrics')
+        return parse_metrics(res.body.decode()) if res.code == 200 else {}
+
+    @tornado.gen.coroutine
+    def _wait_for_service(self, timeout=60):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                res, _ = yield self._fetch('metrics', timeout=5)
+                error = None if res.code == 200 else res.error
+            except OSError as e:  # not listening yet
+                error = e
+            if error is None:
+                return
+            if time.time() > deadline:
+                raise RuntimeError('service is not up in {} seconds: {}'.format(timeout, error))
+            yield tornado.gen.sleep(0.5)
+
+    @tornado.gen.coroutine
+    def _register_hubs(self, hub_urls):
+        res, _ = yield self._fetch('hubs')
+        existing = dict((hub['url'], hub['id']) for hub in json.loads(res.body.decode())['data'])
+        hub_ids = []
+        for hub_url in hub_urls:
+            if hub_url in existing:
+                hub_ids.append(existing[hub_url])  # left by an aborted run
+                continue
+            res, _ = yield self._fetch('hubs', 'POST', {'url': hub_url})
+            if res.code != 201:
+                raise RuntimeError('fail to register hub: {}, {}'.format(hub_url, res.body))
+            hub_ids.append(json.loads(res.body.decode())['data']['id'])
+        return hub_ids
+
+    @tornado.gen.coroutine
+    def _unregister_hubs(self, hub_ids):
+        for hub_id in hub_ids:
+            yield self._fetch('hubs/{}'.format(hub_id), 'DELETE')
+
+    @tornado.gen.coroutine
+    def _wait_for_capabilities(self):
+        """
+        :return: seconds taken until every device of the fleet is listed
+        """
+        started = time.time()
+        while True:
+            res, _ = yield self._fetch('capabilities?debug=true')
+            if res.code == 200 and len(json.loads(res.body.decode())['data']) >= self.options.devices:
+                return time.time() - started
+            if time.time() - started > self.options.refresh_timeout:
+                raise RuntimeError('fleet is not listed in {} seconds'.format(self.options.refresh_timeout))
+            yield tornado.gen.sleep(0.2)
+
+    @tornado.gen.coroutine
+    def _run_client(self, deadline):
+        while time.time() < deadline:
+            query = urlencode({'platform_name': self._rand.choice(PLATFORM_NAMES)})
+            res, seconds = yield self._fetch('capabilities?{}'.format(query))
+            self.recorder.add('query', seconds, 'ok' if res.code == 200 else str(res.code))
+            if res.code != 200:
+                continue
+            caps = json.loads(res.body.decode())['data']
+            if not caps or self._rand.random() >= self.options.lock_ratio:
+                continue
+            cap = self._rand.choice(caps)
+            res, seconds = yield self._fetch('capabilities-lock', 'POST', {
+                'capability_token': cap['capability_token'],
+                'timeout': 60,
+            })
+            # conflicts are expected under contention, they are counted but not timed
+            self.recorder.add('lock', seconds, 'ok' if res.code == 201 else str(res.code))
+            if res.code != 201:
+                continue
+            token = json.loads(res.body.decode())['data']['token']
+            res, seconds = yield self._fetch('capabilities-lock/{}'.format(token), 'DELETE')
+            self.recorder.add('release', seconds, 'ok' if res.code == 200 else str(res.code))
+
+
+def print_summary(result):
+    print('version: {}, devices: {}, hubs: {}'.format(result['version'], result['options']['devices'], result['hubs']))
+    for key, value in result['refresh'].items():
+        print('{:<20} {}'.format(key, 'n/a' if value is None else '{:.4f}s'.format(value)))
+    print('{:<10} {:>10} {:>10} {:>10} {:>10}  {}'.format('operation', 'ops/s', 'p50 ms', 'p99 ms', 'max ms', 'outcomes'))
+    for operation, summary in result['operations'].items():
+        print('{:<10} {:>10.1f} {:>10} {:>10} {:>10}  {}'.format(
+            operation, summary['throughput'],
+            *('n/a' if summary[k] is None else '{:.2f}'.format(summary[k] * 1000) for k in ('p50', 'p99', 'max')),
+            summary['outcomes']))
+    for phase, memory in result['memory'].items():
+        print('memory {:<8} rss: {}, peak: {}'.format(phase, memory['rss'], memory['peak_rss']))
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='load benchmark of device lab against a fake fleet')
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--devices-per-node', type=int, default=1)
+    parser.add_argument('--nodes-per-hub', type=int, default=500)
+    parser.add_argument('--busy-ratio', type=float, default=0.1, help='ratio of appium nodes having a session')
+    parser.add_argument('--clients', type=int, default=50, help='number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--lock-ratio', type=float, default=0.5, help='ratio of queries followed by lock and release')
+    parser.add_argument('--refresh-timeout', type=float, default=300,
+                        help='seconds to wait for the fleet to be listed')
+    parser.add_argument('--port', type=int, default=18888, help='port of the service')
+    parser.add_argument('--fake-port', type=int, default=14444, help='port of the fake fleet')
+    parser.add_argument('--api-base-url', default='/device_lab/api/v1/')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--app-log', default=os.devnull, help='file to append output of the service to')
+    parser.add_argument('--output', help='file to write result to, in json')
+    return parser.parse_args(args)
+
+
+def main():
+    options = parse_args()
+    result = Benchmark(options).run()
+    print_summary(result)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
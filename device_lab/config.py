@@ -1,8 +1,8 @@
 import os
 import logging
+import tempfile
 
 from sqlalchemy.engine.url import URL
-from utils.misc import new_random_string
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,8 +15,11 @@ DB_PORT = int(os.environ.get("DB_PORT", 3306))
 DB_USER = os.environ.get("DB_USER", "root")
 DB_PASSWORD = os.environ.get("DB_PASSWORD")
 DB_NAME = os.environ.get("DB_NAME", "device_lab")
+# connections kept by the pool, which is also the number of threads accessing database
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 2))
 
-DB_URL = URL(
+# a full database url, e.g. sqlite:///hubs.db for local runs, takes place of the DB_* settings above
+DB_URL = os.environ.get("DB_URL") or URL(
     drivername="mysql+pymysql",
     host=DB_HOST,
     username=DB_USER,
@@ -33,7 +36,81 @@ TORNADO_SETTINGS = {
 
 API_BASE_URL = os.environ.get('API_BASE_URL', r'/device_lab/api/v1/')
 STATIC_BASE_URL = os.environ.get('STATIC_BASE_URL', r'/device_lab/static/')
+# serve the generated api spec for swagger ui, set to 0 to leave it out, e.g. where apispec does not support tornado
+API_SPEC_ENABLED = os.environ.get('API_SPEC_ENABLED', '1') == '1'
 
 
 # service related configure
-LOCK_SECRET = os.environ.get("LOCK_SECRET", new_random_string(20))
+# signing key of tokens, if not given, it is generated on start, or kept in LOCK_JOURNAL_DIR if journal is enabled
+LOCK_SECRET = os.environ.get("LOCK_SECRET")
+# directory of lock journal and snapshot, which restore in-process locks on restart, disabled if not set,
+# shared-memory lock tables are kept in it instead of SHARED_MEMORY_DIR, and survive restart
+LOCK_JOURNAL_DIR = os.environ.get("LOCK_JOURNAL_DIR")
+# seconds lock events are buffered before being appended, and journal records compacted into a snapshot
+LOCK_JOURNAL_FLUSH_INTERVAL = float(os.environ.get("LOCK_JOURNAL_FLUSH_INTERVAL", 0.05))
+LOCK_JOURNAL_COMPACT_THRESHOLD = int(os.environ.get("LOCK_JOURNAL_COMPACT_THRESHOLD", 10000))
+# number of worker processes, 0 for one per cpu core, lock state is shared between them by memory-mapped files
+WORKERS = int(os.environ.get("WORKERS", 1))
+SHARED_MEMORY_DIR = os.environ.get("SHARED_MEMORY_DIR", os.path.join(tempfile.gettempdir(), "device_lab-{}".format(PORT)))
+SHARED_LOCK_SLOTS = int(os.environ.get("SHARED_LOCK_SLOTS", 65536))
+# last known capabilities are saved to this file every interval if changed, and served on restart until hubs are
+# polled again, set it empty to disable
+CAPABILITY_SNAPSHOT_PATH = os.environ.get(
+    "CAPABILITY_SNAPSHOT_PATH", os.path.join(SHARED_MEMORY_DIR, "capabilities.snapshot.gz"))
+CAPABILITY_SNAPSHOT_INTERVAL = float(os.environ.get("CAPABILITY_SNAPSHOT_INTERVAL", 10))
+# lock backend: memory (single process), shared_memory (worker processes) or redis (shared by hosts)
+LOCK_BACKEND = os.environ.get("LOCK_BACKEND", "memory")
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/0")
+# capabilities of a hub which fails to respond are kept for this many seconds since its last success
+HUB_FAILURE_GRACE_PERIOD = int(os.environ.get("HUB_FAILURE_GRACE_PERIOD", 60))
+# every hub is polled on its own interval, which is shortened when its nodes change and lengthened otherwise
+HUB_POLL_MIN_INTERVAL = float(os.environ.get("HUB_POLL_MIN_INTERVAL", 5))
+HUB_POLL_MAX_INTERVAL = float(os.environ.get("HUB_POLL_MAX_INTERVAL", 60))
+# upper bound of exponential backoff on failures, and timeout of each poll, in seconds
+HUB_POLL_MAX_BACKOFF = float(os.environ.get("HUB_POLL_MAX_BACKOFF", 300))
+HUB_POLL_TIMEOUT = float(os.environ.get("HUB_POLL_TIMEOUT", 5))
+# max number of hubs fetched at the same time
+HUB_FETCH_CONCURRENCY = int(os.environ.get("HUB_FETCH_CONCURRENCY", 10))
+# max number of connections opened by the http client shared by hub and appium clients,
+# connections are kept alive if pycurl is installed
+HTTP_MAX_CLIENTS = int(os.environ.get("HTTP_MAX_CLIENTS", 50))
+# events buffered for a subscriber of capability events, a slower one is resynced from a snapshot
+EVENT_STREAM_BUFFER_SIZE = int(os.environ.get("EVENT_STREAM_BUFFER_SIZE", 1000))
+# seconds between keep-alive comments sent to an idle subscriber
+EVENT_STREAM_HEARTBEAT = int(os.environ.get("EVENT_STREAM_HEARTBEAT", 30))
+# appium nodes with sessions are polled every period, idle ones back off up to APPIUM_POLL_MAX_INTERVAL seconds
+APPIUM_POLL_MAX_INTERVAL = float(os.environ.get("APPIUM_POLL_MAX_INTERVAL", 60))
+APPIUM_POLL_TIMEOUT = float(os.environ.get("APPIUM_POLL_TIMEOUT", 5))
+# max number of appium nodes polled at the same time
+APPIUM_POLL_CONCURRENCY = int(os.environ.get("APPIUM_POLL_CONCURRENCY", 20))
+# an appium node failing this many times in a row is not polled for APPIUM_CIRCUIT_RESET_TIMEOUT seconds
+APPIUM_CIRCUIT_THRESHOLD = int(os.environ.get("APPIUM_CIRCUIT_THRESHOLD", 3))
+APPIUM_CIRCUIT_RESET_TIMEOUT = float(os.environ.get("APPIUM_CIRCUIT_RESET_TIMEOUT", 60))
+# order of available capabilities: balanced (spread over idle devices, lightly loaded hubs and healthy nodes)
+# or hub_order (first match as reported by hubs)
+PLACEMENT_POLICY = os.environ.get("PLACEMENT_POLICY", "balanced")
+# requests waiting for capabilities are served by priority class, then shared between teams by weight,
+# e.g. "release:4,ci:2", teams not listed weigh 1
+TEAM_WEIGHTS = dict((team, float(weight)) for team, weight in (
+    item.split(':') for item in os.environ.get("TEAM_WEIGHTS", "").split(',') if item))
+# max number of waiting requests, in total and from a team, more are rejected with 429
+WAIT_QUEUE_MAX_SIZE = int(os.environ.get("WAIT_QUEUE_MAX_SIZE", 10000))
+WAIT_QUEUE_MAX_TEAM_SIZE = int(os.environ.get("WAIT_QUEUE_MAX_TEAM_SIZE", 1000))
+# origins of all nodes of a cluster, e.g. "http://10.0.0.1:8888,http://10.0.0.2:8888", hubs are sharded between
+# them by consistent hashing and requests are routed to the node owning the hub, disabled if not set
+# NOTE: nodes should share LOCK_SECRET, and LOCK_BACKEND=redis keeps locks across rebalancing
+CLUSTER_NODES = list(url for url in os.environ.get("CLUSTER_NODES", "").split(',') if url)
+# origin of this node as listed in CLUSTER_NODES
+CLUSTER_SELF = os.environ.get("CLUSTER_SELF", "http://127.0.0.1:{}".format(PORT))
+# points of each node on the hash ring, more spread hubs more evenly
+CLUSTER_REPLICAS = int(os.environ.get("CLUSTER_REPLICAS", 128))
+# peers are checked every interval, one failing this many checks in a row is dropped until it answers again
+CLUSTER_CHECK_INTERVAL = float(os.environ.get("CLUSTER_CHECK_INTERVAL", 2))
+CLUSTER_FAILURE_THRESHOLD = int(os.environ.get("CLUSTER_FAILURE_THRESHOLD", 3))
+# seconds to wait for a peer answering a forwarded request or a health check
+CLUSTER_TIMEOUT = float(os.environ.get("CLUSTER_TIMEOUT", 5))
+# IOLoop lagging this many seconds is logged with the stack blocking it, 0 to disable
+LOOP_STALL_THRESHOLD = float(os.environ.get("LOOP_STALL_THRESHOLD", 0.1))
+# the profiler endpoint is served only to requests carrying this token, disabled if not set
+PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")
+PROFILER_MAX_SECONDS = float(os.environ.get("PROFILER_MAX_SECONDS", 30))
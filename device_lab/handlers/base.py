@@ -1,13 +1,54 @@
+import gzip
 import json
+import hashlib
 import traceback
 
+import tornado.gen
 import tornado.web
 from marshmallow.exceptions import ValidationError
 
 from services.base import BaseServiceException
+from services.cluster import cluster_service
+from utils.clients.cluster import FORWARDED_HEADER
+from utils.metrics import registry
+
+REQUEST_DURATION = registry.histogram(
+    'device_lab_http_request_duration_seconds', 'Time taken to serve HTTP requests',
+    labelnames=('handler', 'method', 'status'))
+
+
+class EncodedResponse(object):
+    """
+    response body encoded once and shared by requests, with a strong ETag derived from the content,
+    the gzipped body is another representation of it, tagged by `gzipped_etag`
+    """
+    GZIP_MIN_LENGTH = 1024
+
+    def __init__(self, status_code, data):
+        self.body = json.dumps({
+            'code': status_code,
+            'data': data,
+        }).encode()
+        digest = hashlib.sha1(self.body).hexdigest()
+        self.etag = '"{}"'.format(digest)
+        self.gzipped_etag = '"{}-gz"'.format(digest)
+        self._gzipped = None
+
+    @property
+    def gzippable(self):
+        return len(self.body) >= self.GZIP_MIN_LENGTH
+
+    @property
+    def gzipped(self):
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
 
 
 class BaseHandler(tornado.web.RequestHandler):
+    # large body is written chunk by chunk, so that the IOLoop is not held by one response
+    CHUNK_SIZE = 64 * 1024
+
     def set_default_headers(self):
         self.set_header("Access-Control-Allow-Origin", "*")
         self.set_header("Access-Control-Allow-Headers", "x-requested-with")
@@ -17,6 +58,10 @@ class BaseHandler(tornado.web.RequestHandler):
         self.set_status(204)
         self.finish()
 
+    def on_finish(self):
+        REQUEST_DURATION.labels(type(self).__name__, self.request.method, self.get_status()) \
+            .observe(self.request.request_time())
+
     def set_error_status(self, **kwargs):
         if 'exc_info' in kwargs:
             type_, value_, traceback_ = kwargs['exc_info']
@@ -36,6 +81,8 @@ class BaseHandler(tornado.web.RequestHandler):
                 'message': self._reason
             }
         }
+        if 'exc_info' in kwargs and isinstance(kwargs['exc_info'][1], BaseServiceException):
+            err_res['data'].update(kwargs['exc_info'][1].data)
         if self.settings.get("serve_traceback") and "exc_info" in kwargs:
             # in debug mode, try to send a traceback
             err_res['data']['traceback'] = traceback.format_exception(*kwargs["exc_info"])
@@ -48,3 +95,64 @@ class BaseHandler(tornado.web.RequestHandler):
             'data': data,
         }
         self.finish(json.dumps(res))
+
+    @tornado.gen.coroutine
+    def send_encoded_response(self, response):
+        """
+        :param response: EncodedResponse
+        """
+        gzipped = response.gzippable and self.accepts_gzip()
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Etag', response.gzipped_etag if gzipped else response.etag)
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+            return
+        body = response.body
+        if gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+            body = response.gzipped
+        self.set_header('Content-Length', len(body))
+        for start in range(0, len(body), self.CHUNK_SIZE):
+            if start:
+                yield self.flush()
+            self.write(body[start:start + self.CHUNK_SIZE])
+        self.finish()
+
+    def accepts_gzip(self):
+        """
+        :return: True if gzip is listed in Accept-Encoding, or covered by *, with a q-value above 0
+        """
+        qvalues = {}
+        for coding in self.request.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            qvalue = 1.0
+            for param in params.split(';'):
+                key, _, value = param.partition('=')
+                if key.strip().lower() == 'q':
+                    try:
+                        qvalue = float(value)
+                    except ValueError:
+                        qvalue = 0.0
+            qvalues[name.strip().lower()] = qvalue
+        return qvalues.get('gzip', qvalues.get('x-gzip', qvalues.get('*', 0.0))) > 0
+
+    def should_route(self):
+        """
+        :return: True if the request may be served by other nodes of the cluster,
+                 False if this node is not clustered or the request is forwarded by another node
+        """
+        return cluster_service is not None and FORWARDED_HEADER not in self.request.headers
+
+    @tornado.gen.coroutine
+    def forward(self, node_url, body=None):
+        """
+        relay the request to another node of the cluster and its answer back
+        :param body: sent in place of the body of the request if given
+        """
+        code, res_body = yield cluster_service.forward(
+            node_url, self.request.method, self.request.uri, self.request.body if body is None else body)
+        self.set_status(code)
+        self.set_header('Content-Type', 'application/json')
+        self.finish(res_body)
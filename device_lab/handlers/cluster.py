@@ -0,0 +1,21 @@
+from handlers.base import BaseHandler
+from services.cluster import cluster_service
+from services.selenium_grid import selenium_grid_service
+
+
+class ClusterStatusHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - cluster
+        description: Get nodes of the cluster as seen by this node and hubs of its shard, checked by peers for health
+        responses:
+            200:
+                description: |
+                    origin of this node, and k: node origin, v: whether it is on the hash ring and its failed checks
+                    in a row, hubs are all of the registry if not clustered
+        """
+        data = {'hubs': selenium_grid_service.get_owned_hubs_url()}
+        if cluster_service is not None:
+            data.update(cluster_service.get_stats())
+        self.send_response(200, data)
@@ -0,0 +1,71 @@
+import tornado.gen
+import tornado.web
+
+from handlers.base import BaseHandler
+from services.diagnostics import diagnostics_service
+
+DEBUG_TOKEN_HEADER = 'X-Device-Lab-Debug-Token'
+
+
+class LoopStatusHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - debug
+        description: Get stalls of the IOLoop of this process
+        responses:
+            200:
+                description: |
+                    lag threshold in seconds, stalls counted and max lag since start,
+                    and recent stalls, latest first, with their lag and the stack blocking the IOLoop if captured
+        """
+        self.send_response(200, diagnostics_service.get_loop_stats())
+
+
+class ProfileHandler(BaseHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        """---
+        tags:
+            - debug
+        description: |
+            Sample stacks of this process for some seconds while it keeps serving,
+            served only to requests with header X-Device-Lab-Debug-Token matched PROFILER_TOKEN
+        parameters:
+            - in: query
+              name: seconds
+              type: number
+              default: 5
+            - in: query
+              name: interval
+              type: number
+              default: 0.005
+              description: seconds between samples
+            - in: query
+              name: top
+              type: integer
+              default: 20
+            - in: query
+              name: all_threads
+              type: boolean
+              description: if true, every thread is sampled instead of the IOLoop only
+        responses:
+            200:
+                description: |
+                    number of samples, idle ones (IOLoop waiting for events), hot stacks with their samples,
+                    and hot frames by samples on top of stack (self) and in stack (total)
+            403:
+                description: profiler is disabled, or the token does not match
+            409:
+                description: another profile is running
+        """
+        diagnostics_service.check_access(self.request.headers.get(DEBUG_TOKEN_HEADER))
+        try:
+            seconds = float(self.get_argument('seconds', 5))
+            interval = float(self.get_argument('interval', 0.005))
+            top = int(self.get_argument('top', 20))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        data = yield diagnostics_service.profile(seconds, interval, top,
+                                                 all_threads=self.get_argument('all_threads', 'false') == 'true')
+        self.send_response(200, data)
@@ -0,0 +1,40 @@
+import os
+import time
+
+from handlers.base import BaseHandler
+from services.selenium_grid import selenium_grid_service
+
+STARTED_AT = time.time()
+
+
+class ReadinessHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - health
+        description: Tell load balancer whether this process serves fresh capabilities
+        responses:
+            200:
+                description: |
+                    ready, hubs are loaded from the registry and each hub is polled once,
+                    hubs still served with capabilities restored on start are listed as stale
+            503:
+                description: not ready, with hubs not polled yet
+        """
+        data = selenium_grid_service.get_readiness()
+        code = 200 if data['ready'] else 503
+        self.set_status(code)
+        self.send_response(code, data)
+
+
+class LivenessHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - health
+        description: Tell whether this process is serving, regardless of the freshness of its capabilities
+        responses:
+            200:
+                description: pid and seconds since start
+        """
+        self.send_response(200, {'pid': os.getpid(), 'uptime': time.time() - STARTED_AT})
@@ -0,0 +1,19 @@
+from handlers.base import BaseHandler
+from utils.metrics import registry
+
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - metrics
+        description: Get metrics of this process in prometheus text format
+        produces:
+            - text/plain
+        responses:
+            200:
+                description: counters, gauges and histograms of request latency, hub and appium fetches,
+                    lock operations and background jobs
+        """
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.finish(registry.render())
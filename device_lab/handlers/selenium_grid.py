@@ -1,12 +1,49 @@
-import tornado.gen
+import json
+from asyncio import CancelledError
 
+import tornado.gen
+from tornado.iostream import StreamClosedError
 
-from handlers.base import BaseHandler
+from handlers.base import BaseHandler, EncodedResponse
 from services.selenium_grid import selenium_grid_service
-from models.dto_schema import CapabilityLockSchema
+from services.hub_registry import hub_registry
+from services.cluster import cluster_service, PeerUnavailableException
+from models.dto_schema import CapabilityLockSchema, CapabilityWaitSchema, CapabilityLockBatchSchema, \
+    CapabilityReleaseBatchSchema, CapabilityLockExtendSchema, HubSchema
+from utils.streams import ServerSentEvent
+from config import EVENT_STREAM_BUFFER_SIZE, EVENT_STREAM_HEARTBEAT
+
+# set on capability responses which include capabilities restored on start and not confirmed by hubs yet
+STALE_HEADER = 'X-Device-Lab-Stale'
+
+
+class ShardedHandler(BaseHandler):
+    """
+    handler of capabilities and locks, which are served by the cluster node owning their hub
+    """
+
+    def get_token_owner(self, token, salt):
+        """
+        :return: url of the node the token should be forwarded to, None if it is served here
+        """
+        if not self.should_route():
+            return None
+        return selenium_grid_service.get_token_owner(token, salt)
+
+    def group_by_owner(self, tokens, salt):
+        """
+        :return: k: url of the node owning them, None for this node, v: tokens
+        """
+        groups = {}
+        for token in tokens:
+            groups.setdefault(self.get_token_owner(token, salt), []).append(token)
+        return groups
+
+    def get_forwarded_body(self, **fields):
+        return json.dumps({**json.loads(self.request.body.decode()), **fields}).encode()
 
 
-class CapabilityListHandler(BaseHandler):
+class CapabilityListHandler(ShardedHandler):
     @tornado.gen.coroutine
     def get(self):
         """---
@@ -41,23 +78,255 @@ class CapabilityListHandler(BaseHandler):
               description: if true, all capabilities will be return
         responses:
             200:
-                description: available capabilities matched query conditions
+                description: |
+                    available capabilities matched query conditions, with a strong ETag,
+                    in a cluster they are merged from every alive node, without ETag,
+                    X-Device-Lab-Stale is set if some are restored on start and not polled yet
+            304:
+                description: not modified since the ETag in If-None-Match
         """
+        # in a cluster every node answers for its shard, and the results are merged
+        routed = self.should_route()
+        encode = None if routed else self.encode_devices
         debug = self.get_argument('debug', 'false')
         if 'true' == debug:
-            devices = selenium_grid_service.get_all_capabilities()
+            response = selenium_grid_service.get_all_capabilities(encode=encode)
         else:
-            devices = selenium_grid_service.get_available_capabilities(
+            response = selenium_grid_service.get_available_capabilities(
                 platform_name=self.get_argument('platform_name'),
                 device_names=self.get_arguments('device_name'),
                 platform_versions=self.get_arguments('platform_version'),
                 min_platform_version=self.get_argument('min_platform_version', None),
                 max_platform_version=self.get_argument('max_platform_version', None),
+                encode=encode,
             )
-        self.send_response(200, devices)
+        if selenium_grid_service.has_stale_capabilities():
+            self.set_header(STALE_HEADER, '1')
+        if routed:
+            peer_devices = yield cluster_service.fan_out(self.request.uri)
+            self.send_response(200, list(response) + [device for devices in peer_devices for device in devices])
+            return
+        yield self.send_encoded_response(response)
+
+    @staticmethod
+    def encode_devices(devices):
+        return EncodedResponse(200, devices)
+
+
+class CapabilityEventStreamHandler(BaseHandler):
+    _subscriber = None
+
+    @tornado.gen.coroutine
+    def get(self):
+        """---
+        tags:
+            - capability
+        description: Stream changes of capabilities as server-sent events
+        responses:
+            200:
+                description: |
+                    text/event-stream, a `snapshot` event of all capabilities (with `free` flag) comes first,
+                    followed by `added`, `removed`, `changed` events of capabilities
+                    and `locked`, `released`, `expired` events of appium_url or udid,
+                    `snapshot` is sent again if the client falls too far behind,
+                    with a shared lock backend, lock events are those of this process only,
+                    while the `free` flag of `snapshot` is checked against the backend
+        """
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self._subscriber = selenium_grid_service.subscribe_capability_events(EVENT_STREAM_BUFFER_SIZE)
+        try:
+            self.write_snapshot()
+            while True:
+                yield self.flush()
+                events, overflowed = yield self._subscriber.get(EVENT_STREAM_HEARTBEAT)
+                if self._subscriber.closed:
+                    return
+                if overflowed:
+                    self.write_snapshot()
+                elif not events:
+                    self.write(b': keep-alive\n\n')
+                for event in events:
+                    self.write(event.encode())
+        except StreamClosedError:
+            pass
+        finally:
+            selenium_grid_service.unsubscribe_capability_events(self._subscriber)
+
+    def write_snapshot(self):
+        self.write(ServerSentEvent('snapshot', selenium_grid_service.get_capability_snapshot()).encode())
+
+    def on_connection_close(self):
+        if self._subscriber is not None:
+            selenium_grid_service.unsubscribe_capability_events(self._subscriber)
+
+
+class CapabilityQueryCacheHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - capability
+        description: Get statistics of capability query cache
+        responses:
+            200:
+                description: generation, size, hits and misses of the cache
+        """
+        self.send_response(200, selenium_grid_service.get_query_cache_stats())
+
+
+class HubListHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - hub
+        description: Get all hubs
+        responses:
+            200:
+                description: list of hubs
+        """
+        self.send_response(200, hub_registry.get_all())
+
+    @tornado.gen.coroutine
+    def post(self):
+        """---
+        tags:
+            - hub
+        description: Add a hub, its devices are polled right away
+        parameters:
+            - in: body
+              required: true
+              schema: Hub
+        responses:
+            201:
+                description: the added hub
+            409:
+                description: hub of the url exists
+        """
+        hub = HubSchema.from_json(self.request.body)
+        hub = yield hub_registry.create(hub['url'])
+        self.send_response(201, hub)
+
+
+class HubDetailHandler(BaseHandler):
+    def get(self, hub_id):
+        """---
+        tags:
+            - hub
+        description: Get a hub
+        parameters:
+            - in: path
+              name: hub_id
+              required: true
+              type: integer
+        responses:
+            200:
+                description: the hub
+        """
+        self.send_response(200, hub_registry.get(int(hub_id)))
+
+    @tornado.gen.coroutine
+    def put(self, hub_id):
+        """---
+        tags:
+            - hub
+        description: Update url of a hub
+        parameters:
+            - in: path
+              name: hub_id
+              required: true
+              type: integer
+            - in: body
+              required: true
+              schema: Hub
+        responses:
+            200:
+                description: the updated hub
+        """
+        hub = HubSchema.from_json(self.request.body)
+        hub = yield hub_registry.update(int(hub_id), hub['url'])
+        self.send_response(200, hub)
+
+    @tornado.gen.coroutine
+    def delete(self, hub_id):
+        """---
+        tags:
+            - hub
+        description: Remove a hub, its devices are removed right away
+        parameters:
+            - in: path
+              name: hub_id
+              required: true
+              type: integer
+        responses:
+            200:
+                description: success
+        """
+        yield hub_registry.delete(int(hub_id))
+        self.send_response(200, {})
+
+
+class HubStatusListHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - hub
+        description: Get polling status of hubs
+        responses:
+            200:
+                description: |
+                    k: hub_url, v: polling interval, consecutive failures, time of last success and failure,
+                    latency of last poll and time of next poll, in seconds
+        """
+        self.send_response(200, selenium_grid_service.get_hub_poll_stats())
+
+
+class AppiumNodeStatusListHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - hub
+        description: Get session polling status of appium nodes
+        responses:
+            200:
+                description: |
+                    k: appium_url, v: polling interval, consecutive failures, time of last success and failure,
+                    latency of last poll, time of next poll and circuit state (closed, open or half_open)
+        """
+        self.send_response(200, selenium_grid_service.get_appium_poll_stats())
+
+
+class PlacementStatusHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - capability
+        description: Get state of the policy ordering available capabilities
+        responses:
+            200:
+                description: |
+                    name of the policy, and for balanced policy, locked and total devices of each hub
+                    and failure rates of appium nodes failed recently
+        """
+        self.send_response(200, selenium_grid_service.get_placement_stats())
+
+
+class BackgroundJobStatusListHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - hub
+        description: Get status of background jobs of this process
+        responses:
+            200:
+                description: |
+                    k: job name, v: period and timeout in seconds, whether a cycle is running, ticks skipped
+                    because last cycle was still running, and outcome, duration and result of recent cycles
+        """
+        self.send_response(200, selenium_grid_service.get_background_job_stats())
 
 
-class CapabilityLockListHandler(BaseHandler):
+class CapabilityLockListHandler(ShardedHandler):
+    @tornado.gen.coroutine
     def post(self):
         """---
         tags:
@@ -70,8 +339,14 @@ class CapabilityLockListHandler(BaseHandler):
         responses:
             201:
                 description: success
+            503:
+                description: the cluster node owning the capability is unavailable
         """
         cap_lock = CapabilityLockSchema.from_json(self.request.body)
+        owner = self.get_token_owner(cap_lock['capability_token'], 'capability')
+        if owner is not None:
+            yield self.forward(owner)
+            return
         token = selenium_grid_service.lock_capability(cap_lock['capability_token'], cap_lock['timeout'])
         data = {
             'token': token,
@@ -79,7 +354,182 @@ class CapabilityLockListHandler(BaseHandler):
         self.send_response(201, data)
 
 
-class CapabilityLockDetailHandler(BaseHandler):
+class CapabilityLockBatchHandler(ShardedHandler):
+    @tornado.gen.coroutine
+    def post(self):
+        """---
+        tags:
+            - capability
+        description: |
+            Lock capabilities in batch, either those of capability_tokens,
+            or up to count available ones matched query conditions, each on a distinct appium node
+        parameters:
+            - in: body
+              required: true
+              schema: CapabilityLockBatch
+        responses:
+            201:
+                description: lock tokens with locked capabilities, and capability tokens failed to lock
+        """
+        cap_lock = CapabilityLockBatchSchema.from_json(self.request.body)
+        cap_tokens = cap_lock['capability_tokens']
+        groups = {None: cap_tokens} if cap_tokens is None else self.group_by_owner(cap_tokens, 'capability')
+        data = selenium_grid_service.lock_capabilities(
+            timeout=cap_lock['timeout'],
+            cap_tokens=groups.pop(None, []),
+            platform_name=cap_lock['platform_name'],
+            device_names=cap_lock['device_name'],
+            platform_versions=cap_lock['platform_version'],
+            min_platform_version=cap_lock['min_platform_version'],
+            max_platform_version=cap_lock['max_platform_version'],
+            count=cap_lock['count'],
+        )
+        if groups:
+            # tokens of other shards are locked by their nodes at the same time
+            answers = yield cluster_service.forward_many('POST', self.request.uri, dict(
+                (owner, self.get_forwarded_body(capability_tokens=tokens)) for owner, tokens in groups.items()))
+            for owner, answer in answers.items():
+                self.merge_locks(data, answer, groups[owner])
+        elif cap_tokens is None and self.should_route():
+            # the rest of count is asked from other nodes one by one, so that no more than count are locked
+            for owner in cluster_service.membership.get_peers():
+                count = cap_lock['count'] - len(data['locks'])
+                if count <= 0:
+                    break
+                answers = yield cluster_service.forward_many('POST', self.request.uri, {
+                    owner: self.get_forwarded_body(count=count)})
+                self.merge_locks(data, answers[owner], [])
+        self.send_response(201, data)
+
+    @staticmethod
+    def merge_locks(data, answer, cap_tokens):
+        if isinstance(answer, PeerUnavailableException) or answer.get('code') != 201:
+            data['failed'].extend(cap_tokens)
+            return
+        data['locks'].extend(answer['data']['locks'])
+        data['failed'].extend(answer['data']['failed'])
+
+    @tornado.gen.coroutine
+    def delete(self):
+        """---
+        tags:
+            - capability
+        description: release locked capabilities in batch
+        parameters:
+            - in: body
+              required: true
+              schema: CapabilityReleaseBatch
+        responses:
+            200:
+                description: lock tokens which are not found or expired
+        """
+        cap_release = CapabilityReleaseBatchSchema.from_json(self.request.body)
+        groups = self.group_by_owner(cap_release['tokens'], 'lock')
+        not_found = selenium_grid_service.release_capabilities(groups.pop(None, []))
+        if groups:
+            answers = yield cluster_service.forward_many('DELETE', self.request.uri, dict(
+                (owner, self.get_forwarded_body(tokens=tokens)) for owner, tokens in groups.items()))
+            for owner, answer in answers.items():
+                if isinstance(answer, PeerUnavailableException) or answer.get('code') != 200:
+                    not_found.extend(groups[owner])
+                else:
+                    not_found.extend(answer['data']['not_found'])
+        self.send_response(200, {'not_found': not_found})
+
+
+class CapabilityLockWaitHandler(BaseHandler):
+    _future = None
+
+    @tornado.gen.coroutine
+    def post(self):
+        """---
+        tags:
+            - capability
+        description: Wait for an available capability matched query conditions and lock it
+        parameters:
+            - in: body
+              required: true
+              schema: CapabilityWait
+        responses:
+            201:
+                description: success, lock token and the locked capability
+            408:
+                description: no matched capability is available before wait timeout
+            429:
+                description: wait queue, or the share of the team, is full
+        """
+        cap_wait = CapabilityWaitSchema.from_json(self.request.body)
+        self._future = selenium_grid_service.wait_and_lock_capability(
+            platform_name=cap_wait['platform_name'],
+            device_names=cap_wait['device_name'],
+            platform_versions=cap_wait['platform_version'],
+            min_platform_version=cap_wait['min_platform_version'],
+            max_platform_version=cap_wait['max_platform_version'],
+            timeout=cap_wait['timeout'],
+            wait=cap_wait['wait'],
+            priority=cap_wait['priority'],
+            team=cap_wait['team'] or self.request.remote_ip,
+        )
+        try:
+            data = yield self._future
+        except CancelledError:
+            return  # client is gone
+        self.send_response(201, data)
+
+    def on_connection_close(self):
+        if self._future is not None:
+            selenium_grid_service.cancel_waiting(self._future)
+
+
+class CapabilityLockQueueHandler(BaseHandler):
+    def get(self):
+        """---
+        tags:
+            - capability
+        description: Get state of the queue of requests waiting for capabilities
+        responses:
+            200:
+                description: |
+                    number of waiting requests in total and by priority class, limits of the queue,
+                    and by team, number of waiting requests and seconds the oldest one has waited
+        """
+        self.send_response(200, selenium_grid_service.get_wait_queue_stats())
+
+
+class CapabilityLockDetailHandler(ShardedHandler):
+    @tornado.gen.coroutine
+    def put(self, token):
+        """---
+        tags:
+            - capability
+        description: |
+            Extend locked capability to timeout seconds from now,
+            so that a client could keep a short lock by heartbeat
+        parameters:
+            - in: path
+              name: token
+              required: true
+              type: string
+            - in: body
+              required: true
+              schema: CapabilityLockExtend
+        responses:
+            200:
+                description: success
+            404:
+                description: lock is expired, released or taken by others
+            503:
+                description: the cluster node owning the lock is unavailable
+        """
+        extend = CapabilityLockExtendSchema.from_json(self.request.body)
+        owner = self.get_token_owner(token, 'lock')
+        if owner is not None:
+            yield self.forward(owner)
+            return
+        data = selenium_grid_service.extend_capability(token, extend['timeout'])
+        self.send_response(200, data)
+
+    @tornado.gen.coroutine
     def delete(self, token):
         """---
         tags:
@@ -93,6 +543,12 @@ class CapabilityLockDetailHandler(BaseHandler):
         responses:
             200:
                 description: success
+            503:
+                description: the cluster node owning the lock is unavailable
         """
+        owner = self.get_token_owner(token, 'lock')
+        if owner is not None:
+            yield self.forward(owner)
+            return
         selenium_grid_service.release_capability(token)
         self.send_response(200, {})
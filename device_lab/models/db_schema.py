@@ -2,9 +2,10 @@ from sqlalchemy import Column, ForeignKey, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm.session import sessionmaker
 
-from config import DB_URL
+from config import DB_URL, DB_POOL_SIZE
 
 Base = declarative_base()
 
@@ -12,10 +13,14 @@ Base = declarative_base()
 class SeleniumGridHub(Base):
     __tablename__ = 'selenium_grid_hub'
     id = Column(Integer, primary_key=True)
-    url = Column(String(250), nullable=False)
+    url = Column(String(250), nullable=False, unique=True)
 
 
-engine = create_engine(DB_URL)
+# NOTE: connections are checked before use and recycled, since they may be idle for long between polls
+engine_options = dict(pool_recycle=3600, pool_pre_ping=True)
+if make_url(DB_URL).drivername != 'sqlite':
+    engine_options['pool_size'] = DB_POOL_SIZE  # sqlite opens a connection per use
+engine = create_engine(DB_URL, **engine_options)
 
 Session = sessionmaker()
 Session.configure(bind=engine)
@@ -1,6 +1,7 @@
-from marshmallow import Schema, fields
+from marshmallow import Schema, fields, validate, validates_schema, ValidationError
 
 from spec import register_schema
+from utils.waiters import PRIORITIES, DEFAULT_PRIORITY
 
 
 class BaseSchema(Schema):
@@ -17,3 +18,52 @@ class CapabilityLockSchema(BaseSchema):
     capability_token = fields.String(required=True)
     timeout = fields.Integer(required=True, validate=lambda i: 0 < i < 3600 * 4)
 register_schema('CapabilityLock', CapabilityLockSchema)
+
+
+class CapabilityLockExtendSchema(BaseSchema):
+    timeout = fields.Integer(required=True, validate=lambda i: 0 < i < 3600 * 4)
+register_schema('CapabilityLockExtend', CapabilityLockExtendSchema)
+
+
+class CapabilityWaitSchema(BaseSchema):
+    # query conditions, same as those of capability list
+    platform_name = fields.String(required=True)
+    device_name = fields.List(fields.String(), missing=list)
+    platform_version = fields.List(fields.String(), missing=list)
+    min_platform_version = fields.String(missing=None, allow_none=True)
+    max_platform_version = fields.String(missing=None, allow_none=True)
+    timeout = fields.Integer(required=True, validate=lambda i: 0 < i < 3600 * 4)
+    wait = fields.Integer(missing=30, validate=lambda i: 0 < i <= 600)
+    priority = fields.String(missing=DEFAULT_PRIORITY, validate=validate.OneOf(sorted(PRIORITIES)))
+    # client or team which the queue is shared fairly between, address of the client by default
+    team = fields.String(missing=None, allow_none=True, validate=validate.Length(max=128))
+register_schema('CapabilityWait', CapabilityWaitSchema)
+
+
+class CapabilityLockBatchSchema(BaseSchema):
+    # either capability tokens, or query conditions (same as those of capability list) with count
+    capability_tokens = fields.List(fields.String(), missing=None)
+    platform_name = fields.String(missing=None)
+    device_name = fields.List(fields.String(), missing=list)
+    platform_version = fields.List(fields.String(), missing=list)
+    min_platform_version = fields.String(missing=None, allow_none=True)
+    max_platform_version = fields.String(missing=None, allow_none=True)
+    count = fields.Integer(missing=1, validate=lambda i: 0 < i <= 1000)
+    timeout = fields.Integer(required=True, validate=lambda i: 0 < i < 3600 * 4)
+
+    @validates_schema
+    def validate_target(self, data):
+        if data.get('capability_tokens') is None and data.get('platform_name') is None:
+            raise ValidationError('either capability_tokens or platform_name is required')
+register_schema('CapabilityLockBatch', CapabilityLockBatchSchema)
+
+
+class CapabilityReleaseBatchSchema(BaseSchema):
+    tokens = fields.List(fields.String(), required=True)
+register_schema('CapabilityReleaseBatch', CapabilityReleaseBatchSchema)
+
+
+class HubSchema(BaseSchema):
+    id = fields.Integer(dump_only=True)
+    url = fields.Url(required=True, require_tld=False)
+register_schema('Hub', HubSchema)
@@ -1,10 +1,15 @@
 class BaseServiceException(Exception):
     # error code should conform with HTTP status code, or else need to map in handlers layer
     INVALID_CODE = 400
+    FORBIDDEN_CODE = 403
     NOT_FOUND_CODE = 404
+    TIMEOUT_CODE = 408
     CONFLICT_CODE = 409
+    TOO_MANY_REQUESTS_CODE = 429
+    SERVICE_UNAVAILABLE_CODE = 503
 
-    def __init__(self, err_code, err_msg):
+    def __init__(self, err_code, err_msg, data=None):
         super().__init__(err_msg)
         self.err_code = err_code
         self.err_msg = err_msg
+        self.data = data or {}  # extra detail sent along with the error message
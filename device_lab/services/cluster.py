@@ -0,0 +1,125 @@
+import json
+import asyncio
+import logging
+from asyncio import CancelledError
+from urllib.parse import urljoin
+
+from utils.clients.cluster import ClusterClient
+from utils.cluster import ClusterMembership
+from utils.tasks import PeriodicTask
+from services.base import BaseServiceException
+
+from config import API_BASE_URL, CLUSTER_NODES, CLUSTER_SELF, CLUSTER_REPLICAS, CLUSTER_CHECK_INTERVAL, \
+    CLUSTER_FAILURE_THRESHOLD, CLUSTER_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+class PeerUnavailableException(BaseServiceException):
+    def __init__(self, err_msg):
+        super().__init__(self.SERVICE_UNAVAILABLE_CODE, err_msg)
+
+
+class ClusterService(object):
+    """
+    route requests between nodes of a cluster, each of which polls and locks the hubs of its shard only
+
+    a request about a capability or a lock is forwarded to the node owning its hub, as told by the token,
+    and a query is answered by every alive node in parallel, peers failing to answer are left out
+    peers are checked every `check_interval` seconds, which moves hubs of the nodes gone or back
+    """
+
+    def __init__(self, membership, client=None, timeout=5, check_interval=2, status_uri=None):
+        self.membership = membership  # type: ClusterMembership
+        self._client = client or ClusterClient()
+        self._timeout = timeout
+        self._check_interval = check_interval
+        self._status_uri = status_uri or urljoin(API_BASE_URL, 'cluster-status')
+        self._job = None  # type: PeriodicTask
+
+    async def forward(self, node_url, method, uri, body=None):
+        """
+        :return: (status code, body) answered by the node
+        :raise PeerUnavailableException: if the node fails to answer
+        """
+        try:
+            res = await self._client.fetch(node_url, uri, method, body, self._timeout)
+        except CancelledError:
+            raise
+        except Exception as e:
+            msg = "cluster node is unavailable: {}, {}".format(node_url, str(e))
+            logger.warning(msg)
+            raise PeerUnavailableException(msg)
+        return res.code, res.body
+
+    async def forward_many(self, method, uri, bodies):
+        """
+        send a request to each node at the same time
+        :param bodies: k: node url, v: body sent to it
+        :return: k: node url, v: decoded body, or PeerUnavailableException if the node fails to answer
+        """
+        node_urls = list(bodies)
+        results = await asyncio.gather(*(self.forward(node_url, method, uri, bodies[node_url])
+                                         for node_url in node_urls), return_exceptions=True)
+        answers = {}
+        for node_url, result in zip(node_urls, results):
+            if isinstance(result, BaseException) and not isinstance(result, PeerUnavailableException):
+                raise result
+            answers[node_url] = result if isinstance(result, PeerUnavailableException) else json.loads(result[1])
+        return answers
+
+    async def fan_out(self, uri):
+        """
+        :return: data answered with 200 by alive peers, those failing are logged and left out
+        """
+        answers = await self.forward_many('GET', uri, dict((node_url, None) for node_url in self.membership.get_peers()))
+        data = []
+        for node_url, answer in answers.items():
+            if isinstance(answer, PeerUnavailableException) or answer.get('code') != 200:
+                logger.warning('cluster node is left out of query: %s', node_url)
+                continue
+            data.append(answer['data'])
+        return data
+
+    async def check_peers(self):
+        """
+        :return: k: peer url, v: whether it answers
+        """
+        async def check(node_url):
+            try:
+                res = await self._client.fetch(node_url, self._status_uri, timeout=self._timeout)
+                return res.code == 200
+            except CancelledError:
+                raise
+            except Exception as e:
+                logger.warning('fail to check cluster node: %s, %s', node_url, str(e))
+                return False
+
+        peers = self.membership.get_peers(alive_only=False)
+        results = await asyncio.gather(*(check(node_url) for node_url in peers))
+        for node_url, success in zip(peers, results):
+            if self.membership.on_check(node_url, success):
+                logger.info('cluster node is %s: %s', 'back' if success else 'gone', node_url)
+        return dict(zip(peers, results))
+
+    def start_background_jobs(self):
+        """
+        start checking peers in current process, should be called after IOLoop is ready
+        """
+        self._job = PeriodicTask('check_cluster_peers', self.check_peers, self._check_interval,
+                                 timeout=self._timeout * 2)
+        self._job.start()
+
+    def get_stats(self):
+        return self.membership.get_stats()
+
+
+def new_cluster_membership():
+    if not CLUSTER_NODES:
+        return None
+    return ClusterMembership(CLUSTER_SELF, CLUSTER_NODES, CLUSTER_REPLICAS, CLUSTER_FAILURE_THRESHOLD)
+
+
+cluster_membership = new_cluster_membership()
+cluster_service = None if cluster_membership is None else ClusterService(
+    cluster_membership, timeout=CLUSTER_TIMEOUT, check_interval=CLUSTER_CHECK_INTERVAL)
@@ -0,0 +1,85 @@
+import hmac
+import threading
+
+from tornado.ioloop import IOLoop
+
+from utils.profiling import LoopLagMonitor, SamplingProfiler, ProfilerBusyError
+from services.base import BaseServiceException
+
+from config import LOOP_STALL_THRESHOLD, PROFILER_TOKEN, PROFILER_MAX_SECONDS
+
+
+class DebugAccessDeniedException(BaseServiceException):
+    def __init__(self, err_msg):
+        super().__init__(self.FORBIDDEN_CODE, err_msg)
+
+
+class InvalidProfileException(BaseServiceException):
+    def __init__(self, err_msg):
+        super().__init__(self.INVALID_CODE, err_msg)
+
+
+class ProfilerBusyException(BaseServiceException):
+    def __init__(self, err_msg):
+        super().__init__(self.CONFLICT_CODE, err_msg)
+
+
+class DiagnosticsService(object):
+    """
+    find what keeps the IOLoop of this process busy: stalls are caught by a monitor running all the time,
+    and a sampling profiler is run on demand by holders of the debug token
+    """
+
+    def __init__(self, monitor=None, profiler=None, token=None, max_seconds=30):
+        self._monitor = monitor  # type: LoopLagMonitor  # None if disabled
+        self._profiler = profiler or SamplingProfiler()
+        self._token = token
+        self._max_seconds = max_seconds
+
+    def check_access(self, token):
+        """
+        :raise DebugAccessDeniedException: if debug endpoints are disabled or the token does not match
+        """
+        if not self._token:
+            raise DebugAccessDeniedException("debug endpoints are disabled")
+        if token is None or not hmac.compare_digest(token.encode(), self._token.encode()):
+            raise DebugAccessDeniedException("invalid debug token")
+
+    async def profile(self, seconds, interval=0.005, top=20, all_threads=False):
+        """
+        sample stacks of the IOLoop thread, or of every thread, for `seconds` while it keeps serving
+        :return: samples summarized by SamplingProfiler
+        """
+        if not 0 < seconds <= self._max_seconds:
+            raise InvalidProfileException("seconds should be in (0, {}]".format(self._max_seconds))
+        if not 0.001 <= interval <= seconds:
+            raise InvalidProfileException("interval should be in [0.001, seconds]")
+        thread_id = None if all_threads else threading.get_ident()
+        try:
+            result = await IOLoop.current().run_in_executor(
+                None, self._profiler.sample, thread_id, seconds, interval, top)
+        except ProfilerBusyError as e:
+            raise ProfilerBusyException(str(e))
+        return {'seconds': seconds, 'interval': interval, **result}
+
+    def get_loop_stats(self):
+        """
+        :return: lag threshold, stalls counted and recent ones with the stacks blocking the IOLoop
+        """
+        if self._monitor is None:
+            return {'threshold': None, 'total_stalls': 0, 'max_lag': None, 'stalls': []}
+        return self._monitor.get_stats()
+
+    def start_background_jobs(self):
+        """
+        start monitoring current IOLoop, should be called after it is ready
+        """
+        if self._monitor is not None:
+            self._monitor.start()
+
+
+diagnostics_service = DiagnosticsService(
+    monitor=LoopLagMonitor(LOOP_STALL_THRESHOLD) if LOOP_STALL_THRESHOLD > 0 else None,
+    token=PROFILER_TOKEN,
+    max_seconds=PROFILER_MAX_SECONDS,
+)
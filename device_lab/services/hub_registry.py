@@ -0,0 +1,172 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.gen
+from tornado.ioloop import IOLoop
+from sqlalchemy.exc import IntegrityError
+
+from models.db_schema import Session, SeleniumGridHub
+from services.base import BaseServiceException
+
+from config import DB_POOL_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+class HubNotFoundException(BaseServiceException):
+    def __init__(self, err_msg):
+        super().__init__(self.NOT_FOUND_CODE, err_msg)
+
+
+class HubConflictException(BaseServiceException):
+    def __init__(self, err_msg):
+        super().__init__(self.CONFLICT_CODE, err_msg)
+
+
+class HubRegistry(object):
+    """
+    hubs of selenium grid kept in memory, so that reading them never touches the database
+
+    the table is re-read by `refresh` in an executor, and listeners are notified only if it is changed,
+    changes made through the registry are written to the table and applied to the memory together,
+    urls are unique, checked against the memory and urls being written first, and then by the table itself
+    """
+
+    def __init__(self, session_factory=Session, executor=None):
+        self._session_factory = session_factory
+        # NOTE: database is accessed by blocking driver, keep it off the IOLoop
+        self._executor = executor or ThreadPoolExecutor(max_workers=DB_POOL_SIZE)
+        self._hubs = {}  # k: id, v: url
+        self._pending_urls = set()  # urls being written to the table
+        self._version = 0  # moved by every change made through the registry
+        self._listeners = []
+        self.loaded = False  # whether hubs are loaded from the table once
+
+    def add_listener(self, listener):
+        """
+        listener will be called without argument whenever hubs are changed
+        """
+        self._listeners.append(listener)
+
+    def get_all_urls(self):
+        urls = []
+        for _, url in sorted(self._hubs.items()):
+            if url not in urls:
+                urls.append(url)
+        return urls
+
+    def get_all(self):
+        return list({'id': hub_id, 'url': url} for hub_id, url in sorted(self._hubs.items()))
+
+    def get(self, hub_id):
+        url = self._hubs.get(hub_id)
+        if url is None:
+            raise HubNotFoundException("hub does not exists: {}".format(hub_id))
+        return {'id': hub_id, 'url': url}
+
+    @tornado.gen.coroutine
+    def refresh(self):
+        """
+        :return: True if hubs are changed
+        """
+        version = self._version
+        hubs = yield self._run(self._load_hubs)
+        self.loaded = True
+        if version != self._version:
+            return False  # changed through the registry while loading, the loaded one may be stale
+        return self._apply(hubs)
+
+    @tornado.gen.coroutine
+    def create(self, url):
+        self._check_url(url)
+        self._pending_urls.add(url)
+        try:
+            hub_id = yield self._run(self._insert_hub, url)
+        except IntegrityError:
+            raise HubConflictException("hub already exists: {}".format(url))
+        finally:
+            self._pending_urls.discard(url)
+        self._apply({**self._hubs, hub_id: url})
+        return {'id': hub_id, 'url': url}
+
+    @tornado.gen.coroutine
+    def update(self, hub_id, url):
+        self.get(hub_id)
+        self._check_url(url, hub_id)
+        self._pending_urls.add(url)
+        try:
+            found = yield self._run(self._update_hub, hub_id, url)
+        except IntegrityError:
+            raise HubConflictException("hub already exists: {}".format(url))
+        finally:
+            self._pending_urls.discard(url)
+        if not found:
+            self._apply(dict((k, v) for k, v in self._hubs.items() if k != hub_id))
+            raise HubNotFoundException("hub does not exists: {}".format(hub_id))
+        self._apply({**self._hubs, hub_id: url})
+        return {'id': hub_id, 'url': url}
+
+    @tornado.gen.coroutine
+    def delete(self, hub_id):
+        self.get(hub_id)
+        yield self._run(self._delete_hub, hub_id)
+        self._apply(dict((k, v) for k, v in self._hubs.items() if k != hub_id))
+
+    def _check_url(self, url, hub_id=None):
+        if url in self._pending_urls:
+            raise HubConflictException("hub is being written: {}".format(url))
+        for other_id, other_url in self._hubs.items():
+            if other_url == url and other_id != hub_id:
+                raise HubConflictException("hub already exists: {}".format(url))
+
+    def _apply(self, hubs):
+        self._version += 1
+        if hubs == self._hubs:
+            return False
+        self._hubs = hubs
+        logger.info('hubs are changed: %s', self.get_all_urls())
+        for listener in self._listeners:
+            listener()
+        return True
+
+    def _run(self, func, *args):
+        return IOLoop.current().run_in_executor(self._executor, func, *args)
+
+    # following methods are run in executor
+    def _load_hubs(self):
+        session = self._session_factory()
+        try:
+            return dict((hub.id, hub.url) for hub in session.query(SeleniumGridHub.id, SeleniumGridHub.url))
+        finally:
+            session.close()
+
+    def _insert_hub(self, url):
+        session = self._session_factory()
+        try:
+            hub = SeleniumGridHub(url=url)
+            session.add(hub)
+            session.commit()
+            return hub.id
+        finally:
+            session.close()
+
+    def _update_hub(self, hub_id, url):
+        session = self._session_factory()
+        try:
+            count = session.query(SeleniumGridHub).filter(SeleniumGridHub.id == hub_id).update({'url': url})
+            session.commit()
+            return count > 0
+        finally:
+            session.close()
+
+    def _delete_hub(self, hub_id):
+        session = self._session_factory()
+        try:
+            session.query(SeleniumGridHub).filter(SeleniumGridHub.id == hub_id).delete()
+            session.commit()
+        finally:
+            session.close()
+
+
+hub_registry = HubRegistry()
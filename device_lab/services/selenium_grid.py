@@ -1,30 +1,70 @@
+import os
 import json
+import heapq
 import time
+import uuid
+import asyncio
 import logging
+from asyncio import CancelledError
 
-from tornado.gen import convert_yielded
-
-from rx import Observable
-from rx.concurrency import IOLoopScheduler
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
 
 from itsdangerous import URLSafeSerializer, BadSignature
 
-from models.db_schema import Session, SeleniumGridHub
 from utils.clients.selenium_grid import SeleniumGridClient
 from utils.clients.appium import AppiumClient
-from utils.managers import SimpleLockManager
+from utils.managers import BaseLockManager, SimpleLockManager, RedisLockManager, CapabilityStore, \
+    LockConflictError, acquire_all
+from utils.caches import GenerationCache, LRUCache
+from utils.waiters import WaiterQueue, QueueFullError, DEFAULT_PRIORITY, DEFAULT_TEAM
+from utils.streams import EventBroadcaster, ServerSentEvent
+from utils.polling import PollState, CircuitBreaker
+from utils.metrics import registry
+from utils.tasks import PeriodicTask, FetchPool
+from utils.journal import LockJournal, CapabilitySnapshotFile, load_or_create_secret
+from utils.placement import BasePlacementPolicy, HubOrderPolicy, new_placement_policy
+from utils.cluster import ClusterMembership
 from services.base import BaseServiceException
-from utils.misc import new_random_string, on_exception_return, get_base_url, is_string_in_partially
+from services.hub_registry import HubRegistry, hub_registry as default_hub_registry
+from services.cluster import cluster_membership
+from utils.misc import new_random_string, get_base_url, parse_version, is_string_in_partially
+
+from utils.shared_memory import SharedMemoryLockManager, SharedCapabilitySnapshot
 
-from config import LOCK_SECRET
+from config import LOCK_SECRET, HUB_FAILURE_GRACE_PERIOD, LOCK_BACKEND, REDIS_URL, WORKERS, SHARED_MEMORY_DIR, \
+    SHARED_LOCK_SLOTS, HUB_POLL_MIN_INTERVAL, HUB_POLL_MAX_INTERVAL, HUB_POLL_MAX_BACKOFF, HUB_POLL_TIMEOUT, \
+    APPIUM_POLL_MAX_INTERVAL, APPIUM_POLL_TIMEOUT, APPIUM_POLL_CONCURRENCY, APPIUM_CIRCUIT_THRESHOLD, \
+    APPIUM_CIRCUIT_RESET_TIMEOUT, HUB_FETCH_CONCURRENCY, LOCK_JOURNAL_DIR, LOCK_JOURNAL_FLUSH_INTERVAL, \
+    LOCK_JOURNAL_COMPACT_THRESHOLD, PLACEMENT_POLICY, WAIT_QUEUE_MAX_SIZE, WAIT_QUEUE_MAX_TEAM_SIZE, TEAM_WEIGHTS, \
+    CAPABILITY_SNAPSHOT_PATH, CAPABILITY_SNAPSHOT_INTERVAL
 
 
 logger = logging.getLogger(__name__)
 
+LOCK_DURATION = registry.histogram(
+    'device_lab_lock_operation_duration_seconds', 'Time taken to lock, extend or release capabilities',
+    labelnames=('operation',),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+LOCK_CONFLICTS = registry.counter(
+    'device_lab_lock_conflicts_total', 'Locks rejected because appium node or device is locked already',
+    labelnames=('resource',))
+CAPABILITIES = registry.gauge(
+    'device_lab_capabilities', 'Capabilities reported by hubs, by whether they are free or held',
+    labelnames=('state',))
+WAITERS = registry.gauge('device_lab_lock_waiters', 'Requests waiting for a capability to be freed')
+WAIT_DURATION = registry.histogram(
+    'device_lab_lock_wait_duration_seconds', 'Time requests waited in queue for a capability, by outcome',
+    labelnames=('priority', 'outcome'),
+    buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600))
+EVENT_SUBSCRIBERS = registry.gauge('device_lab_event_subscribers', 'Clients subscribed to capability events')
+
 
 class LockConflictException(BaseServiceException):
-    def __init__(self, err_msg):
-        super().__init__(self.CONFLICT_CODE, err_msg)
+    def __init__(self, err_msg, contended=None, reserved=False):
+        # contended: k: appium_url or udid, v: the contended key, so that caller could retry another candidate
+        # reserved: the capability is free but wanted by queued waiters, it should be waited for in queue
+        super().__init__(self.CONFLICT_CODE, err_msg, data={'contended': contended or {}, 'reserved': reserved})
 
 
 class LockNotFoundException(BaseServiceException):
@@ -32,176 +72,1061 @@ class LockNotFoundException(BaseServiceException):
         super().__init__(self.NOT_FOUND_CODE, err_msg)
 
 
+class WaitTimeoutException(BaseServiceException):
+    def __init__(self, err_msg):
+        super().__init__(self.TIMEOUT_CODE, err_msg)
+
+
+class WaitQueueFullException(BaseServiceException):
+    def __init__(self, err_msg, queued):
+        super().__init__(self.TOO_MANY_REQUESTS_CODE, err_msg, data={'queued': queued})
+
+
 class SeleniumGridService(object):
-    def __init__(self, selenium_grid_client=None, appium_client=None, secret=new_random_string(20)):
+    def __init__(self, selenium_grid_client=None, appium_client=None, secret=new_random_string(20),
+                 hub_failure_grace_period=HUB_FAILURE_GRACE_PERIOD, appium_lock=None, udid_lock=None,
+                 token_cache_size=65536, hub_registry=None, placement_policy=None, waiter_queue=None,
+                 cluster=None):
         self._selenium_grid_client = selenium_grid_client or SeleniumGridClient()
         self._appium_client = appium_client or AppiumClient()
         # SimpleLockManager works in non-distributed, single thread context
         # for multi thread context, thread lock is needed
-        # for distributed context (multi process), redis is a good choice since its commands are run with exclusive way
-        self._appium_lock = SimpleLockManager()  # key: netloc
-        self._udid_lock = SimpleLockManager()  # key: udid
+        # for distributed context (multi process), use a shared backend such as RedisLockManager
+        self._appium_lock = appium_lock or SimpleLockManager()  # type: BaseLockManager  # key: netloc
+        self._udid_lock = udid_lock or SimpleLockManager()  # type: BaseLockManager  # key: udid
+        self._signed_serializer = URLSafeSerializer(secret)
+        # signing and verifying tokens are costly, capability tokens are signed once when capabilities are ingested,
+        # and tokens are verified once until they are evicted
+        self._capability_tokens = LRUCache(token_cache_size)  # k: (appium_url, udid), v: capability token
+        self._verified_tokens = LRUCache(token_cache_size)  # k: (salt, token), v: loaded value
+        self._capability_store = CapabilityStore()
+        self._capability_store.add_listener(self._on_capabilities_changed)
+        self._placement_policy = placement_policy or HubOrderPolicy()  # type: BasePlacementPolicy
+        # query results are valid until capabilities or lock state change, which moves the generation
+        self._query_cache = GenerationCache()
+        # encoded capabilities are valid until capabilities change
+        self._snapshot_cache = GenerationCache(max_size=8)
+        self._hub_failure_grace_period = hub_failure_grace_period
+        self._hub_last_success = {}  # k: hub_url, v: time of last successful fetch
+        self._hub_polls = {}  # k: hub_url, v: PollState
+        self._hub_registry = hub_registry or default_hub_registry  # type: HubRegistry
+        self._hub_fetch_pool = FetchPool(HUB_FETCH_CONCURRENCY)
+        self._appium_polls = {}  # k: appium_url, v: (PollState, CircuitBreaker)
+        self._appium_in_flight = set()  # appium_url being polled
+        self._appium_lock.add_listener(self._on_appium_lock_event)
+        self._udid_lock.add_listener(self._on_udid_lock_event)
+        self._jobs = {}  # k: name, v: PeriodicTask
+        self._shared_snapshot = None  # type: SharedCapabilitySnapshot
+        self._shared_snapshot_dirty = False
+        # payload: (query, lock timeout, future, timeout handle)
+        self._waiters = waiter_queue or WaiterQueue()  # type: WaiterQueue
+        self._waiter_loop = None  # IOLoop on which waiters are served
+        self._freed_entries = []  # entries freed since last dispatch, None if every waiter should be checked
+        self._dispatch_scheduled = False
+        self._capability_events = EventBroadcaster()
+        # hubs are sharded between nodes of the cluster, this node polls and locks its shard only
+        self._cluster = cluster  # type: ClusterMembership
+        self._polling = False  # whether this process polls hubs, or loads what the leader publishes
+        self._shared_snapshot_loaded = False
+        self._snapshot_file = None  # type: CapabilitySnapshotFile
+        self._snapshot_file_dirty = False
+        self._snapshot_saved_at = None  # time the capabilities restored on start were saved at
+        self._stale_hubs = set()  # hubs whose capabilities are restored on start and not polled yet
+
+    def set_secret(self, secret):
+        """
+        replace the signing key of tokens, tokens signed before are no longer valid
+        """
         self._signed_serializer = URLSafeSerializer(secret)
-        self._capabilities = []  # TODO: create a manager to handle capabilities
+        self._capability_tokens.clear()  # signed again on use
+        self._verified_tokens.clear()
+        self._query_cache.bump()
+
+    def set_lock_managers(self, appium_lock, udid_lock):
+        """
+        replace lock managers, it should be called on startup before any capability is locked
+        """
+        self._appium_lock = appium_lock  # type: BaseLockManager
+        self._udid_lock = udid_lock  # type: BaseLockManager
+        self._appium_lock.add_listener(self._on_appium_lock_event)
+        self._udid_lock.add_listener(self._on_udid_lock_event)
+        self._query_cache.bump()
 
     def get_all_hubs_url(self):
-        session = Session()
-        try:
-            hubs = session.query(SeleniumGridHub.url).all()
-        finally:
-            session.close()
-        return list(hub.url for hub in hubs)
+        return self._hub_registry.get_all_urls()
+
+    def get_owned_hubs_url(self):
+        """
+        :return: hubs of the shard of this node, all of them if it is not clustered
+        """
+        return list(hub_url for hub_url in self.get_all_hubs_url() if self._owns_hub(hub_url))
+
+    def _owns_hub(self, hub_url):
+        # a hub is sharded by its base url, which is the hub_url of its capabilities
+        return self._cluster is None or self._cluster.is_local(self._get_base_url(hub_url))
 
-    def get_all_capabilities(self):
-        return self._capabilities
+    def get_all_capabilities(self, encode=None):
+        """
+        :param encode: function to encode the capabilities, if given, the encoded result is returned
+                       and cached until capabilities change
+        """
+        if encode is None:
+            return self._capability_store.get_all()
+        return self._snapshot_cache.get_or_compute(encode, lambda: encode(self._capability_store.get_all()))
 
     def get_available_capabilities(self, platform_name, device_names=None,
-                                   platform_versions=None, min_platform_version=None, max_platform_version=None):
-        query = Observable.from_(self._capabilities) \
-            .filter(lambda c: not self._appium_lock.is_lock(c['appium_url'])) \
-            .filter(lambda c: not self._udid_lock.is_lock(c['capabilities']['UDID'])) \
-            .filter(lambda c: platform_name is None or c['capabilities']['platformName'] == platform_name) \
-            .filter(lambda c: not device_names or is_string_in_partially(c['capabilities']['deviceName'], device_names)) \
-            .filter(lambda c: not platform_versions or c['capabilities']['version'] in platform_versions) \
-            .filter(lambda c: min_platform_version is None or c['capabilities']['version'] >= min_platform_version) \
-            .filter(lambda c: max_platform_version is None or c['capabilities']['version'] <= max_platform_version)
-        candidates = list(query.to_blocking())
+                                   platform_versions=None, min_platform_version=None, max_platform_version=None,
+                                   encode=None):
+        """
+        :param encode: function to encode the capabilities, if given, the encoded result is returned
+                       and cached along with the result
+        """
+        if not self._is_lock_state_local():
+            # locks may be changed by other processes, so neither free index nor cached result could be trusted
+            result = self._get_available_capabilities(
+                platform_name, device_names, platform_versions, min_platform_version, max_platform_version)
+            return result if encode is None else encode(result)
+        # locks past deadline should be free right away instead of waiting for the background sweep,
+        # releasing them costs O(expired) and moves the generation if there is any
+        self.release_expired_locks()
+        # results are ranked by the placement policy, they are cached within its generation too
+        key = (self._normalize_query(platform_name, device_names, platform_versions,
+                                     min_platform_version, max_platform_version),
+               self._placement_policy.get_generation())
+        result = self._query_cache.get_or_compute(key, lambda: self._get_available_capabilities(
+            platform_name, device_names, platform_versions, min_platform_version, max_platform_version))
+        if encode is None:
+            return result
+        return self._query_cache.get_or_compute((encode, key), lambda: encode(result))
+
+    def _filter_unlocked(self, entries):
+        # check lock state in batch, one call per lock manager instead of one per capability
+        appium_urls = list(set(e.appium_url for e in entries))
+        udids = list(set(e.udid for e in entries))
+        locked_appium_urls = set(k for k, locked in zip(appium_urls, self._appium_lock.is_lock_many(appium_urls))
+                                 if locked)
+        locked_udids = set(k for k, locked in zip(udids, self._udid_lock.is_lock_many(udids)) if locked)
+        return list(e for e in entries if e.appium_url not in locked_appium_urls and e.udid not in locked_udids)
+
+    def _is_lock_state_local(self):
+        return self._appium_lock.local and self._udid_lock.local
+
+    def get_query_cache_stats(self):
+        return self._query_cache.get_stats()
+
+    def _get_available_capabilities(self, platform_name, device_names,
+                                    platform_versions, min_platform_version, max_platform_version):
+        local = self._is_lock_state_local()
+        candidates = self._capability_store.query(
+            platform_name=platform_name,
+            device_names=device_names,
+            platform_versions=platform_versions,
+            min_platform_version=min_platform_version,
+            max_platform_version=max_platform_version,
+            free_only=local,
+        )
+        if not local:
+            candidates = self._filter_unlocked(candidates)
+        candidates = self._placement_policy.rank(candidates)
         result, selected_udid, selected_appium = [], set(), set()
-        for cap in candidates:
-            appium_url = cap['appium_url']
-            udid = cap['capabilities']['UDID']
+        for entry in candidates:
+            appium_url = entry.appium_url
+            udid = entry.udid
             if appium_url in selected_appium or udid in selected_udid:
                 continue
             selected_udid.add(udid)
             selected_appium.add(appium_url)
-            cap_token = self._signed_serializer.dumps((appium_url, udid), salt='capability')
-            result.append({**cap, "capability_token": cap_token})
+            cap_token = self._get_capability_token(appium_url, udid)
+            result.append({**entry.cap, "capability_token": cap_token})
         return result
 
-    def update_capabilities_from_remote(self):
-        Observable.from_(self.get_all_hubs_url()) \
-            .distinct() \
-            .flat_map(self._fetch_hub_detail_and_unpack_to_caps) \
-            .to_list() \
-            .subscribe_on(_scheduler) \
-            .subscribe(self.set_capabilities)
-
-    def refresh_capabilities_from_remote(self, period):
-        expired = period + 2  # expired should be a bit longer than polling period
-
-        def refresh_capability_lock(appium_url__cap):
-            appium_url, cap = appium_url__cap
-            self._appium_lock.acquire(appium_url, expired=expired, refresh=True)
-            logger.info('refresh appium node: %s', appium_url)
-            udid = cap['capabilities'].get('UDID')
-            if udid is not None:
-                logger.info('refresh udid: %s', udid)
-                self._udid_lock.acquire(udid, expired=expired, refresh=True)
-
-        Observable.from_(self._capabilities) \
-            .map(lambda cap: cap['appium_url']) \
-            .distinct() \
-            .flat_map(self._fetch_appium_sessions) \
-            .subscribe_on(_scheduler) \
-            .subscribe(refresh_capability_lock)
+    def get_placement_stats(self):
+        return {'policy': self._placement_policy.name, **self._placement_policy.get_stats()}
+
+    def get_capability_snapshot(self):
+        """
+        :return: all capabilities in hub order, each with a `free` flag
+        """
+        # locks past deadline are freed first, as queries do
+        self.release_expired_locks()
+        entries = self._capability_store.query(free_only=False)
+        if self._is_lock_state_local():
+            return list({**e.cap, 'free': self._capability_store.is_free(e.key)} for e in entries)
+        # locks taken by other processes are not seen by the free index
+        unlocked = set(e.key for e in self._filter_unlocked(entries))
+        return list({**e.cap, 'free': e.key in unlocked} for e in entries)
+
+    def subscribe_capability_events(self, max_size=1000):
+        """
+        subscribe to changes of capabilities (added, removed, changed) and lock state (locked, released, expired)
+
+        get the snapshot right after subscribing, events are published on the same IOLoop so nothing is missed
+        :param max_size: max number of events buffered for the subscriber
+        :return: Subscriber of ServerSentEvent
+        """
+        return self._capability_events.subscribe(max_size)
+
+    def unsubscribe_capability_events(self, subscriber):
+        self._capability_events.unsubscribe(subscriber)
+
+    def add_capabilities_listener(self, listener):
+        """
+        listener will be called with a CapabilityChangeSet whenever capabilities of a hub are changed
+        """
+        self._capability_store.add_listener(listener)
+
+    def merge_hub_capabilities(self, hub_url, caps):
+        """
+        :param caps: latest capabilities of the hub, None if the hub fails to respond
+        :return: CapabilityChangeSet
+        """
+        now = self._get_current_time()
+        if caps is not None:
+            self._hub_last_success[hub_url] = now
+            self._stale_hubs.discard(hub_url)
+            change_set = self._capability_store.apply_hub(hub_url, caps)
+            if change_set.added or change_set.removed or change_set.changed:
+                logger.info('capabilities of hub %s changed, added: %s, removed: %s, changed: %s', hub_url,
+                            len(change_set.added), len(change_set.removed), len(change_set.changed))
+            return change_set
+        last_success = self._hub_last_success.get(hub_url)
+        if last_success is not None and now - last_success <= self._hub_failure_grace_period:
+            logger.warning('keep last known capabilities of hub: %s', hub_url)
+            return None
+        self._hub_last_success.pop(hub_url, None)
+        self._stale_hubs.discard(hub_url)
+        return self._capability_store.remove_hub(hub_url)
+
+    async def refresh_capabilities_from_remote(self, period):
+        """
+        poll sessions of appium nodes which are due, so that devices used outside are locked
+
+        nodes with sessions are polled every period and go first, idle ones back off gradually,
+        unreachable ones back off exponentially and are skipped while their circuit is open,
+        and at most APPIUM_POLL_CONCURRENCY nodes are polled at the same time
+
+        :return: number of nodes due, polled, busy (with sessions) and failed in this cycle
+        """
+        now = time.time()
+        appium_urls = set(cap['appium_url'] for cap in self._capability_store.get_all())
+        for appium_url in set(self._appium_polls) - appium_urls:
+            del self._appium_polls[appium_url]
+        due = []
+        for appium_url in appium_urls:
+            poll = self._appium_polls.get(appium_url)
+            if poll is None:
+                state = PollState(initial_interval=period, min_interval=period,
+                                  max_interval=APPIUM_POLL_MAX_INTERVAL, max_backoff=APPIUM_POLL_MAX_INTERVAL)
+                state.next_poll_at = now + state.get_first_delay()
+                poll = self._appium_polls[appium_url] = (state, CircuitBreaker(
+                    APPIUM_CIRCUIT_THRESHOLD, APPIUM_CIRCUIT_RESET_TIMEOUT))
+            state, breaker = poll
+            if appium_url not in self._appium_in_flight and state.next_poll_at <= now and breaker.allow(now):
+                due.append(appium_url)
+        # nodes which had sessions at last poll go first, then the longest overdue
+        due.sort(key=lambda url: (not self._appium_polls[url][0].changed, self._appium_polls[url][0].next_poll_at))
+        polled = due[:max(0, APPIUM_POLL_CONCURRENCY - len(self._appium_in_flight))]
+        results = await asyncio.gather(*(self._poll_appium_sessions(appium_url, period) for appium_url in polled))
+        return {
+            'due': len(due),
+            'polled': len(polled),
+            'busy': sum(1 for sessions in results if sessions),
+            'failed': sum(1 for sessions in results if sessions is None),
+        }
+
+    def get_appium_poll_stats(self):
+        """
+        :return: k: appium_url, v: polling state and circuit state of the node
+        """
+        return dict((appium_url, {**state.to_dict(), 'circuit': breaker.state})
+                    for appium_url, (state, breaker) in self._appium_polls.items())
+
+    async def _poll_appium_sessions(self, appium_url, period):
+        """
+        :return: sessions of the node, None if it fails to respond
+        """
+        state, breaker = self._appium_polls[appium_url]
+        self._appium_in_flight.add(appium_url)
+        started = time.time()
+        try:
+            sessions = await self._fetch_appium_sessions(appium_url, timeout=APPIUM_POLL_TIMEOUT)
+        finally:
+            self._appium_in_flight.discard(appium_url)
+        now = time.time()
+        self._placement_policy.on_appium_polled(appium_url, sessions is not None)
+        if sessions is None:
+            state.on_failure(now, now - started)
+            breaker.on_failure(now)
+        else:
+            breaker.on_success()
+            if sessions:
+                state.reset_interval()
+            state.on_success(now, now - started, changed=bool(sessions))
+        delay = state.get_next_delay()
+        state.next_poll_at = now + delay
+        # locks are held until the next poll, with one more period for the fetch window
+        for session in sessions or ():
+            self._refresh_capability_lock(appium_url, session, delay + period)
+        return sessions
+
+    def _refresh_capability_lock(self, appium_url, session, expired):
+        self._appium_lock.acquire(appium_url, expired=expired, refresh=True)
+        logger.info('refresh appium node: %s', appium_url)
+        udid = session.get('capabilities', {}).get('UDID')
+        if udid is not None:
+            logger.info('refresh udid: %s', udid)
+            self._udid_lock.acquire(udid, expired=expired, refresh=True)
 
     def lock_capability(self, cap_token, timeout):
         try:
-            appium_netloc, udid = self._signed_serializer.loads(cap_token, salt='capability')
+            appium_netloc, udid = self._load_token(cap_token, 'capability')[:2]
         except BadSignature:
             msg = "capability does not exists: {}".format(cap_token)
             logger.info(msg)
             raise LockNotFoundException(msg)
-        else:
-            return self._lock_capability(appium_netloc, udid, timeout)
+        if self._is_reserved(appium_netloc, udid):
+            msg = "capability is reserved for queued requests: {}, {}".format(appium_netloc, udid)
+            logger.info(msg)
+            raise LockConflictException(msg, reserved=True)
+        return self._lock_capability(appium_netloc, udid, timeout)
 
     def _lock_capability(self, appium_url, udid, timeout):
+        lock_id = self._new_lock_id()
         try:
-            self._appium_lock.acquire(appium_url, expired=timeout)
-            self._udid_lock.acquire(udid, expired=timeout)
-        except RuntimeError as e:
-            msg = "lock conflict: {}, {}, {}".format(appium_url, udid, str(e))
+            with LOCK_DURATION.labels('lock').time():
+                acquire_all([(self._appium_lock, appium_url), (self._udid_lock, udid)], expired=timeout,
+                            owners=[lock_id, lock_id])
+        except LockConflictError as e:
+            msg = "lock conflict: {}, {}".format(appium_url, udid)
             logger.info(msg)
-            raise LockConflictException(msg)
-        expired_at = self._get_current_time() + timeout
-        return self._signed_serializer.dumps((appium_url, udid, expired_at), salt='lock')
+            contended = {}
+            for manager, key in e.keys:
+                contended['appium_url' if manager is self._appium_lock else 'udid'] = key
+            for resource in contended:
+                LOCK_CONFLICTS.labels(resource).inc()
+            raise LockConflictException(msg, contended=contended)
+        return self._dump_lock_token(appium_url, udid, lock_id)
 
     def release_capability(self, lock_token):
+        """
+        :raise LockNotFoundException: if the lock is expired, or the capability is locked by others since then
+        """
+        appium_netloc, udid, lock_id = self._load_lock_token(lock_token)
+        self._verified_tokens.pop(('lock', lock_token))
+        with LOCK_DURATION.labels('release').time():
+            released = [self._appium_lock.release(appium_netloc, lock_id), self._udid_lock.release(udid, lock_id)]
+        if not any(released):
+            msg = "lock does not exists: {}".format(lock_token)
+            logger.info(msg)
+            raise LockNotFoundException(msg)
+
+    def extend_capability(self, lock_token, timeout):
+        """
+        keep the capability locked for `timeout` seconds from now, so that a client could hold short locks
+        by heartbeat instead of a long one which outlives the client if it crashes
+        :raise LockNotFoundException: if the lock is expired, released or locked by others since then
+        """
+        appium_netloc, udid, lock_id = self._load_lock_token(lock_token)
+        with LOCK_DURATION.labels('extend').time():
+            extended = self._appium_lock.extend(appium_netloc, lock_id, timeout) and \
+                self._udid_lock.extend(udid, lock_id, timeout)
+        if not extended:
+            # either half of the lock is lost, do not keep the other one
+            self._appium_lock.release(appium_netloc, lock_id)
+            self._udid_lock.release(udid, lock_id)
+            msg = "lock does not exists: {}".format(lock_token)
+            logger.info(msg)
+            raise LockNotFoundException(msg)
+        return {'token': lock_token, 'expired_at': self._get_current_time() + timeout}
+
+    def _load_lock_token(self, lock_token):
+        """
+        :return: (appium_url, udid, lock id)
+        :raise LockNotFoundException: if the token is invalid, or issued before locks had ids
+        """
         try:
-            appium_netloc, udid, expired_at = self._signed_serializer.loads(lock_token, salt='lock')
-            if expired_at < self._get_current_time():
-                raise BadSignature("Expired token")
+            appium_netloc, udid, lock_id = self._load_token(lock_token, 'lock')[:3]
+            if not isinstance(lock_id, str):
+                # it was the time the lock expires at, and the lock could not be told from one locked by others,
+                # so that the holder could not release or extend it any more, it is left to expire
+                raise BadSignature("Token without lock id")
         except BadSignature as e:
             msg = "lock token does not exists: {}, detail: {}".format(lock_token, str(e))
             logger.info(msg)
             raise LockNotFoundException(msg)
+        return appium_netloc, udid, lock_id
+
+    def _get_capability_token(self, appium_url, udid):
+        key = (appium_url, udid)
+        cap_token = self._capability_tokens.get(key)
+        if cap_token is None:
+            # evicted, or the capability is not ingested through the store
+            value = [appium_url, udid] + self._get_shard(appium_url, udid)
+            cap_token = self._signed_serializer.dumps(value, salt='capability')
+            self._capability_tokens.put(key, cap_token)
+            self._verified_tokens.put(('capability', cap_token), value)
+        return cap_token
+
+    def _dump_lock_token(self, appium_url, udid, lock_id):
+        value = [appium_url, udid, lock_id] + self._get_shard(appium_url, udid)
+        lock_token = self._signed_serializer.dumps(value, salt='lock')
+        self._verified_tokens.put(('lock', lock_token), value)
+        return lock_token
+
+    def _get_shard(self, appium_url, udid):
+        """
+        :return: [hub_url] reporting the capability if clustered, so that tokens tell the node owning them,
+                 empty otherwise
+        """
+        if self._cluster is None:
+            return []
+        for entry in self._capability_store.get_by_appium_url(appium_url):
+            if entry.udid == udid:
+                return [entry.hub_url]
+        return []
+
+    def get_token_owner(self, token, salt):
+        """
+        :param salt: 'capability' or 'lock'
+        :return: url of the cluster node owning the capability of the token, None if it is owned by this node,
+                 or it could not be told (e.g. not clustered, or the token is invalid, which is reported locally)
+        """
+        if self._cluster is None:
+            return None
+        try:
+            value = self._load_token(token, salt)
+        except BadSignature:
+            return None
+        shard_index = 2 if salt == 'capability' else 3
+        if len(value) <= shard_index:
+            return None
+        return self._cluster.get_remote_owner(value[shard_index])
+
+    @staticmethod
+    def _new_lock_id():
+        return uuid.uuid4().hex
+
+    def _load_token(self, token, salt):
+        """
+        :raise BadSignature:
+        """
+        key = (salt, token)
+        value = self._verified_tokens.get(key)
+        if value is None:
+            value = self._signed_serializer.loads(token, salt=salt)
+            self._verified_tokens.put(key, value)
+        return value
+
+    def lock_capabilities(self, timeout, cap_tokens=None, platform_name=None, device_names=None,
+                          platform_versions=None, min_platform_version=None, max_platform_version=None, count=1):
+        """
+        lock capabilities in batch, either those of `cap_tokens`, or up to `count` available ones matched
+        query conditions, which are on distinct appium nodes and devices as `get_available_capabilities` selects
+
+        contended capabilities, and those reserved for queued waiters, are skipped instead of failing the whole batch,
+        each attempt locks all the rest with one call per lock manager
+
+        :return: {'locks': [{'token': lock token, 'capability': locked capability}],
+                  'failed': capability tokens which are not found, contended or reserved}
+        """
+        failed = []
+        if cap_tokens is not None:
+            candidates, seen_appium_urls, seen_udids = [], set(), set()
+            for cap_token in cap_tokens:
+                try:
+                    appium_url, udid = self._load_token(cap_token, 'capability')[:2]
+                except BadSignature:
+                    logger.info("capability does not exists: %s", cap_token)
+                    failed.append(cap_token)
+                    continue
+                if appium_url in seen_appium_urls or udid in seen_udids:
+                    failed.append(cap_token)  # the same appium node or device is requested twice
+                    continue
+                seen_appium_urls.add(appium_url)
+                seen_udids.add(udid)
+                if self._is_reserved(appium_url, udid):
+                    failed.append(cap_token)
+                    continue
+                candidates.append((appium_url, udid, cap_token))
+            count = len(candidates)
         else:
-            self._appium_lock.release(appium_netloc)
-            self._udid_lock.release(udid)
+            caps = self.get_available_capabilities(
+                platform_name, device_names, platform_versions, min_platform_version, max_platform_version)
+            candidates = list((cap['appium_url'], cap['capabilities'].get('UDID'), cap['capability_token'])
+                              for cap in caps if not self._is_reserved(cap['appium_url'], cap['capabilities'].get('UDID')))
+        locked, contended = self._lock_candidates(candidates, count, timeout)
+        failed.extend(cap_token for _, _, cap_token, _ in contended)
+        locks = list({
+            'token': self._dump_lock_token(appium_url, udid, lock_id),
+            'capability': self._get_capability(appium_url, udid, cap_token),
+        } for appium_url, udid, cap_token, lock_id in locked)
+        return {'locks': locks, 'failed': failed}
+
+    def _lock_candidates(self, candidates, count, timeout):
+        """
+        :param candidates: list of (appium_url, udid, capability token), appium_url and udid should be distinct
+        :return: (locked, contended) candidates, each with the id it is locked by appended
+        """
+        locked, contended = [], []
+        pending = list(candidate + (self._new_lock_id(),) for candidate in candidates)
+        while pending and len(locked) < count:
+            size = count - len(locked)
+            batch, pending = pending[:size], pending[size:]
+            requests, owners = [], []
+            for appium_url, udid, _, lock_id in batch:
+                requests.append((self._appium_lock, appium_url))
+                requests.append((self._udid_lock, udid))
+                owners.extend((lock_id, lock_id))
+            try:
+                acquire_all(requests, expired=timeout, owners=owners)
+            except LockConflictError as e:
+                contended_keys = set(e.keys)
+                retry = []
+                for candidate in batch:
+                    appium_url, udid, _, _ = candidate
+                    if (self._appium_lock, appium_url) in contended_keys or (self._udid_lock, udid) in contended_keys:
+                        contended.append(candidate)
+                    else:
+                        retry.append(candidate)
+                # the uncontended ones of the batch are tried again before the rest
+                pending = retry + pending
+                continue
+            locked.extend(batch)
+        return locked, contended
+
+    def _get_capability(self, appium_url, udid, cap_token):
+        for entry in self._capability_store.get_by_appium_url(appium_url):
+            if entry.udid == udid:
+                return {**entry.cap, 'capability_token': cap_token}
+        return None  # removed from hub
+
+    def release_capabilities(self, lock_tokens):
+        """
+        release capabilities in batch, one call per lock manager
+        :return: lock tokens which are not found, expired or locked by others since then
+        """
+        not_found, loaded_tokens, appium_urls, udids, lock_ids = [], [], [], [], []
+        for lock_token in lock_tokens:
+            try:
+                appium_url, udid, lock_id = self._load_lock_token(lock_token)
+            except LockNotFoundException:
+                not_found.append(lock_token)
+                continue
+            self._verified_tokens.pop(('lock', lock_token))
+            loaded_tokens.append(lock_token)
+            appium_urls.append(appium_url)
+            udids.append(udid)
+            lock_ids.append(lock_id)
+        with LOCK_DURATION.labels('release_batch').time():
+            appium_released = self._appium_lock.release_many(appium_urls, lock_ids)
+            udid_released = self._udid_lock.release_many(udids, lock_ids)
+        not_found.extend(lock_token for lock_token, appium, udid in zip(loaded_tokens, appium_released, udid_released)
+                         if not (appium or udid))
+        return not_found
+
+    def wait_and_lock_capability(self, platform_name, device_names=None, platform_versions=None,
+                                 min_platform_version=None, max_platform_version=None, timeout=60, wait=30,
+                                 priority=DEFAULT_PRIORITY, team=DEFAULT_TEAM):
+        """
+        lock the first available capability matched query conditions, if there is none,
+        wait until a matched one is freed by release, expiry or refresh of capabilities
+
+        waiters are served by priority class, then by weighted fair share of teams, then first come first served,
+        see WaiterQueue, and only those whose query matches a freed capability are woken
+        a free capability matched by a waiter is reserved for the queue, direct locks could not take it
+
+        :param timeout: seconds the capability is locked for
+        :param wait: seconds to wait before giving up with WaitTimeoutException
+        :param priority: priority class, one of utils.waiters.PRIORITIES
+        :param team: client or team the request is from, which the queue is shared fairly between
+        :raise WaitQueueFullException: if the queue or the share of the team is full
+        :return: Future of {'token': lock token, 'capability': locked capability},
+                 cancel it to stop waiting, see `cancel_waiting`
+        """
+        query = (platform_name, device_names, platform_versions, min_platform_version, max_platform_version)
+        filter_key = self._normalize_query(*query)
+        future = Future()
+        # waiters of the same query are served in queue order
+        if not self._waiters.has_waiter(filter_key):
+            locked = self._lock_first_available(query, timeout, skip_reserved=True)
+            if locked is not None:
+                future.set_result(locked)
+                return future
+        self._waiter_loop = IOLoop.current()
+        try:
+            waiter = self._waiters.add(filter_key, platform_name, None, priority, team)
+        except QueueFullError as e:
+            logger.info('reject waiter of %s: %s', team, e)
+            raise WaitQueueFullException(str(e), e.queued)
+
+        def on_timeout():
+            if self._waiters.remove(waiter):
+                self._observe_wait(waiter, 'timeout')
+                future.set_exception(WaitTimeoutException("no capability is available in {} seconds".format(wait)))
+
+        def on_done(f):
+            if f.cancelled():
+                if self._waiters.remove(waiter):
+                    self._observe_wait(waiter, 'cancelled')
+                self._waiter_loop.remove_timeout(waiter.payload[3])
+
+        waiter.payload = (query, timeout, future, self._waiter_loop.call_later(wait, on_timeout))
+        future.add_done_callback(on_done)
+        return future
+
+    def cancel_waiting(self, future):
+        """
+        stop waiting for a capability, e.g. client is gone, the capability is released if it has been locked
+        """
+        if not future.done():
+            future.cancel()
+        elif not future.cancelled() and future.exception() is None:
+            self.release_capability(future.result()['token'])
+
+    def get_wait_queue_stats(self):
+        return self._waiters.get_stats()
+
+    def _observe_wait(self, waiter, outcome):
+        WAIT_DURATION.labels(waiter.priority, outcome).observe(self._waiters.get_current_time() - waiter.queued_at)
+
+    def _is_reserved(self, appium_url, udid):
+        """
+        whether the capability is matched by a queued waiter, so that it is left to the queue
+        """
+        if not self._waiters:
+            return False
+        for entry in self._capability_store.get_by_appium_url(appium_url):
+            if entry.udid != udid:
+                continue
+            if any(self._match_query(k, entry) for k in self._waiters.get_filter_keys([entry.platform_name])):
+                return True
+        return False
+
+    def _lock_first_available(self, query, timeout, skip_reserved=False):
+        for cap in self.get_available_capabilities(*query):
+            if skip_reserved and self._is_reserved(cap['appium_url'], cap['capabilities'].get('UDID')):
+                continue
+            try:
+                token = self._lock_capability(cap['appium_url'], cap['capabilities'].get('UDID'), timeout)
+            except LockConflictException:
+                continue  # taken by another process since the query
+            return {'token': token, 'capability': cap}
+        return None
+
+    def _notify_freed(self, entries=None):
+        """
+        :param entries: entries become free, None if it is unknown which are freed
+        """
+        if not self._waiters or entries == []:
+            return
+        if entries is None:
+            self._freed_entries = None
+        elif self._freed_entries is not None:
+            self._freed_entries.extend(entries)
+        # NOTE: dispatch later, lock state should not be changed inside callbacks of lock managers
+        if not self._dispatch_scheduled:
+            self._dispatch_scheduled = True
+            self._waiter_loop.add_callback(self._dispatch_waiters)
+
+    def _dispatch_waiters(self):
+        self._dispatch_scheduled = False
+        freed, self._freed_entries = self._freed_entries, []
+        if freed is None:
+            filter_keys = self._waiters.get_filter_keys()
+        else:
+            filter_keys = list(k for k in self._waiters.get_filter_keys(set(e.platform_name for e in freed))
+                               if any(self._match_query(k, e) for e in freed))
+        # serve head waiters across queries in arrival order, a query is skipped once nothing is available for it
+        heap = list((self._waiters.peek(k).order, k) for k in filter_keys)
+        heapq.heapify(heap)
+        while heap:
+            _, filter_key = heapq.heappop(heap)
+            waiter = self._waiters.peek(filter_key)
+            if waiter is None:
+                continue
+            query, timeout, future, timeout_handle = waiter.payload
+            if future.done():
+                # cancelled, but its done callback is not run yet, the next one takes its place by its own order
+                self._waiters.pop(filter_key)
+            else:
+                locked = self._lock_first_available(query, timeout)
+                if locked is None:
+                    continue
+                self._waiters.pop(filter_key)
+                self._waiter_loop.remove_timeout(timeout_handle)
+                self._observe_wait(waiter, 'served')
+                future.set_result(locked)
+            waiter = self._waiters.peek(filter_key)
+            if waiter is not None:
+                heapq.heappush(heap, (waiter.order, filter_key))
 
     def set_capabilities(self, caps):
-        self._capabilities = caps
+        self._capability_store.replace(caps)
+
+    def _on_capabilities_changed(self, change_set):
+        self._query_cache.bump()
+        self._snapshot_cache.bump()
+        self._shared_snapshot_dirty = True
+        self._snapshot_file_dirty = True
+        self._placement_policy.on_capabilities_changed(change_set)
+        self._update_capability_tokens(change_set)
+        self._notify_freed(change_set.added + change_set.changed)
+        if self._capability_events:
+            for type_, entries in (('added', change_set.added), ('removed', change_set.removed),
+                                   ('changed', change_set.changed)):
+                if entries:
+                    self._capability_events.publish(ServerSentEvent(type_, {
+                        'hub_url': change_set.hub_url,
+                        'capabilities': list(e.cap for e in entries),
+                    }))
+
+    def _update_capability_tokens(self, change_set):
+        for entry in change_set.added + change_set.changed:
+            self._get_capability_token(entry.appium_url, entry.udid)
+        for entry in change_set.removed:
+            if any(e.udid == entry.udid for e in self._capability_store.get_by_appium_url(entry.appium_url)):
+                continue  # still reported by another hub
+            cap_token = self._capability_tokens.pop((entry.appium_url, entry.udid))
+            if cap_token is not None:
+                self._verified_tokens.pop(('capability', cap_token))
+
+    def _on_appium_lock_event(self, event):
+        locked = self._is_locked_by_event(event)
+        if locked is not None:
+            self._capability_store.set_appium_url_locked(event.key, locked)
+            self._placement_policy.on_appium_url_locked(event.key, locked)
+            self._query_cache.bump()
+            if not locked:
+                self._notify_freed(self._capability_store.get_by_appium_url(event.key))
+            self._publish_lock_event('appium_url', event)
+
+    def _on_udid_lock_event(self, event):
+        locked = self._is_locked_by_event(event)
+        if locked is not None:
+            self._capability_store.set_udid_locked(event.key, locked)
+            self._placement_policy.on_udid_locked(event.key, self._capability_store.get_by_udid(event.key), locked)
+            self._query_cache.bump()
+            if not locked:
+                self._notify_freed(self._capability_store.get_by_udid(event.key))
+            self._publish_lock_event('udid', event)
+
+    def _publish_lock_event(self, field, event):
+        if not self._capability_events:
+            return
+        type_ = 'locked' if event.type == BaseLockManager.ACQUIRED else event.type
+        self._capability_events.publish(ServerSentEvent(type_, {field: event.key}))
+
+    @staticmethod
+    def _is_locked_by_event(event):
+        if event.type == BaseLockManager.ACQUIRED:
+            return True
+        if event.type in (BaseLockManager.RELEASED, BaseLockManager.EXPIRED):
+            return False
+        return None  # refreshed, lock state is not changed
+
+    def start_background_jobs(self, election=None, snapshot=None):
+        """
+        start background jobs in current process, should be called after IOLoop is ready
+
+        :param election: LeaderElection, if given, only the elected process polls hubs and appium nodes,
+                         the others load capabilities from the snapshot published by the leader
+        :param snapshot: SharedCapabilitySnapshot, required by election
+        """
+        self.release_expired_lock_in_background(1)
+        if election is None:
+            self._start_polling_jobs()
+            return
+        self._shared_snapshot = snapshot
+
+        def sync_with_leader():
+            if election.is_leader:
+                self._publish_shared_snapshot()
+            elif election.try_acquire():
+                logger.info('elected as leader to poll remote, pid: %s', os.getpid())
+                self._start_polling_jobs()
+            else:
+                self._load_shared_snapshot()
+
+        self._start_job('sync_with_leader', sync_with_leader, 1)
+
+    def _start_polling_jobs(self):
+        self._polling = True
+        self.update_capabilities_in_background(10)
+        self.refresh_capabilities_in_background(5)
+        if self._snapshot_file is not None:
+            self._start_job('save_capability_snapshot', self.save_capability_snapshot, CAPABILITY_SNAPSHOT_INTERVAL)
+
+    def _publish_shared_snapshot(self):
+        if not self._shared_snapshot_dirty:
+            return
+        self._shared_snapshot_dirty = False
+        self._shared_snapshot.publish(self._capability_store.get_all_by_hub())
+
+    def _load_shared_snapshot(self):
+        hub_caps = self._shared_snapshot.load_if_changed()
+        if hub_caps is None:
+            return
+        self._shared_snapshot_loaded = True
+        self._stale_hubs.clear()  # the leader is polling them
+        for hub_url in set(self._capability_store.get_hub_urls()) - set(hub_caps):
+            self._capability_store.remove_hub(hub_url)
+        for hub_url, caps in hub_caps.items():
+            self._capability_store.apply_hub(hub_url, caps)
+
+    def _start_job(self, name, func, period, timeout=None):
+        # NOTE: jobs are bound to current IOLoop, start them after it is ready (e.g. after forking worker processes)
+        job = self._jobs[name] = PeriodicTask(name, func, period, timeout)
+        job.start()
+        return job
+
+    def get_background_job_stats(self):
+        """
+        :return: k: job name, v: period, timeout, skipped ticks and outcomes of recent cycles
+        """
+        return dict((name, job.get_stats()) for name, job in self._jobs.items())
 
     def update_capabilities_in_background(self, period=10):
-        Observable.interval(period * 1000, scheduler=_scheduler) \
-            .subscribe_on(_scheduler) \
-            .subscribe(lambda _: self.update_capabilities_from_remote())
+        """
+        refresh hub registry every period, every hub is polled on its own adaptive schedule
+        """
+        # hubs changed through the registry take effect right away
+        self._hub_registry.add_listener(self.sync_hub_polls)
+        if self._cluster is not None:
+            self._cluster.add_listener(self.sync_hub_polls)
+        self.sync_hub_polls()  # hubs loaded before
+        self._start_job('refresh_hubs', self._refresh_hubs, period)
+
+    async def _refresh_hubs(self):
+        changed = await self._hub_registry.refresh()
+        if not changed and self._stale_hubs:
+            self.sync_hub_polls()  # restored hubs which are not in the registry are dropped once it is loaded
+        return changed
+
+    def sync_hub_polls(self):
+        """
+        start polling new hubs of the registry, and stop polling removed ones,
+        or those moved to other nodes of the cluster
+        """
+        hub_urls = set(self.get_owned_hubs_url())
+        for hub_url in set(self._hub_polls) - hub_urls:
+            state = self._hub_polls.pop(hub_url)
+            if state.handle is not None:
+                IOLoop.current().remove_timeout(state.handle)
+        removed = set(self._capability_store.get_hub_urls()) - hub_urls
+        if not self._hub_registry.loaded:
+            removed -= self._stale_hubs  # restored ones are kept until hubs are loaded from the registry
+        for hub_url in removed:
+            logger.info('hub is removed or moved to another node: %s', hub_url)
+            self._hub_last_success.pop(hub_url, None)
+            self._stale_hubs.discard(hub_url)
+            self._capability_store.remove_hub(hub_url)
+        for hub_url in hub_urls - set(self._hub_polls):
+            state = self._hub_polls[hub_url] = PollState(
+                min_interval=HUB_POLL_MIN_INTERVAL,
+                max_interval=HUB_POLL_MAX_INTERVAL,
+                max_backoff=HUB_POLL_MAX_BACKOFF,
+            )
+            self._schedule_hub_poll(hub_url, state, state.get_first_delay())
+
+    def get_hub_poll_stats(self):
+        """
+        :return: k: hub_url, v: polling interval, consecutive failures, time of last success and failure,
+                 latency of last poll and time of next poll
+        """
+        return dict((hub_url, state.to_dict()) for hub_url, state in self._hub_polls.items())
+
+    def _schedule_hub_poll(self, hub_url, state, delay):
+        state.next_poll_at = time.time() + delay
+        state.handle = IOLoop.current().call_later(delay, self._poll_hub, hub_url, state)
+
+    async def _poll_hub(self, hub_url, state):
+        if self._hub_polls.get(hub_url) is not state:
+            return  # removed from registry
+        state.handle = None
+        started = time.time()
+        caps = await self._fetch_hub_capabilities(hub_url, timeout=HUB_POLL_TIMEOUT)
+        now = time.time()
+        if self._hub_polls.get(hub_url) is not state:
+            return  # removed from registry while polling
+        change_set = self.merge_hub_capabilities(hub_url, caps)
+        if caps is None:
+            state.on_failure(now, now - started)
+        else:
+            changed = bool(change_set.added or change_set.removed or change_set.changed)
+            state.on_success(now, now - started, changed)
+        # next poll is scheduled after this one is done, so polls of a hub never overlap
+        self._schedule_hub_poll(hub_url, state, state.get_next_delay())
 
     def refresh_capabilities_in_background(self, period=5):
-        Observable.interval(period * 1000, scheduler=_scheduler) \
-            .subscribe_on(_scheduler) \
-            .subscribe(lambda _: self.refresh_capabilities_from_remote(period))
+        # nodes are checked every second, and polled only when they are due,
+        # a cycle waits for the nodes it polls, which are bounded by APPIUM_POLL_TIMEOUT
+        self._start_job('refresh_capabilities_from_remote', lambda: self.refresh_capabilities_from_remote(period),
+                        1, timeout=APPIUM_POLL_TIMEOUT * 2)
+
+    def release_expired_locks(self):
+        self._appium_lock.release_expired_keys()
+        self._udid_lock.release_expired_keys()
+        if not self._is_lock_state_local():
+            # releases and expiry by other processes are not notified, check waiters on every sweep
+            self._notify_freed()
+
+    def attach_lock_journal(self, journal):
+        """
+        restore locks from the journal and persist their changes to it,
+        only in-process lock managers are journaled, shared-memory tables are kept in the journal directory
+        and redis keeps lock state by itself
+        """
+        for namespace, manager in (('appium', self._appium_lock), ('udid', self._udid_lock)):
+            if isinstance(manager, SimpleLockManager):
+                journal.restore(namespace, manager)
+            else:
+                logger.info('lock state of %s is kept by %s, not journaled', namespace, type(manager).__name__)
+
+    def clear_shared_locks(self):
+        """
+        drop locks left in shared-memory lock tables by the last run,
+        called by the process starting the worker group, before workers are forked
+        """
+        for manager in (self._appium_lock, self._udid_lock):
+            if isinstance(manager, SharedMemoryLockManager):
+                manager.clear()
+
+    def attach_capability_snapshot(self, snapshot_file):
+        """
+        restore capabilities saved by last run, they are served as stale until their hubs are polled,
+        and save capabilities to the file once they change from now on
+        """
+        self._snapshot_file = snapshot_file
+        snapshot = snapshot_file.load()
+        if snapshot is None:
+            return
+        self._snapshot_saved_at, hub_caps = snapshot
+        for hub_url, caps in hub_caps.items():
+            if not self._owns_hub(hub_url):
+                continue
+            self._capability_store.apply_hub(hub_url, caps)
+            self._stale_hubs.add(hub_url)
+            # kept as long as if the hub was polled when saved
+            self._hub_last_success[hub_url] = int(self._snapshot_saved_at)
+        self._snapshot_file_dirty = False
+        logger.info('restore capabilities of %s hubs saved at %s', len(self._stale_hubs), self._snapshot_saved_at)
+
+    async def save_capability_snapshot(self):
+        """
+        :return: True if capabilities are changed and saved
+        """
+        if not self._snapshot_file_dirty:
+            return False
+        self._snapshot_file_dirty = False
+        await self._snapshot_file.save(self._capability_store.get_all_by_hub())
+        return True
+
+    def get_readiness(self):
+        """
+        ready once hubs are loaded from the registry and each hub of this node is polled once,
+        or for a process following the leader, once it loads what the leader publishes
+
+        :return: ready or not, hubs not polled yet, and hubs served with capabilities restored on start
+        """
+        if self._polling:
+            pending = list(hub_url for hub_url, state in self._hub_polls.items()
+                           if state.last_success is None and state.last_failure is None)
+            ready = self._hub_registry.loaded and not pending
+        else:
+            pending = []
+            ready = self._shared_snapshot_loaded
+        return {
+            'ready': ready,
+            'hub_registry_loaded': self._hub_registry.loaded,
+            'pending_hubs': pending,
+            'stale_hubs': sorted(self._stale_hubs),
+            'snapshot_saved_at': self._snapshot_saved_at,
+        }
+
+    def has_stale_capabilities(self):
+        return bool(self._stale_hubs)
+
+    def bind_metrics(self):
+        """
+        gauges are read from this service when metrics are collected
+        """
+        CAPABILITIES.labels('free').set_function(lambda: self._capability_store.count_free())
+        CAPABILITIES.labels('held').set_function(
+            lambda: len(self._capability_store) - self._capability_store.count_free())
+        WAITERS.set_function(lambda: len(self._waiters))
+        EVENT_SUBSCRIBERS.set_function(lambda: len(self._capability_events))
 
     def release_expired_lock_in_background(self, period=1):
-        ob = Observable.interval(period * 1000, scheduler=_scheduler)
-        ob \
-            .subscribe_on(_scheduler) \
-            .subscribe(lambda _: self._appium_lock.release_expired_keys())
-        ob \
-            .subscribe_on(_scheduler) \
-            .subscribe(lambda _: self._udid_lock.release_expired_keys())
-
-    def _fetch_hub_detail_and_unpack_to_caps(self, hub_url) -> Observable:
-        def on_error(e):
+        self._start_job('release_expired_locks', self.release_expired_locks, period)
+
+    async def _fetch_hub_capabilities(self, hub_url, timeout=20):
+        """
+        at most HUB_FETCH_CONCURRENCY hubs are fetched at the same time, the others wait for their turn
+
+        :param timeout: seconds to wait for the hub
+        :return: capabilities of the hub, None if the hub fails to respond
+        """
+        # failure of fetching or parsing hub detail is not taken as a hub without nodes
+        try:
+            res = await self._hub_fetch_pool.run(
+                self._selenium_grid_client.get_devices_by_hub_url_async, hub_url, timeout)
+            nodes = json.loads(res.body)['nodes']
+        except CancelledError:
+            raise
+        except Exception as e:
             logger.error("fail to fetch nodes by url: %s, %s", hub_url, str(e))
-            return Observable.empty()
-
-        @on_exception_return(on_error)
-        def unpack_node(node):
-            appium_netloc = self._get_base_url(node['id'])
-            hub_netloc = self._get_base_url(hub_url)
-            malform_dto = node['protocols']['web_driver']['browsers']['']
-            if 'name' in malform_dto:
-                del malform_dto['name']
-            if 'version' in malform_dto:
-                del malform_dto['version']
-            cap_lists = malform_dto.values()  # list of cap_lists
-            return Observable.from_(cap_lists) \
-                .flat_map(lambda cap_list: Observable.from_(cap_list)) \
-                .map(lambda cap: {**cap, 'appium_url': appium_netloc, 'hub_url': hub_netloc})
-
-        @on_exception_return(on_error)
-        def unpack_hub(hub_detail):
-            return Observable.from_(hub_detail['nodes'])
-
-        future = convert_yielded(self._selenium_grid_client.get_devices_by_hub_url_async(hub_url))
-        return Observable.from_future(future) \
-            .map(lambda res: json.loads(res.body)) \
-            .catch_exception(handler=on_error) \
-            .flat_map(unpack_hub) \
-            .flat_map(unpack_node)
-
-    def _fetch_appium_sessions(self, appium_url) -> Observable:
-        def on_error(e):
+            return None
+        hub_netloc = self._get_base_url(hub_url)
+        caps = []
+        for node in nodes:
+            # a malformed node is skipped, the other nodes of the hub are kept
+            try:
+                caps.extend(self._unpack_node(node, hub_netloc))
+            except Exception as e:
+                logger.error("fail to unpack node of hub: %s, %s", hub_url, str(e))
+        return caps
+
+    def _unpack_node(self, node, hub_netloc):
+        appium_netloc = self._get_base_url(node['id'])
+        malform_dto = node['protocols']['web_driver']['browsers']['']
+        # values other than name and version are lists of capabilities
+        return list({**cap, 'appium_url': appium_netloc, 'hub_url': hub_netloc}
+                    for key, cap_list in malform_dto.items() if key not in ('name', 'version')
+                    for cap in cap_list)
+
+    async def _fetch_appium_sessions(self, appium_url, timeout=20):
+        """
+        :param timeout: seconds to wait for the node
+        :return: sessions of the node, None if the node fails to respond
+        """
+        try:
+            res = await self._appium_client.get_sessions(appium_url, timeout=timeout)
+            return json.loads(res.body)['value']
+        except CancelledError:
+            raise
+        except Exception as e:
             logger.error("fail to fetch appium sessions by url: %s, %s", appium_url, str(e))
-            return Observable.empty()
+            return None
 
-        future = convert_yielded(self._appium_client.get_sessions(appium_url))
-        return Observable.from_future(future) \
-            .map(lambda res: json.loads(res.body)) \
-            .catch_exception(handler=on_error) \
-            .flat_map(lambda data: Observable.from_(data['value'])) \
-            .map(lambda cap: (appium_url, cap))
+    @staticmethod
+    def _normalize_query(platform_name, device_names, platform_versions, min_platform_version, max_platform_version):
+        # queries which are bound to get the same result share the same key
+        return (
+            platform_name,
+            tuple(sorted(set(name.lower() for name in device_names or ()))),
+            tuple(sorted(set(platform_versions or ()))),
+            None if min_platform_version is None else parse_version(min_platform_version),
+            None if max_platform_version is None else parse_version(max_platform_version),
+        )
+
+    @staticmethod
+    def _match_query(query_key, entry):
+        platform_name, device_names, platform_versions, min_parsed, max_parsed = query_key
+        return (platform_name is None or entry.platform_name == platform_name) and \
+            (not device_names or is_string_in_partially(entry.device_name, device_names)) and \
+            (not platform_versions or entry.version in platform_versions) and \
+            (min_parsed is None or entry.parsed_version >= min_parsed) and \
+            (max_parsed is None or entry.parsed_version <= max_parsed)
 
     @staticmethod
     def _get_base_url(url):
@@ -212,10 +1137,44 @@ class SeleniumGridService(object):
         return int(time.time())
 
 
-_scheduler = IOLoopScheduler()
+def new_lock_manager(namespace):
+    if LOCK_BACKEND == 'redis':
+        return RedisLockManager.from_url(REDIS_URL, 'device_lab:{}'.format(namespace))
+    if LOCK_BACKEND == 'shared_memory' or WORKERS != 1:
+        # NOTE: lock table should be created before forking, so that it is mapped into every worker
+        # a table in the journal directory is kept across restarts, like the journal of in-process locks
+        directory = LOCK_JOURNAL_DIR or SHARED_MEMORY_DIR
+        os.makedirs(directory, exist_ok=True)
+        return SharedMemoryLockManager(os.path.join(directory, '{}.lock'.format(namespace)), SHARED_LOCK_SLOTS)
+    return SimpleLockManager()
+
+
+def open_lock_managers(service):
+    """
+    open the lock backend configured for the service, called on startup before forking instead of on import,
+    so that importing the service never touches shared lock tables of a running one
+    """
+    service.set_lock_managers(new_lock_manager('appium'), new_lock_manager('udid'))
+
+
+def restore_service_state(service):
+    """
+    load signing key, locks and capabilities kept on disk by last run into the service,
+    called on startup instead of on import, so that tests and tools could import the service without touching files
+    """
+    if LOCK_JOURNAL_DIR:
+        if not LOCK_SECRET:
+            service.set_secret(load_or_create_secret(os.path.join(LOCK_JOURNAL_DIR, 'secret')))
+        service.attach_lock_journal(LockJournal(
+            LOCK_JOURNAL_DIR, LOCK_JOURNAL_FLUSH_INTERVAL, LOCK_JOURNAL_COMPACT_THRESHOLD))
+    if CAPABILITY_SNAPSHOT_PATH:
+        service.attach_capability_snapshot(CapabilitySnapshotFile(CAPABILITY_SNAPSHOT_PATH))
+
 
-selenium_grid_service = SeleniumGridService(secret=LOCK_SECRET)
-# start background job
-selenium_grid_service.update_capabilities_in_background(10)
-selenium_grid_service.release_expired_lock_in_background(1)
-selenium_grid_service.refresh_capabilities_in_background(5)
+selenium_grid_service = SeleniumGridService(
+    secret=LOCK_SECRET or new_random_string(20),
+    placement_policy=new_placement_policy(PLACEMENT_POLICY),
+    waiter_queue=WaiterQueue(TEAM_WEIGHTS, max_size=WAIT_QUEUE_MAX_SIZE, max_team_size=WAIT_QUEUE_MAX_TEAM_SIZE),
+    cluster=cluster_membership,
+)
+selenium_grid_service.bind_metrics()
@@ -0,0 +1,216 @@
+"""
+a minimal redis server speaking RESP, for testing redis backed components without a real redis
+
+only commands used by this project are supported, lua scripts could not be evaluated,
+instead each script is registered with an equivalent python function
+"""
+import hashlib
+import socketserver
+import threading
+import time
+
+from utils.managers import RedisLockManager
+
+
+class FakeRedisServer(object):
+    def __init__(self, host='127.0.0.1', port=0):
+        self._data = {}  # k: key, v: (value, expired_at in seconds or None)
+        self._scripts = {}  # k: sha1 of script, v: python function(server, keys, args)
+        self._mutex = threading.RLock()
+        self.commands = []  # name of received commands, for assertion of round-trips
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        command = server._read_command(self.rfile)
+                    except EOFError:
+                        return
+                    self.wfile.write(server._execute(command))
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'redis://{}:{}/0'.format(host, port)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def register_script(self, script, func):
+        self._scripts[hashlib.sha1(script.encode()).hexdigest()] = func
+
+    # data operations, could be used by registered scripts
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expired_at = item
+        if expired_at is not None and expired_at <= time.time():
+            del self._data[key]
+            return None
+        return value
+
+    def set(self, key, value, px=None):
+        self._data[key] = (value, None if px is None else time.time() + px / 1000)
+
+    def pttl(self, key):
+        if self.get(key) is None:
+            return -2
+        expired_at = self._data[key][1]
+        return -1 if expired_at is None else int((expired_at - time.time()) * 1000)
+
+    def pexpire(self, key, px):
+        if self.get(key) is None:
+            return 0
+        self._data[key] = (self._data[key][0], time.time() + px / 1000)
+        return 1
+
+    def delete(self, key):
+        return 1 if self.get(key) is not None and self._data.pop(key) else 0
+
+    @staticmethod
+    def _read_command(rfile):
+        line = rfile.readline()
+        if not line:
+            raise EOFError()
+        assert line.startswith(b'*'), line
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(rfile.readline()[1:])
+            args.append(rfile.read(size + 2)[:-2].decode())
+        return args
+
+    def _execute(self, command):
+        name, args = command[0].upper(), command[1:]
+        self.commands.append(name)
+        with self._mutex:
+            try:
+                return self._encode(getattr(self, '_cmd_' + name.lower())(*args))
+            except AttributeError:
+                return b'-ERR unknown command ' + name.encode() + b'\r\n'
+            except ScriptNotFound:
+                return b'-NOSCRIPT No matching script. Please use EVAL.\r\n'
+
+    def _encode(self, value):
+        if value is True:
+            return b'+OK\r\n'
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, int):
+            return ':{}\r\n'.format(value).encode()
+        if isinstance(value, list):
+            return '*{}\r\n'.format(len(value)).encode() + b''.join(self._encode(v) for v in value)
+        value = str(value).encode()
+        return '${}\r\n'.format(len(value)).encode() + value + b'\r\n'
+
+    def _cmd_ping(self):
+        return True
+
+    def _cmd_select(self, db):
+        return True
+
+    def _cmd_get(self, key):
+        return self.get(key)
+
+    def _cmd_set(self, key, value, *options):
+        options = [o.upper() for o in options]
+        px = None
+        if 'PX' in options:
+            px = int(options[options.index('PX') + 1])
+        if 'NX' in options and self.get(key) is not None:
+            return None
+        self.set(key, value, px)
+        return True
+
+    def _cmd_exists(self, *keys):
+        return sum(1 for key in keys if self.get(key) is not None)
+
+    def _cmd_del(self, *keys):
+        return sum(self.delete(key) for key in keys)
+
+    def _cmd_pttl(self, key):
+        return self.pttl(key)
+
+    def _cmd_pexpire(self, key, px):
+        return self.pexpire(key, int(px))
+
+    def _cmd_script(self, sub_command, *args):
+        if sub_command.upper() == 'LOAD':
+            sha = hashlib.sha1(args[0].encode()).hexdigest()
+            if sha not in self._scripts:
+                raise AttributeError()
+            return sha
+        if sub_command.upper() == 'EXISTS':
+            return list(1 if sha in self._scripts else 0 for sha in args)
+        raise AttributeError()
+
+    def _cmd_evalsha(self, sha, num_keys, *keys_and_args):
+        func = self._scripts.get(sha)
+        if func is None:
+            raise ScriptNotFound()
+        num_keys = int(num_keys)
+        return func(self, list(keys_and_args[:num_keys]), list(keys_and_args[num_keys:]))
+
+    def _cmd_eval(self, script, num_keys, *keys_and_args):
+        return self._cmd_evalsha(hashlib.sha1(script.encode()).hexdigest(), num_keys, *keys_and_args)
+
+
+class ScriptNotFound(Exception):
+    pass
+
+
+def refresh_script(server, keys, args):
+    # python equivalent of RedisLockManager.REFRESH_SCRIPT
+    key, px = keys[0], int(args[0])
+    ttl = server.pttl(key)
+    if ttl < 0:
+        server.set(key, '1', px)
+        return 0
+    if ttl < px:
+        server.pexpire(key, px)
+    return 1
+
+
+def acquire_many_script(server, keys, args):
+    # python equivalent of RedisLockManager.ACQUIRE_MANY_SCRIPT
+    contended = list(i + 1 for i, key in enumerate(keys) if server.get(key) is not None)
+    if not contended:
+        for key, value in zip(keys, args[1:]):
+            server.set(key, value, int(args[0]))
+    return contended
+
+
+def release_owned_script(server, keys, args):
+    # python equivalent of RedisLockManager.RELEASE_OWNED_SCRIPT
+    if server.get(keys[0]) == args[0]:
+        return server.delete(keys[0])
+    return 0
+
+
+def extend_script(server, keys, args):
+    # python equivalent of RedisLockManager.EXTEND_SCRIPT
+    if server.get(keys[0]) == args[0]:
+        return server.pexpire(keys[0], int(args[1]))
+    return 0
+
+
+def new_lock_server():
+    """
+    start a fake redis server which supports scripts of RedisLockManager
+    """
+    server = FakeRedisServer().start()
+    server.register_script(RedisLockManager.REFRESH_SCRIPT, refresh_script)
+    server.register_script(RedisLockManager.ACQUIRE_MANY_SCRIPT, acquire_many_script)
+    server.register_script(RedisLockManager.RELEASE_OWNED_SCRIPT, release_owned_script)
+    server.register_script(RedisLockManager.EXTEND_SCRIPT, extend_script)
+    return server
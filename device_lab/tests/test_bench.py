@@ -0,0 +1,57 @@
+import json
+
+import tornado.testing
+
+from bench.fake_grid import FakeFleet, get_address
+from bench.run import get_percentile, parse_metrics, get_mean, LatencyRecorder
+
+
+class TestFakeFleet(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        self.fleet = FakeFleet(devices=10, devices_per_node=2, nodes_per_hub=2, busy_ratio=1, port=4444)
+        return self.fleet.make_app()
+
+    def test_hubs(self):
+        hub_urls = self.fleet.get_hub_urls()
+        self.assertEqual(['http://127.1.0.1:4444/', 'http://127.1.0.2:4444/', 'http://127.1.0.3:4444/'], hub_urls)
+        res = self.fetch('/grid/admin/ShowAllNodesServlet', headers={'Host': '127.1.0.3:4444'})
+        nodes = json.loads(res.body.decode())['nodes']
+        self.assertEqual(['http://127.2.0.5:4444'], list(node['id'] for node in nodes))
+        caps = nodes[0]['protocols']['web_driver']['browsers']['']['']
+        self.assertEqual(['udid-000008', 'udid-000009'], list(cap['capabilities']['UDID'] for cap in caps))
+        res = self.fetch('/grid/admin/ShowAllNodesServlet', headers={'Host': '127.1.0.4:4444'})
+        self.assertEqual(404, res.code)
+
+    def test_sessions(self):
+        res = self.fetch('/wd/hub/sessions', headers={'Host': '127.2.0.1:4444'})
+        sessions = json.loads(res.body.decode())['value']
+        self.assertEqual('udid-000000', sessions[0]['capabilities']['UDID'])
+
+    def test_address(self):
+        self.assertEqual('127.2.0.254', get_address(253, 2))
+        self.assertEqual('127.2.1.1', get_address(254, 2))
+
+
+class TestReport(tornado.testing.AsyncTestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, get_percentile(values, 50))
+        self.assertEqual(99, get_percentile(values, 99))
+        self.assertEqual(1, get_percentile([1], 99))
+        self.assertIsNone(get_percentile([], 50))
+
+    def test_metrics(self):
+        samples = parse_metrics('# TYPE d histogram\nd_sum{job="a"} 3.0\nd_count{job="a"} 2\n')
+        self.assertEqual(1.5, get_mean(samples, 'd', '{job="a"}'))
+        self.assertIsNone(get_mean(samples, 'd'))
+
+    def test_recorder(self):
+        recorder = LatencyRecorder()
+        recorder.add('lock', 0.1)
+        recorder.add('lock', 0.3)
+        recorder.add('lock', 0.2, '409')
+        summary = recorder.summarize(duration=2)['lock']
+        self.assertEqual({'ok': 2, '409': 1}, summary['outcomes'])
+        self.assertEqual(1, summary['throughput'])
+        self.assertEqual(0.1, summary['p50'])
+        self.assertEqual(0.3, summary['max'])
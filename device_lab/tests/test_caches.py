@@ -0,0 +1,43 @@
+import unittest
+
+from utils.caches import GenerationCache, LRUCache
+
+
+class TestGenerationCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = GenerationCache()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_cache_until_generation_moves(self):
+        self.assertEqual(1, self.cache.get_or_compute('k', self.compute))
+        self.assertEqual(1, self.cache.get_or_compute('k', self.compute))
+        self.cache.bump()
+        self.assertEqual(2, self.cache.get_or_compute('k', self.compute))
+        stats = self.cache.get_stats()
+        self.assertEqual((1, 2, 1), (stats['hits'], stats['misses'], stats['generation']))
+
+    def test_result_computed_before_bump_is_not_cached(self):
+        def compute_and_bump():
+            self.cache.bump()
+            return self.compute()
+        self.cache.get_or_compute('k', compute_and_bump)
+        self.assertEqual(0, self.cache.get_stats()['size'])
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertNotIn('b', cache)
+        self.assertEqual((1, 3), (cache.get('a'), cache.get('c')))
+        self.assertEqual(1, cache.pop('a'))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual({'size': 1, 'hits': 3, 'misses': 1}, cache.get_stats())
+
@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import tempfile
+import unittest
+import subprocess
+import multiprocessing
+import urllib.request
+from urllib.error import HTTPError
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm.session import sessionmaker
+
+from bench.fake_grid import get_hub_urls, serve_fake_grid
+from models.db_schema import Base, SeleniumGridHub
+from services.selenium_grid import SeleniumGridService
+from utils.cluster import HashRing, ClusterMembership
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestHashRing(unittest.TestCase):
+    def setUp(self):
+        self.keys = list('http://10.0.{}.{}:4444/'.format(i // 250, i % 250) for i in range(1000))
+
+    def test_spread(self):
+        ring = HashRing(['a', 'b', 'c'])
+        owners = list(ring.get_node(key) for key in self.keys)
+        for node in ('a', 'b', 'c'):
+            self.assertGreater(owners.count(node), 200)
+        self.assertIsNone(HashRing().get_node('x'))
+
+    def test_add_moves_keys_to_new_node_only(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.get_node(key)) for key in self.keys)
+        self.assertTrue(ring.add('d'))
+        self.assertFalse(ring.add('d'))
+        moved = list(key for key in self.keys if ring.get_node(key) != before[key])
+        self.assertTrue(all(ring.get_node(key) == 'd' for key in moved))
+        self.assertLess(len(moved), 400)  # about a quarter
+
+    def test_remove_moves_keys_of_removed_node_only(self):
+        ring = HashRing(['a', 'b', 'c'])
+        before = dict((key, ring.get_node(key)) for key in self.keys)
+        self.assertTrue(ring.remove('b'))
+        self.assertFalse(ring.remove('b'))
+        for key in self.keys:
+            if before[key] != 'b':
+                self.assertEqual(before[key], ring.get_node(key))
+            else:
+                self.assertIn(ring.get_node(key), ('a', 'c'))
+
+
+class TestClusterMembership(unittest.TestCase):
+    def test_drop_and_rejoin(self):
+        membership = ClusterMembership('http://a', ['http://b', 'http://c'], failure_threshold=2)
+        changes = []
+        membership.add_listener(lambda: changes.append(membership.get_peers()))
+        self.assertEqual(['http://b', 'http://c'], membership.get_peers())
+        self.assertFalse(membership.on_check('http://b', False))
+        self.assertTrue(membership.on_check('http://b', False))
+        self.assertFalse(membership.on_check('http://b', False))
+        self.assertEqual([['http://c']], changes)
+        self.assertEqual(['http://b', 'http://c'], membership.get_peers(alive_only=False))
+        self.assertEqual({'alive': False, 'failures': 3}, membership.get_stats()['nodes']['http://b'])
+        self.assertTrue(membership.on_check('http://b', True))
+        self.assertEqual(['http://b', 'http://c'], changes[-1])
+
+    def test_owner(self):
+        membership = ClusterMembership('http://a', ['http://a', 'http://b'])
+        keys = list('http://10.0.0.{}:4444/'.format(i) for i in range(20))
+        remote = list(key for key in keys if membership.get_remote_owner(key) is not None)
+        self.assertTrue(0 < len(remote) < len(keys))
+        self.assertTrue(all(membership.get_owner(key) == 'http://b' for key in remote))
+        self.assertTrue(all(membership.is_local(key) for key in keys if key not in remote))
+
+
+class TestShardedService(unittest.TestCase):
+    def setUp(self):
+        self.membership = ClusterMembership('http://a', ['http://a', 'http://b'])
+        self.hub_urls = list('http://10.0.0.{}:4444/'.format(i) for i in range(20))
+        self.service = SeleniumGridService(cluster=self.membership)
+        self.service.get_all_hubs_url = lambda: self.hub_urls
+        self.service.set_capabilities(list({
+            'capabilities': {'platformName': 'ios', 'version': '1', 'UDID': 'udid{}'.format(i)},
+            'appium_url': 'http://10.1.0.{}:4723/'.format(i),
+            'hub_url': hub_url,
+        } for i, hub_url in enumerate(self.hub_urls)))
+
+    def test_owned_hubs(self):
+        owned = self.service.get_owned_hubs_url()
+        self.assertEqual(list(url for url in self.hub_urls if self.membership.is_local(url)), owned)
+        self.assertTrue(0 < len(owned) < len(self.hub_urls))
+
+    def test_tokens_tell_owner(self):
+        for cap in self.service.get_available_capabilities(platform_name='ios'):
+            cap_token = cap['capability_token']
+            owner = self.membership.get_remote_owner(cap['hub_url'])
+            self.assertEqual(owner, self.service.get_token_owner(cap_token, 'capability'))
+            lock_token = self.service.lock_capability(cap_token, 10)
+            self.assertEqual(owner, self.service.get_token_owner(lock_token, 'lock'))
+            self.service.release_capability(lock_token)
+        self.assertIsNone(self.service.get_token_owner('invalid', 'lock'))
+
+    def test_tokens_of_single_node(self):
+        service = SeleniumGridService()
+        service.set_capabilities([{'capabilities': {'platformName': 'ios', 'UDID': 'udid1'},
+                                   'appium_url': 'http://10.1.0.1:4723/', 'hub_url': self.hub_urls[0]}])
+        cap_token = service.get_available_capabilities(platform_name='ios')[0]['capability_token']
+        self.assertIsNone(service.get_token_owner(cap_token, 'capability'))
+        self.assertEqual(2, len(service._signed_serializer.loads(cap_token, salt='capability')))
+
+
+def get_unused_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TestClusterProcesses(unittest.TestCase):
+    """
+    nodes of a cluster run by `app.py` as local processes, sharing a hub table in sqlite and a fake fleet
+    """
+    API_BASE_URL = '/device_lab/api/v1/'
+    FLEET_OPTIONS = dict(devices=12, devices_per_node=1, nodes_per_hub=2, busy_ratio=0, seed=0)
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        fake_port = get_unused_port()
+        self.hub_urls = get_hub_urls(self.FLEET_OPTIONS['devices'], self.FLEET_OPTIONS['devices_per_node'],
+                                     self.FLEET_OPTIONS['nodes_per_hub'], fake_port)
+        db_url = 'sqlite:///{}'.format(os.path.join(self.work_dir, 'hubs.db'))
+        engine = create_engine(db_url)
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.add_all(SeleniumGridHub(url=url) for url in self.hub_urls)
+        session.commit()
+        session.close()
+
+        ready = multiprocessing.Event()
+        self.fake_grid = multiprocessing.Process(target=serve_fake_grid, daemon=True,
+                                                 args=(self.FLEET_OPTIONS, fake_port, ready))
+        self.fake_grid.start()
+        ready.wait()
+        ports = list(get_unused_port() for _ in range(3))
+        self.node_urls = list('http://127.0.0.1:{}'.format(port) for port in ports)
+        self.nodes = []
+        for port, node_url in zip(ports, self.node_urls):
+            env = dict(os.environ, PORT=str(port), API_BASE_URL=self.API_BASE_URL, DB_URL=db_url,
+                       CLUSTER_NODES=','.join(self.node_urls), CLUSTER_SELF=node_url, LOCK_SECRET='secret',
+                       CLUSTER_CHECK_INTERVAL='0.2', CLUSTER_FAILURE_THRESHOLD='2', CLUSTER_TIMEOUT='1',
+                       HUB_POLL_MIN_INTERVAL='0.2', HUB_POLL_MAX_INTERVAL='0.5', LOCK_BACKEND='memory',
+                       SHARED_MEMORY_DIR=os.path.join(self.work_dir, str(port)), API_SPEC_ENABLED='0')
+            env.pop('LOCK_JOURNAL_DIR', None)
+            # NOTE: stderr is kept in a file, a pipe not read could block the node once it is full
+            with open(os.path.join(self.work_dir, '{}.log'.format(port)), 'wb') as log:
+                self.nodes.append(subprocess.Popen([sys.executable, 'app.py'], cwd=APP_DIR, env=env,
+                                                   stdout=subprocess.DEVNULL, stderr=log))
+
+    def tearDown(self):
+        for node in self.nodes:
+            node.terminate()
+            node.wait()
+        self.fake_grid.terminate()
+        self.fake_grid.join()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def request(self, node_index, path, method='GET', body=None):
+        """
+        :return: (code, data) of the response body
+        """
+        request = urllib.request.Request(
+            self.node_urls[node_index] + self.API_BASE_URL + path, method=method,
+            data=None if body is None else json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=5) as res:
+                body = json.loads(res.read().decode())
+        except HTTPError as e:
+            body = json.loads(e.read().decode())
+        return body['code'], body['data']
+
+    def wait_for(self, func, timeout=30):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                if func():
+                    return
+            except OSError:
+                pass  # not started yet
+            for node, node_url in zip(self.nodes, self.node_urls):
+                if node.poll() is not None and node.returncode >= 0:
+                    self.fail('node {} exited with {}:\n{}'.format(node_url, node.returncode, self.read_log(node_url)))
+            if time.time() > deadline:
+                self.fail('timed out')
+            time.sleep(0.2)
+
+    def read_log(self, node_url):
+        with open(os.path.join(self.work_dir, '{}.log'.format(node_url.rsplit(':', 1)[1])), 'rb') as log:
+            return log.read().decode(errors='replace')
+
+    def count_devices(self, node_index):
+        return len(self.request(node_index, 'capabilities?debug=true')[1])
+
+    def test_sharded_nodes(self):
+        devices = self.FLEET_OPTIONS['devices']
+        self.wait_for(lambda: all(self.count_devices(i) == devices for i in range(3)))
+        shards = list(self.request(i, 'cluster-status')[1]['hubs'] for i in range(3))
+        self.assertEqual(sorted(self.hub_urls), sorted(url for hubs in shards for url in hubs))
+
+        caps = self.request(0, 'capabilities?platform_name=ios')[1] + \
+            self.request(0, 'capabilities?platform_name=android')[1]
+        self.assertEqual(devices, len(caps))
+        # lock through any node, and release through another one
+        locks = []
+        for i, cap in enumerate(caps):
+            code, data = self.request(i % 3, 'capabilities-lock', 'POST',
+                                      {'capability_token': cap['capability_token'], 'timeout': 60})
+            self.assertEqual(201, code)
+            locks.append(data['token'])
+        self.assertEqual([], self.request(1, 'capabilities?platform_name=ios')[1])
+        code, _ = self.request(0, 'capabilities-lock', 'POST',
+                               {'capability_token': caps[0]['capability_token'], 'timeout': 60})
+        self.assertEqual(409, code)
+        self.assertEqual(200, self.request(2, 'capabilities-lock/{}'.format(locks[0]), 'DELETE')[0])
+        self.assertEqual(404, self.request(1, 'capabilities-lock/{}'.format(locks[0]), 'DELETE')[0])
+        code, data = self.request(1, 'capabilities-lock-batch', 'DELETE', {'tokens': locks})
+        self.assertEqual(200, code)
+        self.assertEqual([locks[0]], data['not_found'])
+
+        code, data = self.request(2, 'capabilities-lock-batch', 'POST',
+                                  {'platform_name': caps[0]['capabilities']['platformName'], 'count': devices,
+                                   'timeout': 60})
+        self.assertEqual(201, code)
+        self.assertEqual(sum(1 for cap in caps if cap['capabilities']['platformName'] ==
+                             caps[0]['capabilities']['platformName']), len(data['locks']))
+
+        # hubs of a stopped node are taken over by the others
+        self.nodes[2].terminate()
+        self.nodes[2].wait()
+        self.wait_for(lambda: self.count_devices(0) == devices and self.count_devices(1) == devices)
+        shards = list(self.request(i, 'cluster-status')[1]['hubs'] for i in range(2))
+        self.assertEqual(sorted(self.hub_urls), sorted(url for hubs in shards for url in hubs))
@@ -0,0 +1,105 @@
+import gzip
+import json
+
+import tornado.testing
+import tornado.web
+
+from handlers.base import BaseHandler
+from handlers.selenium_grid import CapabilityListHandler
+from handlers.metrics import MetricsHandler
+from handlers.health import ReadinessHandler, LivenessHandler
+from services.selenium_grid import selenium_grid_service
+
+
+class TestCapabilityListHandler(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([(r'/capabilities', CapabilityListHandler)])
+
+    def setUp(self):
+        super().setUp()
+        selenium_grid_service.set_capabilities(list({
+            "capabilities": {"platformName": "ios", "UDID": "udid{}".format(i), "deviceName": "iPhone " * 200},
+            "appium_url": "appium_url{}".format(i),
+        } for i in range(100)))
+
+    def tearDown(self):
+        selenium_grid_service.set_capabilities([])
+        super().tearDown()
+
+    def test_not_modified(self):
+        res = self.fetch('/capabilities?platform_name=ios')
+        self.assertEqual(200, res.code)
+        self.assertEqual(100, len(json.loads(res.body.decode())['data']))
+        etag = res.headers['Etag']
+        res = self.fetch('/capabilities?platform_name=ios', headers={'If-None-Match': etag})
+        self.assertEqual(304, res.code)
+        self.assertEqual(b'', res.body)
+
+        selenium_grid_service.set_capabilities([])
+        res = self.fetch('/capabilities?platform_name=ios', headers={'If-None-Match': etag})
+        self.assertEqual(200, res.code)
+        self.assertNotEqual(etag, res.headers['Etag'])
+
+    def test_gzip_in_chunks(self):
+        res = self.fetch('/capabilities?debug=true', headers={'Accept-Encoding': 'gzip'}, decompress_response=False)
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+        data = json.loads(gzip.decompress(res.body).decode())['data']
+        self.assertEqual(selenium_grid_service.get_all_capabilities(), data)
+        self.assertLess(BaseHandler.CHUNK_SIZE, len(json.dumps(data)))
+        res = self.fetch('/capabilities?debug=true')
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertEqual(data, json.loads(res.body.decode())['data'])
+
+    def test_gzipped_body_is_tagged_apart(self):
+        res = self.fetch('/capabilities?debug=true', headers={'Accept-Encoding': 'gzip'}, decompress_response=False)
+        gzipped_etag = res.headers['Etag']
+        res = self.fetch('/capabilities?debug=true', headers={'Accept-Encoding': 'identity'}, decompress_response=False)
+        self.assertNotIn('Content-Encoding', res.headers)
+        self.assertNotEqual(gzipped_etag, res.headers['Etag'])
+        res = self.fetch('/capabilities?debug=true', decompress_response=False,
+                         headers={'Accept-Encoding': 'identity', 'If-None-Match': gzipped_etag})
+        self.assertEqual(200, res.code)
+
+    def test_gzip_refused_by_q_value(self):
+        for accept_encoding in ('gzip;q=0', 'deflate, gzip; q=0.0', '*;q=0', 'br, *;q=0.5, gzip;q=0'):
+            res = self.fetch('/capabilities?debug=true', headers={'Accept-Encoding': accept_encoding},
+                             decompress_response=False)
+            self.assertNotIn('Content-Encoding', res.headers, accept_encoding)
+        res = self.fetch('/capabilities?debug=true', headers={'Accept-Encoding': 'br, *;q=0.5'},
+                         decompress_response=False)
+        self.assertEqual('gzip', res.headers['Content-Encoding'])
+
+
+class TestMetricsHandler(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/capabilities', CapabilityListHandler),
+            (r'/metrics', MetricsHandler),
+        ])
+
+    def test_request_duration(self):
+        self.fetch('/capabilities')
+        res = self.fetch('/metrics')
+        self.assertEqual(200, res.code)
+        self.assertTrue(res.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = res.body.decode().splitlines()
+        self.assertIn('# TYPE device_lab_http_request_duration_seconds histogram', lines)
+        self.assertTrue(any(line.startswith(
+            'device_lab_http_request_duration_seconds_count{handler="CapabilityListHandler",method="GET",status="200"}')
+            for line in lines))
+        self.assertIn('device_lab_capabilities{state="free"} 0', lines)
+
+
+class TestHealthHandler(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/health/ready', ReadinessHandler),
+            (r'/health/live', LivenessHandler),
+        ])
+
+    def test_not_ready_before_start(self):
+        res = self.fetch('/health/ready')
+        self.assertEqual(503, res.code)
+        self.assertFalse(json.loads(res.body.decode())['data']['ready'])
+        res = self.fetch('/health/live')
+        self.assertEqual(200, res.code)
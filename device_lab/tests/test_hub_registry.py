@@ -0,0 +1,80 @@
+import tornado.gen
+import tornado.testing
+from sqlalchemy import create_engine
+from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from models.db_schema import Base, SeleniumGridHub
+from services.hub_registry import HubRegistry, HubNotFoundException, HubConflictException
+
+
+def new_session_factory():
+    # every thread shares the same in-memory database
+    engine = create_engine('sqlite://', connect_args={'check_same_thread': False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+class TestHubRegistry(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.session_factory = new_session_factory()
+        self.registry = HubRegistry(session_factory=self.session_factory)
+        self.changes = 0
+        self.registry.add_listener(self.on_changed)
+
+    def on_changed(self):
+        self.changes += 1
+
+    def insert_hub(self, url):
+        session = self.session_factory()
+        session.add(SeleniumGridHub(url=url))
+        session.commit()
+        session.close()
+
+    @tornado.testing.gen_test
+    def test_refresh_notifies_only_changes(self):
+        self.insert_hub('http://hub1:4444')
+        self.assertTrue((yield self.registry.refresh()))
+        self.assertEqual(['http://hub1:4444'], self.registry.get_all_urls())
+        self.assertFalse((yield self.registry.refresh()))
+        self.assertEqual(1, self.changes)
+
+    @tornado.testing.gen_test
+    def test_crud(self):
+        hub = yield self.registry.create('http://hub1:4444')
+        self.assertEqual(['http://hub1:4444'], self.registry.get_all_urls())
+        with self.assertRaises(HubConflictException):
+            yield self.registry.create('http://hub1:4444')
+
+        yield self.registry.update(hub['id'], 'http://hub2:4444')
+        self.assertEqual({'id': hub['id'], 'url': 'http://hub2:4444'}, self.registry.get(hub['id']))
+        self.assertFalse((yield self.registry.refresh()))  # database is in sync
+
+        yield self.registry.delete(hub['id'])
+        with self.assertRaises(HubNotFoundException):
+            self.registry.get(hub['id'])
+        self.assertFalse((yield self.registry.refresh()))
+        self.assertEqual(3, self.changes)
+
+    @tornado.testing.gen_test
+    def test_url_is_unique(self):
+        # concurrent requests, the second one is rejected while the first one is being written
+        results = yield [self.registry.create('http://hub1:4444'), self.create_or_conflict('http://hub1:4444')]
+        self.assertEqual('http://hub1:4444', results[0]['url'])
+        self.assertIsNone(results[1])
+        # written by another process, not loaded yet
+        self.insert_hub('http://hub2:4444')
+        with self.assertRaises(HubConflictException):
+            yield self.registry.create('http://hub2:4444')
+        with self.assertRaises(HubConflictException):
+            yield self.registry.update(results[0]['id'], 'http://hub2:4444')
+        yield self.registry.refresh()
+        self.assertEqual(['http://hub1:4444', 'http://hub2:4444'], self.registry.get_all_urls())
+
+    @tornado.gen.coroutine
+    def create_or_conflict(self, url):
+        try:
+            return (yield self.registry.create(url))
+        except HubConflictException:
+            return None
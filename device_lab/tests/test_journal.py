@@ -0,0 +1,153 @@
+import os
+import stat
+import shutil
+import tempfile
+
+import tornado.gen
+import tornado.testing
+
+from utils.journal import LockJournal, CapabilitySnapshotFile, load_or_create_secret
+from utils.managers import SimpleLockManager
+
+
+class TestLockJournal(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def new_journal(self, **kwargs):
+        journal = LockJournal(self.directory, **kwargs)
+        managers = dict((namespace, SimpleLockManager()) for namespace in ('appium', 'udid'))
+        for namespace, manager in managers.items():
+            journal.restore(namespace, manager)
+        return journal, managers
+
+    @tornado.testing.gen_test
+    def test_restore(self):
+        journal, managers = self.new_journal()
+        managers['appium'].acquire('appium1', expired=60)
+        managers['appium'].acquire('appium2', expired=60)
+        managers['appium'].acquire('appium1', expired=120, refresh=True)
+        managers['appium'].release('appium2')
+        managers['udid'].acquire('udid1', expired=60)
+        managers['udid'].acquire('udid2', expired=-1)  # expired before restart
+        yield journal.flush()
+
+        _, restored = self.new_journal()
+        self.assertEqual(managers['appium'].dump(), restored['appium'].dump())
+        self.assertEqual(['appium1'], list(restored['appium'].dump()))
+        self.assertEqual(['udid1'], list(restored['udid'].dump()))
+        self.assertTrue(restored['udid'].is_lock('udid1'))
+
+    @tornado.testing.gen_test
+    def test_events_are_flushed_in_batch(self):
+        journal, managers = self.new_journal(flush_interval=0.01)
+        for i in range(100):
+            managers['udid'].acquire('udid{}'.format(i), expired=60)
+        yield tornado.gen.sleep(0.05)
+        with open(os.path.join(self.directory, LockJournal.JOURNAL_NAME)) as f:
+            self.assertEqual(100, len(f.readlines()))
+
+    @tornado.testing.gen_test
+    def test_compact(self):
+        journal, managers = self.new_journal(compact_threshold=3)
+        managers['udid'].acquire('udid1', expired=60)
+        managers['udid'].acquire('udid2', expired=60)
+        yield journal.flush()
+        managers['udid'].release('udid1')
+        managers['udid'].acquire('udid3', expired=60)
+        yield journal.flush()  # over threshold, written as snapshot
+        with open(os.path.join(self.directory, LockJournal.JOURNAL_NAME)) as f:
+            self.assertEqual('', f.read())
+        managers['udid'].acquire('udid4', expired=60)
+        yield journal.flush()
+
+        _, restored = self.new_journal()
+        self.assertEqual(['udid2', 'udid3', 'udid4'], sorted(restored['udid'].dump()))
+
+    def test_broken_record_is_skipped(self):
+        with open(os.path.join(self.directory, LockJournal.JOURNAL_NAME), 'w') as f:
+            f.write('["udid", "udid1", 9999999999]\n["udid", "udid2", 99')
+        _, restored = self.new_journal()
+        self.assertEqual(['udid1'], list(restored['udid'].dump()))
+
+    def test_secret(self):
+        path = os.path.join(self.directory, 'secret')
+        secret = load_or_create_secret(path)
+        self.assertEqual(secret, load_or_create_secret(path))
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+
+    @tornado.testing.gen_test
+    def test_lock_token_survives_restart(self):
+        from services.selenium_grid import SeleniumGridService
+        caps = [{"capabilities": {"platformName": "ios", "UDID": "udid1"}, "appium_url": "appium_url1"}]
+
+        def new_service():
+            service = SeleniumGridService(secret=load_or_create_secret(os.path.join(self.directory, 'secret')))
+            journal = LockJournal(self.directory)
+            service.attach_lock_journal(journal)
+            service.set_capabilities(caps)
+            return service, journal
+
+        service, journal = new_service()
+        cap_token = service.get_available_capabilities('ios')[0]['capability_token']
+        lock_token = service.lock_capability(cap_token, 60)
+        yield journal.flush()
+
+        service, _ = new_service()
+        self.assertEqual([], service.get_available_capabilities('ios'))
+        service.release_capability(lock_token)
+        self.assertEqual(cap_token, service.get_available_capabilities('ios')[0]['capability_token'])
+
+
+class TestCapabilitySnapshotFile(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'snapshot', 'capabilities.snapshot.gz')
+        self.hub_caps = {'http://hub1:4444': [{
+            "capabilities": {"platformName": "ios", "UDID": "udid1"},
+            "appium_url": "appium_url1", "hub_url": "http://hub1:4444/",
+        }]}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    @tornado.testing.gen_test
+    def test_save_and_load(self):
+        snapshot_file = CapabilitySnapshotFile(self.path)
+        self.assertIsNone(snapshot_file.load())
+        yield snapshot_file.save(self.hub_caps)
+        saved_at, hub_caps = snapshot_file.load()
+        self.assertEqual(self.hub_caps, hub_caps)
+        with open(self.path, 'wb') as f:
+            f.write(b'broken')
+        self.assertIsNone(snapshot_file.load())
+
+    @tornado.testing.gen_test
+    def test_warm_start(self):
+        from services.selenium_grid import SeleniumGridService
+        service = SeleniumGridService()
+        service.attach_capability_snapshot(CapabilitySnapshotFile(self.path))
+        service.merge_hub_capabilities('http://hub1:4444', self.hub_caps['http://hub1:4444'])
+        self.assertTrue((yield service.save_capability_snapshot()))
+        self.assertFalse((yield service.save_capability_snapshot()))
+
+        # restarted, capabilities are served as stale until the hub is polled
+        service = SeleniumGridService()
+        service.get_all_hubs_url = lambda: []
+        service.attach_capability_snapshot(CapabilitySnapshotFile(self.path))
+        self.assertEqual(1, len(service.get_available_capabilities('ios')))
+        self.assertTrue(service.has_stale_capabilities())
+        service.sync_hub_polls()  # kept before the registry is loaded
+        readiness = service.get_readiness()
+        self.assertEqual(['http://hub1:4444'], readiness['stale_hubs'])
+        self.assertFalse(readiness['ready'])
+        service.merge_hub_capabilities('http://hub1:4444', self.hub_caps['http://hub1:4444'])
+        self.assertFalse(service.has_stale_capabilities())
+        self.assertEqual(1, len(service.get_available_capabilities('ios')))
@@ -0,0 +1,221 @@
+import time
+import unittest
+
+from utils.managers import CapabilityStore, SimpleLockManager, RedisLockManager, LockConflictError, acquire_all
+from tests.fake_redis import new_lock_server
+
+
+def new_cap(appium_url, udid, platform_name='ios', version='1', device_name='iPhone 8', hub_url='hub1'):
+    return {
+        "capabilities": {
+            "platformName": platform_name,
+            "version": version,
+            "deviceName": device_name,
+            "UDID": udid,
+        },
+        "appium_url": appium_url,
+        "hub_url": hub_url,
+    }
+
+
+class TestCapabilityStore(unittest.TestCase):
+    def setUp(self):
+        self.store = CapabilityStore()
+        self.caps = [
+            new_cap('appium1', 'udid1', version='9.3', device_name='iPhone 6'),
+            new_cap('appium1', 'udid2', version='10.0', device_name='iPhone 8 Plus'),
+            new_cap('appium2', 'udid3', version='11.2.1', device_name='iPad Pro'),
+            new_cap('appium3', 'udid4', platform_name='android', version='8.0', device_name='Pixel 2'),
+        ]
+        self.store.replace(self.caps)
+
+    def query_udids(self, **kwargs):
+        return [e.udid for e in self.store.query(**kwargs)]
+
+    def test_query_by_platform_name(self):
+        self.assertEqual(['udid1', 'udid2', 'udid3'], self.query_udids(platform_name='ios'))
+        self.assertEqual(['udid4'], self.query_udids(platform_name='android'))
+        self.assertEqual([], self.query_udids(platform_name='windows'))
+
+    def test_query_by_device_name_partially(self):
+        self.assertEqual(['udid1', 'udid2'], self.query_udids(device_names=['iphone']))
+        self.assertEqual(['udid2', 'udid3'], self.query_udids(device_names=['plus', 'PRO']))
+
+    def test_query_by_version_range_is_numeric(self):
+        self.assertEqual(['udid2', 'udid3'], self.query_udids(platform_name='ios', min_platform_version='10'))
+        self.assertEqual(['udid1', 'udid2'], self.query_udids(platform_name='ios', max_platform_version='10'))
+        self.assertEqual(['udid2'], self.query_udids(min_platform_version='9.4', max_platform_version='10.1'))
+        self.assertEqual(['udid3'], self.query_udids(platform_versions=['11.2.1']))
+
+    def test_locked_capabilities_are_not_free(self):
+        self.store.set_appium_url_locked('appium1', True)
+        self.assertEqual(['udid3'], self.query_udids(platform_name='ios'))
+        self.store.set_udid_locked('udid3', True)
+        self.assertEqual([], self.query_udids(platform_name='ios'))
+        self.assertEqual(['udid1', 'udid2', 'udid3'], self.query_udids(platform_name='ios', free_only=False))
+        self.store.set_appium_url_locked('appium1', False)
+        self.assertEqual(['udid1', 'udid2'], self.query_udids(platform_name='ios'))
+
+    def test_lock_state_survives_replace(self):
+        self.store.set_udid_locked('udid1', True)
+        self.store.replace(self.caps)
+        self.assertEqual(['udid2', 'udid3'], self.query_udids(platform_name='ios'))
+
+    def test_add_and_remove(self):
+        entry = self.store.add(new_cap('appium4', 'udid5', version='10.3'))
+        self.assertEqual(['udid2', 'udid5'], self.query_udids(min_platform_version='10', max_platform_version='11'))
+        self.store.remove(entry.key)
+        self.assertEqual(['udid2'], self.query_udids(min_platform_version='10', max_platform_version='11'))
+        self.assertEqual(self.caps, self.store.get_all())
+
+    def test_apply_hub_keeps_unchanged_entries(self):
+        store = CapabilityStore()
+        change_sets = []
+        store.add_listener(change_sets.append)
+        caps = [new_cap('appium1', 'udid1'), new_cap('appium1', 'udid2')]
+        store.apply_hub('hub1', caps)
+        entry = store.get(('hub1', 'appium1', 'udid1'))
+
+        updated = [new_cap('appium1', 'udid1'), new_cap('appium1', 'udid2', version='2'), new_cap('appium2', 'udid3')]
+        change_set = store.apply_hub('hub1', updated)
+        self.assertIs(entry, store.get(('hub1', 'appium1', 'udid1')))
+        self.assertEqual(['udid3'], [e.udid for e in change_set.added])
+        self.assertEqual(['udid2'], [e.udid for e in change_set.changed])
+        self.assertEqual([], change_set.removed)
+
+        change_set = store.apply_hub('hub1', updated[1:])
+        self.assertEqual(['udid1'], [e.udid for e in change_set.removed])
+        self.assertEqual(updated[1:], store.get_all())
+
+        store.apply_hub('hub1', updated[1:])  # nothing changed, nothing published
+        self.assertEqual(3, len(change_sets))
+
+    def test_remove_hub(self):
+        store = CapabilityStore()
+        store.apply_hub('hub1', [new_cap('appium1', 'udid1')])
+        store.apply_hub('hub2', [new_cap('appium2', 'udid2', hub_url='hub2')])
+        change_set = store.remove_hub('hub1')
+        self.assertEqual(['udid1'], [e.udid for e in change_set.removed])
+        self.assertEqual(['hub2'], store.get_hub_urls())
+        self.assertEqual(['udid2'], [e.udid for e in store.query()])
+
+    def test_capability_moves_to_hub_reporting_it_latest(self):
+        store = CapabilityStore()
+        cap = new_cap('appium1', 'udid1')
+        store.apply_hub('hub1', [cap])
+        store.apply_hub('hub2', [cap])
+        self.assertEqual({'hub1': [], 'hub2': [cap]}, store.get_all_by_hub())
+        change_set = store.apply_hub('hub1', [])  # no longer owned by hub1, kept
+        self.assertEqual([], change_set.removed)
+        store.remove(store.get(('hub1', 'appium1', 'udid1')).key)
+        self.assertEqual({'hub1': [], 'hub2': []}, store.get_all_by_hub())
+        self.assertEqual([], store.remove_hub('hub2').removed)
+
+
+class TestRedisLockManager(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = new_lock_server()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        self.lock = RedisLockManager.from_url(self.server.url, 'test:{}'.format(self.id()))
+        self.other = RedisLockManager.from_url(self.server.url, 'test:{}'.format(self.id()))
+        self.events = []
+        self.lock.add_listener(lambda e: self.events.append((e.type, e.key)))
+
+    def test_lock_is_shared_by_managers(self):
+        self.lock.acquire('lock1', expired=10)
+        self.assertTrue(self.other.is_lock('lock1'))
+        with self.assertRaises(RuntimeError) as context:
+            self.other.acquire('lock1', expired=10)
+        self.assertTrue('cannot lock: lock1' in str(context.exception))
+        self.other.release('lock1')
+        self.assertFalse(self.lock.is_lock('lock1'))
+        self.assertEqual([('acquired', 'lock1')], self.events)
+
+    def test_lock_expired_by_redis(self):
+        self.lock.acquire('lock1', expired=0.05)
+        time.sleep(0.1)
+        self.assertFalse(self.lock.is_lock('lock1'))
+        self.other.acquire('lock1', expired=10)
+
+    def test_refresh(self):
+        self.lock.acquire('lock1', expired=10, refresh=True)
+        self.lock.acquire('lock1', expired=0.05, refresh=True)
+        time.sleep(0.1)
+        self.assertTrue(self.lock.is_lock('lock1'))
+        self.assertEqual([('acquired', 'lock1'), ('refreshed', 'lock1')], self.events)
+
+    def test_is_lock_many_in_one_round_trip(self):
+        self.lock.acquire('lock1', expired=10)
+        self.lock.acquire('lock3', expired=10)
+        del self.server.commands[:]
+        self.assertEqual([True, False, True], self.lock.is_lock_many(['lock1', 'lock2', 'lock3']))
+        self.assertEqual(['EXISTS'] * 3, self.server.commands)
+
+    def test_release_many(self):
+        self.lock.acquire_many(['lock1', 'lock2'], expired=10)
+        del self.events[:]
+        self.lock.release_many(['lock1', 'lock2', 'lock3'])
+        self.assertEqual([False, False], self.other.is_lock_many(['lock1', 'lock2']))
+        self.assertEqual([('released', 'lock1'), ('released', 'lock2')], self.events)
+
+    def test_release_and_extend_by_owner(self):
+        self.lock.acquire_many(['lock1', 'lock2'], expired=0.05, owners=['owner1', None])
+        self.assertFalse(self.other.extend('lock1', 'owner2', expired=10))
+        self.assertTrue(self.other.extend('lock1', 'owner1', expired=10))
+        time.sleep(0.1)
+        self.assertEqual([True, False], self.lock.is_lock_many(['lock1', 'lock2']))
+        self.lock.acquire('lock2', expired=10)
+        self.assertEqual([False, True, True], self.other.release_many(['lock1', 'lock1', 'lock2'],
+                                                                       ['owner2', 'owner1', None]))
+        self.assertEqual([False, False], self.lock.is_lock_many(['lock1', 'lock2']))
+
+    def test_stale_holder_cannot_release_lock_taken_over(self):
+        self.lock.acquire('lock1', expired=0.05, owner='owner1')
+        time.sleep(0.1)
+        self.other.acquire('lock1', expired=10, owner='owner2')
+        del self.events[:]
+        self.assertFalse(self.lock.release('lock1', 'owner1'))
+        self.assertTrue(self.other.is_lock('lock1'))
+        self.assertEqual([], self.events)
+
+    def test_acquire_many_is_all_or_nothing(self):
+        self.other.acquire('lock2', expired=10)
+        with self.assertRaises(LockConflictError) as context:
+            self.lock.acquire_many(['lock1', 'lock2', 'lock3'], expired=10)
+        self.assertEqual(['lock2'], context.exception.keys)
+        self.assertEqual([False, True, False], self.lock.is_lock_many(['lock1', 'lock2', 'lock3']))
+        self.lock.acquire_many(['lock1', 'lock3'], expired=10)
+        self.assertEqual([True, True, True], self.other.is_lock_many(['lock1', 'lock2', 'lock3']))
+
+
+class RacyLockManager(SimpleLockManager):
+    # another process takes the key between check and acquire
+    def acquire_many(self, keys, expired=5, owners=None):
+        raise LockConflictError(keys)
+
+
+class TestAcquireAll(unittest.TestCase):
+    def setUp(self):
+        self.lock1 = SimpleLockManager()
+        self.lock2 = SimpleLockManager()
+
+    def test_report_all_contended_keys(self):
+        self.lock1.acquire('a')
+        self.lock2.acquire('b')
+        with self.assertRaises(LockConflictError) as context:
+            acquire_all([(self.lock1, 'a'), (self.lock1, 'c'), (self.lock2, 'b')])
+        self.assertEqual([(self.lock1, 'a'), (self.lock2, 'b')], context.exception.keys)
+        self.assertFalse(self.lock1.is_lock('c'))
+
+    def test_roll_back_on_conflict(self):
+        lock2 = RacyLockManager()
+        with self.assertRaises(LockConflictError) as context:
+            acquire_all([(self.lock1, 'a'), (lock2, 'b')])
+        self.assertEqual([(lock2, 'b')], context.exception.keys)
+        self.assertFalse(self.lock1.is_lock('a'))
@@ -0,0 +1,57 @@
+import unittest
+
+from utils.metrics import MetricsRegistry
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter('conflicts_total', 'conflicts', labelnames=('resource',))
+        counter.labels('udid').inc()
+        counter.labels('udid').inc(2)
+        counter.labels('appium_url').inc()
+        self.assertEqual([
+            '# HELP conflicts_total conflicts',
+            '# TYPE conflicts_total counter',
+            'conflicts_total{resource="appium_url"} 1',
+            'conflicts_total{resource="udid"} 3',
+        ], self.registry.render().splitlines())
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('waiters', 'waiters')
+        gauge.set(3)
+        gauge.dec()
+        self.assertIn('waiters 2', self.registry.render().splitlines())
+        items = [1, 2, 3]
+        gauge.set_function(lambda: len(items))
+        items.append(4)
+        self.assertIn('waiters 4', self.registry.render().splitlines())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('duration_seconds', 'duration', labelnames=('handler',),
+                                            buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.labels('a"b').observe(value)
+        self.assertEqual([
+            '# HELP duration_seconds duration',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{handler="a\\"b",le="0.1"} 2',
+            'duration_seconds_bucket{handler="a\\"b",le="1"} 3',
+            'duration_seconds_bucket{handler="a\\"b",le="+Inf"} 4',
+            'duration_seconds_sum{handler="a\\"b"} 3.65',
+            'duration_seconds_count{handler="a\\"b"} 4',
+        ], self.registry.render().splitlines())
+
+    def test_histogram_time(self):
+        histogram = self.registry.histogram('duration_seconds', 'duration')
+        with self.assertRaises(ValueError):
+            with histogram.time():
+                raise ValueError()
+        self.assertIn('duration_seconds_count 1', self.registry.render().splitlines())
+
+    def test_register_twice(self):
+        self.registry.counter('conflicts_total', 'conflicts')
+        with self.assertRaises(ValueError):
+            self.registry.gauge('conflicts_total', 'conflicts')
@@ -1,6 +1,6 @@
 import unittest
 
-from utils.misc import on_exception_return
+from utils.misc import on_exception_return, parse_version
 
 
 class TestOnExceptionReturn(unittest.TestCase):
@@ -16,3 +16,11 @@ class TestOnExceptionReturn(unittest.TestCase):
             raise Exception(msg)
         msg = 'bad things happen'
         self.assertEqual(msg, raise_exception(msg))
+
+
+class TestParseVersion(unittest.TestCase):
+    def test_parse_version(self):
+        self.assertEqual((11, 2, 1), parse_version('11.2.1'))
+        self.assertEqual(parse_version('11'), parse_version('11.0'))
+        self.assertLess(parse_version('9.3'), parse_version('10'))
+        self.assertEqual((), parse_version(None))
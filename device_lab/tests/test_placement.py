@@ -0,0 +1,108 @@
+import unittest
+
+from utils.managers import CapabilityEntry, CapabilityChangeSet
+from utils.placement import BalancedPolicy, HubOrderPolicy, new_placement_policy
+from services.selenium_grid import SeleniumGridService
+
+
+def new_entry(appium_url, udid, hub_url='hub1'):
+    return CapabilityEntry({"capabilities": {"platformName": "ios", "UDID": udid},
+                            "appium_url": appium_url, "hub_url": hub_url})
+
+
+class TestBalancedPolicy(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.policy = BalancedPolicy(idle_horizon=100)
+        self.policy.get_current_time = lambda: self.now
+        self.entries = [new_entry('appium1', 'udid1', 'hub1'), new_entry('appium2', 'udid2', 'hub1'),
+                        new_entry('appium3', 'udid3', 'hub2'), new_entry('appium4', 'udid4', 'hub2')]
+        self.policy.on_capabilities_changed(CapabilityChangeSet(None, self.entries, [], []))
+
+    def rank(self):
+        return list(e.udid for e in self.policy.rank(self.entries))
+
+    def lock(self, entry, locked=True):
+        self.policy.on_appium_url_locked(entry.appium_url, locked)
+        self.policy.on_udid_locked(entry.udid, [entry], locked)
+
+    def test_hub_order_if_nothing_known(self):
+        self.assertEqual(['udid1', 'udid2', 'udid3', 'udid4'], self.rank())
+
+    def test_least_recently_used_first(self):
+        self.lock(self.entries[0])
+        self.lock(self.entries[0], locked=False)
+        self.now += 50
+        self.lock(self.entries[2])
+        self.lock(self.entries[2], locked=False)
+        self.assertEqual(['udid2', 'udid4', 'udid1', 'udid3'], self.rank())
+        self.now += 100
+        self.assertEqual(['udid1', 'udid2', 'udid3', 'udid4'], self.rank())
+
+    def test_lightly_loaded_hub_first(self):
+        self.now += 1000
+        self.lock(self.entries[0])
+        self.now += 1000  # recency is gone, load of hub1 is left
+        self.assertEqual(['udid3', 'udid4', 'udid1', 'udid2'], self.rank())
+        self.assertEqual({'locked': 1, 'devices': 2}, self.policy.get_stats()['hub_load']['hub1'])
+        self.lock(self.entries[0], locked=False)
+        self.assertEqual({}, self.policy._hub_locked)
+
+    def test_failing_node_last(self):
+        self.policy.on_appium_polled('appium1', False)
+        self.assertEqual(['udid2', 'udid3', 'udid4', 'udid1'], self.rank())
+        for _ in range(30):
+            self.policy.on_appium_polled('appium1', True)
+        self.assertEqual({}, self.policy.get_stats()['failure_rates'])
+
+    def test_removed_capabilities(self):
+        self.lock(self.entries[2])
+        self.policy.on_appium_polled('appium3', False)
+        self.policy.on_capabilities_changed(CapabilityChangeSet('hub2', [], self.entries[2:], []))
+        self.assertEqual(['hub1'], list(self.policy.get_stats()['hub_load']))
+        self.assertEqual({}, self.policy.get_stats()['failure_rates'])
+        self.assertNotIn('udid3', self.policy._udid_used_at)
+        self.assertNotIn('appium3', self.policy._appium_used_at)
+
+    def test_generation_moves_with_failure_rate_and_time(self):
+        generation = self.policy.get_generation()
+        self.now += 1000
+        self.assertEqual(generation, self.policy.get_generation())  # nothing used, recency does not matter
+        self.policy.on_appium_polled('appium1', False)
+        self.assertNotEqual(generation, self.policy.get_generation())
+        generation = self.policy.get_generation()
+        self.policy.on_appium_polled('appium2', True)
+        self.assertEqual(generation, self.policy.get_generation())
+        self.lock(self.entries[0])
+        generation = self.policy.get_generation()
+        self.now += 10
+        self.assertNotEqual(generation, self.policy.get_generation())
+
+    def test_new_placement_policy(self):
+        self.assertIsInstance(new_placement_policy('hub_order'), HubOrderPolicy)
+        with self.assertRaises(ValueError):
+            new_placement_policy('random')
+
+
+class TestServiceWithBalancedPolicy(unittest.TestCase):
+    def test_released_device_is_picked_last(self):
+        service = SeleniumGridService(secret='secret', placement_policy=BalancedPolicy())
+        service.set_capabilities(list(
+            {"capabilities": {"platformName": "ios", "UDID": "udid{}".format(i)}, "appium_url": "appium_url{}".format(i)}
+            for i in range(3)))
+        picked = []
+        for _ in range(3):
+            cap = service.get_available_capabilities(platform_name='ios')[0]
+            picked.append(cap['capabilities']['UDID'])
+            service.release_capability(service.lock_capability(cap['capability_token'], 10))
+        self.assertEqual(['udid0', 'udid1', 'udid2'], picked)
+        self.assertEqual('balanced', service.get_placement_stats()['policy'])
+
+    def test_failing_node_is_ranked_last_in_cached_result(self):
+        service = SeleniumGridService(secret='secret', placement_policy=BalancedPolicy())
+        service.set_capabilities(list(
+            {"capabilities": {"platformName": "ios", "UDID": "udid{}".format(i)}, "appium_url": "appium_url{}".format(i)}
+            for i in range(2)))
+        self.assertEqual('udid0', service.get_available_capabilities(platform_name='ios')[0]['capabilities']['UDID'])
+        service._placement_policy.on_appium_polled('appium_url0', False)
+        self.assertEqual('udid1', service.get_available_capabilities(platform_name='ios')[0]['capabilities']['UDID'])
@@ -0,0 +1,54 @@
+import unittest
+
+from utils.polling import PollState, CircuitBreaker
+
+
+class TestPollState(unittest.TestCase):
+    def setUp(self):
+        self.rand = 0.5  # no jitter
+        self.state = PollState(initial_interval=10, min_interval=5, max_interval=20, max_backoff=60,
+                               rand=lambda: self.rand)
+
+    def test_interval_adapts_to_changes(self):
+        self.state.on_success(1000, 0.1, changed=True)
+        self.assertEqual(5, self.state.get_next_delay())
+        self.state.on_success(1001, 0.1, changed=True)
+        self.assertEqual(5, self.state.interval)
+        for _ in range(10):
+            self.state.on_success(1002, 0.1, changed=False)
+        self.assertEqual(20, self.state.interval)
+
+    def test_backoff_on_failure(self):
+        delays = []
+        for _ in range(4):
+            self.state.on_failure(1000, 5)
+            delays.append(self.state.get_next_delay())
+        self.assertEqual([20, 40, 60, 60], delays)
+        self.state.on_success(1001, 0.1, changed=False)
+        self.assertEqual(0, self.state.failures)
+        self.assertEqual(12.5, self.state.get_next_delay())
+
+    def test_jitter(self):
+        self.rand = 0
+        self.assertEqual(8, self.state.get_next_delay())
+        self.assertEqual(0, self.state.get_first_delay())
+        self.rand = 1
+        self.assertEqual(12, self.state.get_next_delay())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_open_and_half_open(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        breaker.on_failure(1000)
+        self.assertTrue(breaker.allow(1000))
+        breaker.on_failure(1000)
+        self.assertFalse(breaker.allow(1059))
+        self.assertTrue(breaker.allow(1060))
+        self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+        # trial fails, open again
+        breaker.on_failure(1060)
+        self.assertFalse(breaker.allow(1061))
+        self.assertTrue(breaker.allow(1120))
+        breaker.on_success()
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+
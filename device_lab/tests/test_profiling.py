@@ -0,0 +1,92 @@
+import json
+import time
+import threading
+from unittest import mock
+
+import tornado.gen
+import tornado.testing
+import tornado.web
+
+from handlers.diagnostics import ProfileHandler, LoopStatusHandler, DEBUG_TOKEN_HEADER
+from services.diagnostics import DiagnosticsService, DebugAccessDeniedException
+from utils.profiling import LoopLagMonitor, SamplingProfiler, ProfilerBusyError
+
+
+def block_loop(seconds):
+    time.sleep(seconds)
+
+
+def spin(stopped):
+    while not stopped.is_set():
+        sum(range(1000))
+
+
+class TestLoopLagMonitor(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_stall_with_stack(self):
+        monitor = LoopLagMonitor(threshold=0.05, interval=0.01)
+        monitor.start()
+        try:
+            yield tornado.gen.sleep(0.05)
+            self.assertEqual(0, monitor.get_stats()['total_stalls'])
+            block_loop(0.3)
+            yield tornado.gen.sleep(0.05)
+        finally:
+            monitor.stop()
+        stats = monitor.get_stats()
+        self.assertEqual(1, stats['total_stalls'])
+        stall = stats['stalls'][0]
+        self.assertGreaterEqual(stall['lag'], 0.25)
+        self.assertTrue(any(frame.endswith(' block_loop') for frame in stall['stack']))
+
+
+class TestSamplingProfiler(tornado.testing.AsyncTestCase):
+    def test_hot_stack(self):
+        stopped = threading.Event()
+        thread = threading.Thread(target=spin, args=(stopped,))
+        thread.start()
+        try:
+            result = SamplingProfiler().sample(thread.ident, 0.1, 0.002, top=5)
+        finally:
+            stopped.set()
+            thread.join()
+        self.assertGreater(result['samples'], 10)
+        self.assertEqual(0, result['idle'])
+        self.assertTrue(result['stacks'][0]['stack'][-1].endswith(' spin'))
+        self.assertTrue(any(frame['frame'].endswith(' spin') and frame['total'] >= frame['self']
+                            for frame in result['frames']))
+
+    def test_one_profile_at_a_time(self):
+        profiler = SamplingProfiler()
+        profiler._running.acquire()
+        with self.assertRaises(ProfilerBusyError):
+            profiler.sample(None, 0.01)
+
+
+class TestProfileHandler(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application([
+            (r'/debug/profile', ProfileHandler),
+            (r'/loop-status', LoopStatusHandler),
+        ])
+
+    def test_guarded(self):
+        res = self.fetch('/debug/profile?seconds=0.05')
+        self.assertEqual(403, res.code)
+        service = DiagnosticsService(token='secret', max_seconds=1)
+        with self.assertRaises(DebugAccessDeniedException):
+            service.check_access('wrong')
+        with mock.patch('handlers.diagnostics.diagnostics_service', service):
+            res = self.fetch('/debug/profile?seconds=0.05', headers={DEBUG_TOKEN_HEADER: 'wrong'})
+            self.assertEqual(403, res.code)
+            res = self.fetch('/debug/profile?seconds=2', headers={DEBUG_TOKEN_HEADER: 'secret'})
+            self.assertEqual(400, res.code)
+            res = self.fetch('/debug/profile?seconds=0.05&interval=0.005', headers={DEBUG_TOKEN_HEADER: 'secret'})
+            self.assertEqual(200, res.code)
+            data = json.loads(res.body.decode())['data']
+            self.assertGreater(data['samples'], 0)
+            self.assertEqual(0.05, data['seconds'])
+
+    def test_loop_status(self):
+        data = json.loads(self.fetch('/loop-status').body.decode())['data']
+        self.assertEqual(0, data['total_stalls'])
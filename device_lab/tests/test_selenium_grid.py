@@ -1,9 +1,17 @@
 import unittest
+from unittest import mock
+
+import json
+import tornado.gen
 import tornado.testing
+from tornado.concurrent import Future
 
 from utils.clients.selenium_grid import SeleniumGridClient
-from services.selenium_grid import SeleniumGridService
-from services.selenium_grid import SimpleLockManager
+from services.selenium_grid import SeleniumGridService, LockConflictException, LockNotFoundException, \
+    WaitTimeoutException, WaitQueueFullException
+from services.selenium_grid import SimpleLockManager, RedisLockManager
+from tests.fake_redis import new_lock_server
+import time
 from time import sleep
 
 
@@ -85,6 +93,154 @@ class TestSeleniumGridService(unittest.TestCase):
                     {'capabilities': {'platformName': 'ios', 'version': '2', 'UDID': 'udid2'}, 'appium_url': 'appium_url2'}]
         self.assertEqual(expected, caps)
 
+    def test_locked_capability_is_not_available(self):
+        caps = self.service.get_available_capabilities(platform_name='ios')
+        lock_token = self.service.lock_capability(caps[0]['capability_token'], 10)
+        caps = self.service.get_available_capabilities(platform_name='ios')
+        self.assertEqual([('appium_url2', 'udid2')], [(c['appium_url'], c['capabilities']['UDID']) for c in caps])
+        self.service.release_capability(lock_token)
+        caps = self.service.get_available_capabilities(platform_name='ios')
+        self.assertEqual(2, len(caps))
+
+    def test_stale_lock_token_does_not_release_later_lock(self):
+        cap_token = self.service.get_available_capabilities(platform_name='ios')[0]['capability_token']
+        stale_token = self.service.lock_capability(cap_token, 1)
+        for manager in (self.service._appium_lock, self.service._udid_lock):
+            manager._lock = dict((key, 0) for key in manager._lock)  # expired
+        self.service.release_expired_locks()
+        lock_token = self.service.lock_capability(cap_token, 10)
+        with self.assertRaises(LockNotFoundException):
+            self.service.release_capability(stale_token)
+        with self.assertRaises(LockNotFoundException):
+            self.service.extend_capability(stale_token, 10)
+        self.assertTrue(self.service._udid_lock.is_lock('udid1'))
+        self.assertEqual([stale_token], self.service.release_capabilities([stale_token, lock_token]))
+        self.assertFalse(self.service._udid_lock.is_lock('udid1'))
+
+    def test_lock_token_without_lock_id_is_rejected(self):
+        cap_token = self.service.get_available_capabilities(platform_name='ios')[0]['capability_token']
+        self.service.lock_capability(cap_token, 10)
+        # issued before locks had ids, with the time the lock expires at
+        old_token = self.service._signed_serializer.dumps(('appium_url1', 'udid1', time.time() + 60), salt='lock')
+        with self.assertRaises(LockNotFoundException):
+            self.service.release_capability(old_token)
+        with self.assertRaises(LockNotFoundException):
+            self.service.extend_capability(old_token, 10)
+        self.assertEqual([old_token], self.service.release_capabilities([old_token]))
+        self.assertTrue(self.service._appium_lock.is_lock('appium_url1'))
+        self.assertTrue(self.service._udid_lock.is_lock('udid1'))
+
+    def test_extend_capability(self):
+        cap_token = self.service.get_available_capabilities(platform_name='ios')[0]['capability_token']
+        lock_token = self.service.lock_capability(cap_token, 1)
+        result = self.service.extend_capability(lock_token, 60)
+        self.assertEqual(lock_token, result['token'])
+        self.assertGreater(self.service._udid_lock.dump()['udid1'][0], time.time() + 30)
+        # half of the lock is lost, the other half is not kept
+        self.service._udid_lock.release('udid1')
+        with self.assertRaises(LockNotFoundException):
+            self.service.extend_capability(lock_token, 60)
+        self.assertFalse(self.service._appium_lock.is_lock('appium_url1'))
+
+    def test_lock_conflict_reports_contended_keys(self):
+        caps = self.service.get_available_capabilities(platform_name='ios')
+        self.service.lock_capability(caps[0]['capability_token'], 10)
+        with self.assertRaises(LockConflictException) as context:
+            self.service.lock_capability(caps[0]['capability_token'], 10)
+        self.assertEqual({'appium_url': 'appium_url1', 'udid': 'udid1'}, context.exception.data['contended'])
+        # nothing is left locked by a failed attempt
+        token = self.service._signed_serializer.dumps(('appium_url2', 'udid1'), salt='capability')
+        with self.assertRaises(LockConflictException) as context:
+            self.service.lock_capability(token, 10)
+        self.assertEqual({'udid': 'udid1'}, context.exception.data['contended'])
+        self.assertFalse(self.service._appium_lock.is_lock('appium_url2'))
+
+    def test_query_result_is_cached_until_lock_changes(self):
+        caps = self.service.get_available_capabilities(platform_name='ios', min_platform_version='1')
+        self.assertIs(caps, self.service.get_available_capabilities(platform_name='ios', min_platform_version='1.0'))
+        self.service.lock_capability(caps[0]['capability_token'], 10)
+        self.assertEqual(1, len(self.service.get_available_capabilities(platform_name='ios', min_platform_version='1')))
+        stats = self.service.get_query_cache_stats()
+        self.assertEqual((1, 2), (stats['hits'], stats['misses']))
+
+
+class TestLockCapabilitiesInBatch(unittest.TestCase):
+    def setUp(self):
+        self.service = SeleniumGridService(secret='secret')
+        self.service.set_capabilities([
+            {"capabilities": {"platformName": "ios", "UDID": "udid1"}, "appium_url": "appium_url1"},
+            {"capabilities": {"platformName": "ios", "UDID": "udid2"}, "appium_url": "appium_url1"},
+            {"capabilities": {"platformName": "ios", "UDID": "udid3"}, "appium_url": "appium_url2"},
+            {"capabilities": {"platformName": "ios", "UDID": "udid4"}, "appium_url": "appium_url3"},
+        ])
+
+    @staticmethod
+    def get_locked(result):
+        return [(lock['capability']['appium_url'], lock['capability']['capabilities']['UDID'])
+                for lock in result['locks']]
+
+    def test_lock_by_query_on_distinct_appium_nodes(self):
+        result = self.service.lock_capabilities(10, platform_name='ios', count=5)
+        self.assertEqual([('appium_url1', 'udid1'), ('appium_url2', 'udid3'), ('appium_url3', 'udid4')],
+                         self.get_locked(result))
+        self.assertEqual([], self.service.get_available_capabilities(platform_name='ios'))
+
+        self.assertEqual([], self.service.release_capabilities(list(lock['token'] for lock in result['locks'])))
+        self.assertEqual(3, len(self.service.get_available_capabilities(platform_name='ios')))
+
+    def test_contended_capabilities_are_skipped(self):
+        caps = self.service.get_available_capabilities(platform_name='ios')
+        # locked by others after query
+        self.service._udid_lock.acquire('udid3', 10)
+        result = self.service.lock_capabilities(10, cap_tokens=list(c['capability_token'] for c in caps) + ['bad'])
+        self.assertEqual([('appium_url1', 'udid1'), ('appium_url3', 'udid4')], self.get_locked(result))
+        self.assertEqual(['bad', caps[1]['capability_token']], result['failed'])
+
+    def test_release_reports_unknown_tokens(self):
+        result = self.service.lock_capabilities(10, platform_name='ios', count=1)
+        self.assertEqual(['bad'], self.service.release_capabilities([result['locks'][0]['token'], 'bad']))
+        self.assertFalse(self.service._appium_lock.is_lock('appium_url1'))
+
+
+class TestTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.service = SeleniumGridService(secret='secret')
+        self.caps = [
+            {"capabilities": {"platformName": "ios", "UDID": "udid1"}, "appium_url": "appium_url1", "hub_url": "hub1"},
+            {"capabilities": {"platformName": "ios", "UDID": "udid2"}, "appium_url": "appium_url2", "hub_url": "hub1"},
+        ]
+        self.service.merge_hub_capabilities('hub1', self.caps)
+        serializer = self.service._signed_serializer
+        self.calls = []
+        for name in ('dumps', 'loads'):
+            def wrapper(*args, _f=getattr(serializer, name), _name=name, **kwargs):
+                self.calls.append(_name)
+                return _f(*args, **kwargs)
+            setattr(serializer, name, wrapper)
+
+    def test_capability_tokens_are_signed_on_ingest(self):
+        caps = self.service.get_available_capabilities(platform_name='ios')
+        self.assertEqual(2, len(caps))
+        self.service.lock_capability(caps[0]['capability_token'], 10)
+        self.assertEqual(['dumps'], self.calls)  # lock token only
+
+    def test_lock_token_is_verified_once(self):
+        caps = self.service.get_available_capabilities(platform_name='ios')
+        self.service.lock_capability(caps[0]['capability_token'], 10)
+        token = self.service.lock_capability(caps[1]['capability_token'], 10)
+        self.service.release_capability(token)
+        self.assertNotIn('loads', self.calls)
+        with self.assertRaises(LockNotFoundException):
+            self.service.release_capability('bad')
+
+    def test_tokens_are_evicted_with_capability(self):
+        cap_token = self.service.get_available_capabilities(platform_name='ios')[1]['capability_token']
+        self.service.lock_capability(cap_token, 1)
+        self.service.merge_hub_capabilities('hub1', self.caps[:1])
+        self.assertNotIn(('appium_url2', 'udid2'), self.service._capability_tokens)
+        self.assertNotIn(('capability', cap_token), self.service._verified_tokens)
+        self.assertIn(('appium_url1', 'udid1'), self.service._capability_tokens)
+
 
 class TestSimpleLockManager(unittest.TestCase):
     def setUp(self):
@@ -111,3 +267,417 @@ class TestSimpleLockManager(unittest.TestCase):
         self.lock.release_expired_keys()
         self.assertFalse(self.lock.is_lock('lock1'))
 
+    def test_release_and_extend_by_owner(self):
+        self.lock.acquire('lock1', expired=-1, owner='owner1')
+        self.assertFalse(self.lock.extend('lock1', 'owner1'))  # expired
+        self.lock.acquire('lock1', expired=self.expired, owner='owner2')
+        self.assertFalse(self.lock.release('lock1', 'owner1'))
+        self.assertTrue(self.lock.extend('lock1', 'owner2', expired=60))
+        self.assertGreater(self.lock.dump()['lock1'][0], time.time() + 30)
+        self.lock.acquire('lock1', expired=1, refresh=True)
+        self.assertEqual('owner2', self.lock.dump()['lock1'][1])
+        self.assertTrue(self.lock.release('lock1', 'owner2'))
+        self.assertFalse(self.lock.is_lock('lock1'))
+
+
+class TestMergeHubCapabilities(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.service = SeleniumGridService(hub_failure_grace_period=30)
+        self.service._get_current_time = lambda: self.now
+        self.caps = [{
+            "capabilities": {"platformName": "ios", "version": "1", "UDID": "udid1"},
+            "appium_url": "appium_url1",
+            "hub_url": "hub_url1",
+        }]
+
+    def test_keep_capabilities_of_failed_hub_within_grace_period(self):
+        self.service.merge_hub_capabilities('hub_url1', self.caps)
+        self.now += 30
+        self.assertIsNone(self.service.merge_hub_capabilities('hub_url1', None))
+        self.assertEqual(self.caps, self.service.get_all_capabilities())
+        self.now += 1
+        change_set = self.service.merge_hub_capabilities('hub_url1', None)
+        self.assertEqual(1, len(change_set.removed))
+        self.assertEqual([], self.service.get_all_capabilities())
+
+
+class TestHubPolling(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.service = SeleniumGridService(secret='secret')
+        self.hub_urls = ['hub1', 'hub2']
+        self.results = {'hub1': [], 'hub2': None}
+        self.polled = []
+        self.service.get_all_hubs_url = lambda: self.hub_urls
+
+        async def fetch(hub_url, timeout):
+            self.polled.append(hub_url)
+            return self.results[hub_url]
+        self.service._fetch_hub_capabilities = fetch
+
+    def poll(self, hub_url):
+        state = self.service._hub_polls[hub_url]
+        self.io_loop.remove_timeout(state.handle)
+        return self.service._poll_hub(hub_url, state)
+
+    @tornado.testing.gen_test
+    def test_every_hub_is_polled_on_its_own(self):
+        self.service.sync_hub_polls()
+        yield self.poll('hub1')
+        yield self.poll('hub2')
+        self.assertEqual(['hub1', 'hub2'], self.polled)
+        stats = self.service.get_hub_poll_stats()
+        self.assertEqual(0, stats['hub1']['failures'])
+        self.assertIsNotNone(stats['hub1']['last_success'])
+        self.assertEqual(1, stats['hub2']['failures'])
+        self.assertIsNone(stats['hub2']['last_success'])
+
+        self.hub_urls = ['hub1']
+        self.service.sync_hub_polls()
+        self.assertEqual(['hub1'], list(self.service.get_hub_poll_stats()))
+
+
+class FakeSeleniumGridClient(object):
+    def __init__(self, hub_details):
+        self.hub_details = hub_details  # k: hub_url, v: detail of the hub, missing for failure
+
+    @tornado.gen.coroutine
+    def get_devices_by_hub_url_async(self, hub_url, timeout=20):
+        if hub_url not in self.hub_details:
+            raise IOError('connection refused')
+        return mock.Mock(body=json.dumps(self.hub_details[hub_url]).encode())
+
+
+class TestFetchHubCapabilities(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        node = {
+            'id': 'http://appium1:4723/wd/hub',
+            'protocols': {'web_driver': {'browsers': {'': {
+                'name': '', 'version': '',
+                'ios': [{'capabilities': {'platformName': 'ios', 'UDID': 'udid1'}}],
+            }}}},
+        }
+        self.client = FakeSeleniumGridClient({
+            'http://hub1:4444/console': {'nodes': [node, {'id': 'http://appium2:4723', 'protocols': {}}]},
+        })
+        self.service = SeleniumGridService(secret='secret', selenium_grid_client=self.client)
+        self.service.get_all_hubs_url = lambda: ['http://hub1:4444/console', 'http://hub2:4444']
+
+    @tornado.testing.gen_test
+    def test_malformed_node_is_skipped(self):
+        caps = yield self.service._fetch_hub_capabilities('http://hub1:4444/console')
+        self.assertEqual([{
+            'capabilities': {'platformName': 'ios', 'UDID': 'udid1'},
+            'appium_url': 'http://appium1:4723/',
+            'hub_url': 'http://hub1:4444/',
+        }], caps)
+        caps = yield self.service._fetch_hub_capabilities('http://hub2:4444')
+        self.assertIsNone(caps)
+
+    @tornado.testing.gen_test
+    def test_polled_capabilities_are_merged(self):
+        self.service.sync_hub_polls()
+        for hub_url, state in self.service._hub_polls.items():
+            self.io_loop.remove_timeout(state.handle)
+            yield self.service._poll_hub(hub_url, state)
+        self.assertEqual(['udid1'], list(cap['capabilities']['UDID'] for cap in self.service.get_all_capabilities()))
+        stats = self.service.get_hub_poll_stats()
+        self.assertEqual(0, stats['http://hub1:4444/console']['failures'])
+        self.assertEqual(1, stats['http://hub2:4444']['failures'])
+
+
+class TestAppiumSessionPolling(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.service = SeleniumGridService(secret='secret')
+        self.service.set_capabilities(list({
+            "capabilities": {"platformName": "ios", "UDID": "udid{}".format(i)},
+            "appium_url": "appium_url{}".format(i),
+        } for i in range(4)))
+        self.sessions = {}  # k: appium_url, v: sessions or None for failure, missing for no response
+        self.polled = []
+
+        async def fetch(appium_url, timeout):
+            self.polled.append(appium_url)
+            if appium_url not in self.sessions:
+                await Future()  # no response
+            return self.sessions[appium_url]
+        self.service._fetch_appium_sessions = fetch
+
+    def make_all_due(self):
+        for state, _ in self.service._appium_polls.values():
+            state.next_poll_at = 0
+
+    @tornado.testing.gen_test
+    def test_poll_in_bounded_window(self):
+        with mock.patch('services.selenium_grid.APPIUM_POLL_CONCURRENCY', 3):
+            yield self.service.refresh_capabilities_from_remote(5)
+            self.make_all_due()
+            self.io_loop.spawn_callback(self.service.refresh_capabilities_from_remote, 5)
+            yield tornado.gen.sleep(0.01)
+            self.assertEqual(3, len(self.polled))
+            result = yield self.service.refresh_capabilities_from_remote(5)
+            self.assertEqual(3, len(self.polled))
+            self.assertEqual({'due': 1, 'polled': 0, 'busy': 0, 'failed': 0}, result)
+
+    @tornado.testing.gen_test
+    def test_busy_node_is_locked_and_polled_first(self):
+        self.sessions = {
+            'appium_url0': [{'capabilities': {'UDID': 'udid0'}}],
+            'appium_url1': [],
+            'appium_url2': None,
+            'appium_url3': [],
+        }
+        yield self.service.refresh_capabilities_from_remote(5)
+        self.make_all_due()
+        result = yield self.service.refresh_capabilities_from_remote(5)
+        self.assertEqual({'due': 4, 'polled': 4, 'busy': 1, 'failed': 1}, result)
+        self.assertTrue(self.service._udid_lock.is_lock('udid0'))
+        stats = self.service.get_appium_poll_stats()
+        self.assertEqual(5, stats['appium_url0']['interval'])
+        self.assertLess(5, stats['appium_url1']['interval'])
+        self.assertEqual(1, stats['appium_url2']['failures'])
+
+        del self.polled[:]
+        with mock.patch('services.selenium_grid.APPIUM_POLL_CONCURRENCY', 1):
+            self.make_all_due()
+            yield self.service.refresh_capabilities_from_remote(5)
+        self.assertEqual(['appium_url0'], self.polled)
+
+    @tornado.testing.gen_test
+    def test_unreachable_node_is_skipped_while_circuit_is_open(self):
+        self.sessions = dict(('appium_url{}'.format(i), []) for i in range(4))
+        self.sessions['appium_url3'] = None
+        yield self.service.refresh_capabilities_from_remote(5)
+        for _ in range(3):
+            self.make_all_due()
+            yield self.service.refresh_capabilities_from_remote(5)
+        del self.polled[:]
+        self.make_all_due()
+        yield self.service.refresh_capabilities_from_remote(5)
+        self.assertEqual('open', self.service.get_appium_poll_stats()['appium_url3']['circuit'])
+        self.assertEqual(['appium_url0', 'appium_url1', 'appium_url2'], sorted(self.polled))
+
+
+class TestSimpleLockManagerExpiry(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.lock = SimpleLockManager()
+        self.lock.get_current_time = lambda: self.now
+        self.events = []
+        self.lock.add_listener(lambda e: self.events.append((e.type, e.key)))
+
+    def test_past_deadline_key_is_unlocked_before_sweep(self):
+        self.lock.acquire('lock1', expired=2)
+        self.now += 3
+        self.assertFalse(self.lock.is_lock('lock1'))
+        self.lock.acquire('lock1', expired=2)
+        self.assertEqual([('acquired', 'lock1'), ('expired', 'lock1'), ('acquired', 'lock1')], self.events)
+
+    def test_refreshed_key_is_not_expired_by_stale_deadline(self):
+        self.lock.acquire('lock1', expired=2)
+        self.lock.acquire('lock2', expired=2)
+        self.lock.acquire('lock1', expired=10, refresh=True)
+        self.now += 3
+        self.assertEqual(1, self.lock.release_expired_keys())
+        self.assertTrue(self.lock.is_lock('lock1'))
+        self.assertFalse(self.lock.is_lock('lock2'))
+        self.now += 10
+        self.assertEqual(1, self.lock.release_expired_keys())
+        self.assertEqual(0, self.lock.release_expired_keys())
+
+
+class TestSeleniumGridServiceWithSharedLock(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = new_lock_server()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def new_service(self):
+        service = SeleniumGridService(
+            secret='secret',
+            appium_lock=RedisLockManager.from_url(self.server.url, 'appium'),
+            udid_lock=RedisLockManager.from_url(self.server.url, 'udid'),
+        )
+        service.set_capabilities([
+            {"capabilities": {"platformName": "ios", "UDID": "udid1"}, "appium_url": "appium_url1"},
+            {"capabilities": {"platformName": "ios", "UDID": "udid2"}, "appium_url": "appium_url2"},
+        ])
+        return service
+
+    def test_lock_by_another_service_is_seen(self):
+        service1, service2 = self.new_service(), self.new_service()
+        caps = service1.get_available_capabilities(platform_name='ios')
+        self.assertEqual(2, len(caps))
+        service2.lock_capability(caps[0]['capability_token'], 10)
+        caps = service1.get_available_capabilities(platform_name='ios')
+        self.assertEqual(['udid2'], [c['capabilities']['UDID'] for c in caps])
+        snapshot = service1.get_capability_snapshot()
+        self.assertEqual([False, True], [c['free'] for c in snapshot])
+
+    def test_lock_is_extended_and_released_by_another_service(self):
+        service1, service2 = self.new_service(), self.new_service()
+        caps = service1.get_available_capabilities(platform_name='ios')
+        lock_token = service1.lock_capability(caps[0]['capability_token'], 10)
+        service2.extend_capability(lock_token, 60)
+        service2.release_capability(lock_token)
+        self.assertEqual(len(caps), len(service1.get_available_capabilities(platform_name='ios')))
+        with self.assertRaises(LockNotFoundException):
+            service2.extend_capability(lock_token, 60)
+
+    def test_lock_managers_replaced_on_startup(self):
+        service1, service2 = self.new_service(), self.new_service()
+        service2.set_lock_managers(SimpleLockManager(), SimpleLockManager())
+        available = len(service1.get_available_capabilities(platform_name='ios'))
+        caps = service2.get_available_capabilities(platform_name='ios')
+        service2.lock_capability(caps[0]['capability_token'], 10)
+        self.assertEqual(['udid2'], [c['capabilities']['UDID']
+                                     for c in service2.get_available_capabilities(platform_name='ios')])
+        self.assertEqual(available, len(service1.get_available_capabilities(platform_name='ios')))
+
+
+class TestWaitAndLockCapability(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.service = SeleniumGridService(secret='secret')
+        self.service.set_capabilities([
+            {"capabilities": {"platformName": "ios", "version": "11", "UDID": "udid1"}, "appium_url": "appium_url1"},
+            {"capabilities": {"platformName": "android", "version": "8", "UDID": "udid2"}, "appium_url": "appium_url2"},
+        ])
+
+    def wait(self, platform_name='ios', wait=5, **kwargs):
+        return self.service.wait_and_lock_capability(platform_name, timeout=10, wait=wait, **kwargs)
+
+    @tornado.testing.gen_test
+    def test_lock_available_capability_right_away(self):
+        locked = yield self.wait()
+        self.assertEqual('udid1', locked['capability']['capabilities']['UDID'])
+        self.assertTrue(self.service._udid_lock.is_lock('udid1'))
+
+    @tornado.testing.gen_test
+    def test_higher_priority_is_served_first(self):
+        locked = yield self.wait()
+        normal, high = self.wait(team='a'), self.wait(min_platform_version='10', priority='high', team='b')
+        yield tornado.gen.moment
+        self.service.release_capability(locked['token'])
+        yield high
+        self.assertFalse(normal.done())
+        self.assertEqual(1, self.service.get_wait_queue_stats()['teams']['a']['queued'])
+        self.service.cancel_waiting(normal)
+
+    @tornado.testing.gen_test
+    def test_queue_full(self):
+        self.service._waiters.max_team_size = 1
+        yield self.wait()
+        waiter = self.wait(team='a')
+        with self.assertRaises(WaitQueueFullException) as context:
+            self.wait(team='a')
+        self.assertEqual(429, context.exception.err_code)
+        self.service.cancel_waiting(waiter)
+
+    @tornado.testing.gen_test
+    def test_capability_is_reserved_for_waiters(self):
+        locked = yield self.wait()
+        cap_token = locked['capability']['capability_token']
+        waiter = self.wait()
+        yield tornado.gen.moment
+        self.service.release_capability(locked['token'])
+        # released, but not yet handed to the waiter
+        with self.assertRaises(LockConflictException) as context:
+            self.service.lock_capability(cap_token, 10)
+        self.assertTrue(context.exception.data['reserved'])
+        self.assertEqual([cap_token], self.service.lock_capabilities(10, cap_tokens=[cap_token])['failed'])
+        yield waiter
+
+    @tornado.testing.gen_test
+    def test_waiters_are_served_in_order_on_release(self):
+        locked = yield self.wait()
+        first, second = self.wait(), self.wait(min_platform_version='10')
+        yield tornado.gen.moment
+        self.assertFalse(first.done() or second.done())
+
+        self.service.release_capability(locked['token'])
+        locked = yield first
+        self.assertEqual('udid1', locked['capability']['capabilities']['UDID'])
+        self.assertFalse(second.done())
+
+        self.service.release_capability(locked['token'])
+        yield second
+
+    @tornado.testing.gen_test
+    def test_cancelled_waiters_of_different_queries_are_skipped(self):
+        locked = yield self.wait()
+        cancelled = [self.wait(), self.wait(min_platform_version='10')]
+        first, second = self.wait(max_platform_version='12'), self.wait()
+        yield tornado.gen.moment
+        for future in cancelled:
+            future.cancel()
+        self.service.release_capability(locked['token'])
+        # dispatched before done callbacks of the cancelled ones are run
+        self.service._dispatch_waiters()
+        self.assertTrue(first.done())
+        self.assertFalse(second.done())
+        self.assertEqual(1, len(self.service._waiters))
+        self.service.cancel_waiting(second)
+        yield first
+
+    @tornado.testing.gen_test
+    def test_waiter_is_not_woken_by_unmatched_capability(self):
+        locked = yield self.wait(platform_name='android')
+        waiter = self.wait(platform_name='ios', max_platform_version='10')
+        visited = []
+        self.service._lock_first_available = lambda query, timeout: visited.append(query)
+        self.service.release_capability(locked['token'])
+        yield tornado.gen.moment
+        self.assertFalse(waiter.done())
+        self.assertEqual([], visited)
+        self.service.cancel_waiting(waiter)
+
+    @tornado.testing.gen_test
+    def test_wait_for_new_capability(self):
+        waiter = self.wait(platform_name='ios', min_platform_version='12')
+        self.service.merge_hub_capabilities('hub_url1', [
+            {"capabilities": {"platformName": "ios", "version": "12.1", "UDID": "udid3"}, "appium_url": "appium_url3"},
+        ])
+        locked = yield waiter
+        self.assertEqual('udid3', locked['capability']['capabilities']['UDID'])
+
+    @tornado.testing.gen_test
+    def test_wait_timeout(self):
+        yield self.wait()
+        with self.assertRaises(WaitTimeoutException):
+            yield self.wait(wait=0.1)
+        self.assertEqual(0, len(self.service._waiters))
+
+
+class TestCapabilityEvents(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.service = SeleniumGridService(secret='secret')
+        self.cap = {"capabilities": {"platformName": "ios", "UDID": "udid1"}, "appium_url": "appium_url1"}
+        self.service.set_capabilities([self.cap])
+
+    @tornado.testing.gen_test
+    def test_snapshot_and_deltas(self):
+        subscriber = self.service.subscribe_capability_events()
+        self.assertEqual([{**self.cap, 'free': True}], self.service.get_capability_snapshot())
+
+        caps = self.service.get_available_capabilities(platform_name='ios')
+        token = self.service.lock_capability(caps[0]['capability_token'], 10)
+        self.service.release_capability(token)
+        self.service.set_capabilities([])
+        events, overflowed = yield subscriber.get()
+        self.assertFalse(overflowed)
+        self.assertEqual([
+            ('locked', {'appium_url': 'appium_url1'}),
+            ('locked', {'udid': 'udid1'}),
+            ('released', {'appium_url': 'appium_url1'}),
+            ('released', {'udid': 'udid1'}),
+            ('removed', {'hub_url': None, 'capabilities': [self.cap]}),
+        ], [(e.type, e.data) for e in events])
+
@@ -0,0 +1,138 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from utils.managers import LockConflictError
+from utils.shared_memory import SharedMemoryLockManager, SharedCapabilitySnapshot, LeaderElection
+
+
+class SharedMemoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_in_child(self, func):
+        """
+        run func in a forked process, :return: exit code of the child, 0 if func returns True
+        """
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = 0 if func() else 1
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        return os.WEXITSTATUS(status)
+
+
+class TestSharedMemoryLockManager(SharedMemoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.lock = SharedMemoryLockManager(os.path.join(self.dir, 'test.lock'), slots=8)
+
+    def test_acquire_and_release(self):
+        self.lock.acquire('a', 10)
+        self.assertTrue(self.lock.is_lock('a'))
+        with self.assertRaises(LockConflictError):
+            self.lock.acquire('a', 10)
+        self.lock.release('a')
+        self.assertFalse(self.lock.is_lock('a'))
+
+    def test_lock_expired(self):
+        self.lock.acquire('a', -1)
+        self.assertFalse(self.lock.is_lock('a'))
+        self.lock.acquire('a', 10)
+
+    def test_probe_chain_survives_release(self):
+        keys = list('key{}'.format(i) for i in range(8))
+        for key in keys:
+            self.lock.acquire(key, 10)
+        with self.assertRaises(RuntimeError):
+            self.lock.acquire('key8', 10)
+        self.lock.release('key0')
+        self.assertEqual([False] + [True] * 7, self.lock.is_lock_many(keys))
+        self.lock.acquire('key8', 10)
+        self.assertTrue(self.lock.is_lock('key8'))
+
+    def test_release_and_extend_by_owner(self):
+        self.lock.acquire_many(['a', 'b'], 10, owners=['owner1', None])
+        self.assertFalse(self.lock.release('a', 'owner2'))
+        self.assertFalse(self.lock.extend('b', 'owner1', 10))
+        self.assertTrue(self.lock.extend('a', 'owner1', -1))
+        self.assertFalse(self.lock.is_lock('a'))
+        self.lock.acquire('a', 10, owner='owner2')
+        self.assertFalse(self.lock.release('a', 'owner1'))
+        self.assertTrue(self.lock.release('a', 'owner2'))
+        self.assertTrue(self.lock.release('b'))
+
+    def test_acquire_many_is_all_or_nothing(self):
+        self.lock.acquire('b', 10)
+        with self.assertRaises(LockConflictError) as ctx:
+            self.lock.acquire_many(['a', 'b', 'c'], 10)
+        self.assertEqual(['b'], ctx.exception.keys)
+        self.assertEqual([False, True, False], self.lock.is_lock_many(['a', 'b', 'c']))
+
+    def test_open_keeps_locks_of_table_in_use(self):
+        self.lock.acquire('a', 10)
+        other = SharedMemoryLockManager(os.path.join(self.dir, 'test.lock'), slots=8)
+        self.assertTrue(self.lock.is_lock('a'))
+        self.assertTrue(other.is_lock('a'))
+        other.clear()
+        self.assertFalse(self.lock.is_lock('a'))
+        self.lock.acquire('a', 10)
+
+    def test_reopened_table_keeps_live_locks_only(self):
+        keys = list('key{}'.format(i) for i in range(8))
+        self.lock.acquire_many(keys[:4], 10, owners=['owner1'] * 4)
+        self.lock.acquire_many(keys[4:], -1)
+        self.lock.release('key0')
+        # e.g. reopened by a restarted process
+        restarted = SharedMemoryLockManager(os.path.join(self.dir, 'test.lock'), slots=8)
+        self.assertEqual([False, True, True, True, False, False, False, False], restarted.is_lock_many(keys))
+        self.assertTrue(restarted.release('key1', 'owner1'))
+        self.assertEqual(2, restarted.compact())
+        restarted.acquire_many(list('new{}'.format(i) for i in range(6)), 10)
+
+    def test_lock_is_shared_with_forked_process(self):
+        self.lock.acquire('a', 10)
+
+        def child():
+            if not self.lock.is_lock('a'):
+                return False
+            self.lock.acquire('b', 10)
+            return True
+
+        self.assertEqual(0, self.run_in_child(child))
+        self.assertTrue(self.lock.is_lock('b'))
+        with self.assertRaises(LockConflictError):
+            self.lock.acquire('b', 10)
+
+
+class TestSharedCapabilitySnapshot(SharedMemoryTestCase):
+    def test_load_if_changed(self):
+        path = os.path.join(self.dir, 'capabilities.json')
+        writer, reader = SharedCapabilitySnapshot(path), SharedCapabilitySnapshot(path)
+        self.assertIsNone(reader.load_if_changed())
+
+        writer.publish({'hub1': [{'appium_url': 'appium1'}]})
+        self.assertEqual({'hub1': [{'appium_url': 'appium1'}]}, reader.load_if_changed())
+        self.assertIsNone(reader.load_if_changed())
+
+        writer.publish({})
+        self.assertEqual({}, reader.load_if_changed())
+
+
+class TestLeaderElection(SharedMemoryTestCase):
+    def test_only_one_leader(self):
+        path = os.path.join(self.dir, 'leader')
+        election = LeaderElection(path)
+        self.assertFalse(election.is_leader)
+        self.assertTrue(election.try_acquire())
+        self.assertTrue(election.is_leader)
+
+        # record locks are owned by process, a forked child could not take over
+        self.assertEqual(0, self.run_in_child(lambda: not LeaderElection(path).try_acquire()))
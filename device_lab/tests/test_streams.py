@@ -0,0 +1,37 @@
+import tornado.testing
+
+from utils.streams import EventBroadcaster, ServerSentEvent
+
+
+class TestEventBroadcaster(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.broadcaster = EventBroadcaster()
+
+    @tornado.testing.gen_test
+    def test_events_are_fanned_out(self):
+        subscriber1, subscriber2 = self.broadcaster.subscribe(), self.broadcaster.subscribe()
+        event = ServerSentEvent('added', {'udid': 'udid1'})
+        self.broadcaster.publish(event)
+        self.assertEqual(([event], False), (yield subscriber1.get()))
+        self.assertEqual(([event], False), (yield subscriber2.get()))
+        self.assertEqual(b'event: added\ndata: {"udid": "udid1"}\n\n', event.encode())
+
+    @tornado.testing.gen_test
+    def test_buffer_is_bounded(self):
+        subscriber = self.broadcaster.subscribe(max_size=2)
+        for i in range(3):
+            self.broadcaster.publish(ServerSentEvent('added', i))
+        self.assertEqual(([], True), (yield subscriber.get()))
+        self.broadcaster.publish(ServerSentEvent('added', 3))
+        events, overflowed = yield subscriber.get()
+        self.assertEqual(([3], False), ([e.data for e in events], overflowed))
+
+    @tornado.testing.gen_test
+    def test_get_timeout(self):
+        subscriber = self.broadcaster.subscribe()
+        self.assertEqual(([], False), (yield subscriber.get(0.01)))
+        self.broadcaster.unsubscribe(subscriber)
+        self.assertEqual(0, len(self.broadcaster))
+        yield subscriber.get()
+        self.assertTrue(subscriber.closed)
@@ -0,0 +1,69 @@
+import tornado.gen
+from tornado.gen import convert_yielded
+import tornado.testing
+from tornado.concurrent import Future
+
+from utils.tasks import PeriodicTask, FetchPool, CycleResult
+
+
+class TestFetchPool(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_bounded_concurrency(self):
+        pool = FetchPool(2)
+        futures = dict((i, Future()) for i in range(3))
+        started = []
+
+        async def fetch(i):
+            started.append(i)
+            return await futures[i]
+
+        result = convert_yielded(pool.map(fetch, [0, 1, 2]))
+        yield tornado.gen.sleep(0.01)
+        self.assertEqual([0, 1], started)
+        self.assertEqual(2, pool.running)
+        futures[1].set_exception(IOError('refused'))
+        yield tornado.gen.sleep(0.01)
+        self.assertEqual([0, 1, 2], started)
+        futures[0].set_result('a')
+        futures[2].set_result('c')
+        result = yield result
+        self.assertEqual('a', result[0])
+        self.assertIsInstance(result[1], IOError)
+        self.assertEqual('c', result[2])
+        self.assertEqual(0, pool.running)
+
+
+class TestPeriodicTask(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    def test_slow_cycle_is_not_stacked_and_cancelled(self):
+        calls = []
+
+        async def run():
+            calls.append(len(calls))
+            if len(calls) == 1:
+                await Future()  # never done
+            return len(calls)
+
+        task = PeriodicTask('test', run, period=0.02, timeout=0.05)
+        task.start()
+        yield tornado.gen.sleep(0.09)
+        task.stop()
+        stats = task.get_stats()
+        self.assertLessEqual(2, stats['skipped'])
+        self.assertEqual(CycleResult.CANCELLED, stats['cycles'][0]['outcome'])
+        self.assertLessEqual(2, len(stats['cycles']))
+        self.assertEqual(CycleResult.OK, stats['cycles'][1]['outcome'])
+        self.assertEqual(2, stats['cycles'][1]['result'])
+
+    @tornado.testing.gen_test
+    def test_failure_is_recorded(self):
+        def run():
+            raise ValueError('bad')
+
+        task = PeriodicTask('test', run, period=1)
+        task.start()
+        yield tornado.gen.sleep(0.01)
+        task.stop()
+        cycle = task.get_stats()['cycles'][0]
+        self.assertEqual((CycleResult.FAILED, 'bad'), (cycle['outcome'], cycle['error']))
+        self.assertFalse(task.running)
@@ -0,0 +1,86 @@
+import unittest
+
+from utils.waiters import WaiterQueue, QueueFullError
+
+
+class TestWaiterQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = WaiterQueue()
+
+    def test_first_come_first_served(self):
+        first = self.queue.add('f1', 'ios', 1)
+        self.queue.add('f1', 'ios', 2)
+        self.assertIs(first, self.queue.peek('f1'))
+        self.assertEqual([1, 2], [self.queue.pop('f1').payload, self.queue.pop('f1').payload])
+        self.assertFalse(self.queue.has_waiter('f1'))
+
+    def test_filters_are_indexed(self):
+        self.queue.add('f1', 'ios', 1)
+        self.queue.add('f2', 'ios', 2)
+        self.queue.add('f3', 'android', 3)
+        self.assertEqual({'f1', 'f2'}, set(self.queue.get_filter_keys(['ios'])))
+        self.assertEqual({'f1', 'f2', 'f3'}, set(self.queue.get_filter_keys()))
+        self.queue.pop('f3')
+        self.assertEqual([], self.queue.get_filter_keys(['android']))
+
+    def test_remove(self):
+        first = self.queue.add('f1', 'ios', 1)
+        second = self.queue.add('f1', 'ios', 2)
+        self.assertTrue(self.queue.remove(second))
+        self.assertFalse(self.queue.remove(second))
+        self.assertEqual(1, len(self.queue))
+        self.assertTrue(self.queue.remove(first))
+        self.assertEqual(0, len(self.queue))
+        self.assertEqual([], self.queue.get_filter_keys())
+
+    def test_higher_priority_first(self):
+        self.queue.add('f1', 'ios', 1, priority='low')
+        self.queue.add('f1', 'ios', 2)
+        self.queue.add('f1', 'ios', 3, priority='high')
+        self.assertEqual([3, 2, 1], list(self.queue.pop('f1').payload for _ in range(3)))
+
+    def test_fair_share_between_teams(self):
+        self.queue.team_weights = {'b': 2}
+        for i in range(4):
+            self.queue.add('f1', 'ios', 'a{}'.format(i), team='a')
+        for i in range(4):
+            self.queue.add('f1', 'ios', 'b{}'.format(i), team='b')
+        served = list(self.queue.pop('f1').payload for _ in range(6))
+        self.assertEqual(['b0', 'a0', 'b1', 'b2', 'a1', 'b3'], served)
+        # a team arriving later does not catch up with the time it was absent
+        self.queue.add('f1', 'ios', 'c0', team='c')
+        self.assertEqual('c0', self.queue.peek('f1').payload)
+
+    def test_cancelled_waiters_do_not_count_against_team(self):
+        for i in range(3):
+            self.queue.remove(self.queue.add('f1', 'ios', 'a{}'.format(i), team='a'))
+        self.assertEqual({}, self.queue._finish_tags)
+        self.queue.add('f1', 'ios', 'a3', team='a')
+        self.queue.add('f1', 'ios', 'b0', team='b')
+        # not penalised for the cancelled ones, first come first served
+        self.assertEqual(['a3', 'b0'], [self.queue.pop('f1').payload, self.queue.pop('f1').payload])
+        self.assertEqual({}, self.queue._finish_tags)
+
+    def test_queue_is_bounded(self):
+        self.queue.max_size, self.queue.max_team_size = 3, 2
+        self.queue.add('f1', 'ios', 1, team='a')
+        waiter = self.queue.add('f2', 'ios', 2, team='a')
+        with self.assertRaises(QueueFullError):
+            self.queue.add('f1', 'ios', 3, team='a')
+        self.queue.add('f1', 'ios', 3, team='b')
+        with self.assertRaises(QueueFullError) as context:
+            self.queue.add('f1', 'ios', 4, team='c')
+        self.assertEqual(3, context.exception.queued)
+        self.queue.remove(waiter)
+        self.queue.add('f1', 'ios', 4, team='a')
+
+    def test_stats(self):
+        self.queue.get_current_time = lambda: 100.0
+        self.queue.add('f1', 'ios', 1, team='a', priority='high')
+        self.queue.get_current_time = lambda: 110.0
+        self.queue.add('f2', 'ios', 2, team='a')
+        self.queue.remove(self.queue.add('f2', 'ios', 3, team='b'))
+        stats = self.queue.get_stats()
+        self.assertEqual(2, stats['queued'])
+        self.assertEqual({'high': 1, 'normal': 1, 'low': 0}, stats['priorities'])
+        self.assertEqual({'a': {'queued': 2, 'max_wait': 10.0}}, stats['teams'])
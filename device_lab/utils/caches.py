@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+
+class GenerationCache(object):
+    """
+    cache computed results by key until the generation moves, then all of them are dropped at once
+
+    cached results are shared between callers and should be treated as read-only
+    it is not thread-safe, use it in the IOLoop thread only
+    """
+
+    def __init__(self, max_size=1024):
+        self._max_size = max_size
+        self._generation = 0
+        self._results = {}  # k: key, v: result computed in current generation
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def bump(self):
+        self._generation += 1
+        self._results.clear()
+
+    def get_or_compute(self, key, compute):
+        try:
+            result = self._results[key]
+        except KeyError:
+            pass
+        else:
+            self._hits += 1
+            return result
+        self._misses += 1
+        generation = self._generation
+        result = compute()
+        # result computed before generation moved is stale, return it without caching
+        if generation == self._generation:
+            if len(self._results) >= self._max_size:
+                del self._results[next(iter(self._results))]
+            self._results[key] = result
+        return result
+
+    def get_stats(self):
+        return {
+            'generation': self._generation,
+            'size': len(self._results),
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+
+class LRUCache(object):
+    """
+    bounded mapping, the least recently used item is evicted once it is full
+
+    it is not thread-safe, use it in the IOLoop thread only
+    """
+
+    def __init__(self, max_size=1024):
+        self._max_size = max_size
+        self._items = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            self._misses += 1
+            return default
+        self._hits += 1
+        return self._items[key]
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self._max_size:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._items.pop(key, default)
+
+    def clear(self):
+        self._items.clear()
+
+    def get_stats(self):
+        return {
+            'size': len(self._items),
+            'hits': self._hits,
+            'misses': self._misses,
+        }
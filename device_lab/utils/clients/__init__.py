@@ -0,0 +1,22 @@
+import logging
+
+from tornado.httpclient import AsyncHTTPClient
+
+try:
+    import pycurl  # noqa: F401
+except ImportError:  # only required to keep connections alive
+    pycurl = None
+
+logger = logging.getLogger(__name__)
+
+
+def configure_http_client(max_clients):
+    """
+    AsyncHTTPClient is shared by all clients of an IOLoop, configure it before it is created,
+    curl based one is preferred as it keeps connections to hubs and appium nodes alive between polls
+    """
+    if pycurl is not None:
+        AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient', max_clients=max_clients)
+    else:
+        logger.warning('pycurl is not installed, connections to hubs and appium nodes are not kept alive')
+        AsyncHTTPClient.configure(None, max_clients=max_clients)
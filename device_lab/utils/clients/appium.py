@@ -1,20 +1,36 @@
+import time
 from urllib.parse import urljoin
 
 import tornado.gen
 from tornado.httpclient import AsyncHTTPClient
 
+from utils.metrics import registry
+
+FETCH_DURATION = registry.histogram(
+    'device_lab_appium_fetch_duration_seconds', 'Time taken to fetch sessions from appium nodes',
+    labelnames=('outcome',))
+
 
 class AppiumClient(object):
     def __init__(self, http=None):
-        self._http = AsyncHTTPClient() if http is None else http  # type: AsyncHTTPClient
+        # NOTE: AsyncHTTPClient is bound to current IOLoop, create it on use so that the client could be
+        # constructed before IOLoop is created (e.g. before forking worker processes)
+        self._http = http  # type: AsyncHTTPClient
 
     @tornado.gen.coroutine
-    def get_sessions(self, appium_url):
+    def get_sessions(self, appium_url, timeout=20):
         """
         get all devices under specific hub
         :param hub_url:
+        :param timeout: seconds for the whole request
         :return: devices' configuration and status
         """
         api_url = urljoin(appium_url, 'wd/hub/sessions')
-        res = yield self._http.fetch(api_url)
+        # NOTE: nodes are not labelled, there may be hundreds of them
+        started, outcome = time.perf_counter(), 'error'
+        try:
+            res = yield (self._http or AsyncHTTPClient()).fetch(api_url, request_timeout=timeout)
+            outcome = 'success'
+        finally:
+            FETCH_DURATION.labels(outcome).observe(time.perf_counter() - started)
         return res
@@ -0,0 +1,42 @@
+import time
+from urllib.parse import urljoin
+
+import tornado.gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from utils.metrics import registry
+
+# requests carrying this header are served by the receiving node itself instead of being routed again
+FORWARDED_HEADER = 'X-Device-Lab-Forwarded'
+
+FETCH_DURATION = registry.histogram(
+    'device_lab_cluster_fetch_duration_seconds', 'Time taken by requests forwarded to other cluster nodes',
+    labelnames=('outcome',))
+
+
+class ClusterClient(object):
+    def __init__(self, http=None):
+        # NOTE: AsyncHTTPClient is bound to current IOLoop, create it on use so that the client could be
+        # constructed before IOLoop is created (e.g. before forking worker processes)
+        self._http = http  # type: AsyncHTTPClient
+
+    @tornado.gen.coroutine
+    def fetch(self, node_url, uri, method='GET', body=None, timeout=5):
+        """
+        send a request to another node of the cluster
+        :param node_url: origin of the node
+        :param uri: path and query of the request
+        :param timeout: seconds for the whole request
+        :return: response of any status code, it raises only if the node fails to answer
+        """
+        request = HTTPRequest(urljoin(node_url, uri), method=method, body=body, headers={FORWARDED_HEADER: '1'},
+                              request_timeout=timeout, allow_nonstandard_methods=True)
+        started, outcome = time.perf_counter(), 'error'
+        try:
+            res = yield (self._http or AsyncHTTPClient()).fetch(request, raise_error=False)
+            if res.code == 599:
+                raise res.error  # connection failure is returned instead of raised by some versions
+            outcome = 'success'
+        finally:
+            FETCH_DURATION.labels(outcome).observe(time.perf_counter() - started)
+        return res
@@ -0,0 +1,133 @@
+import bisect
+import hashlib
+
+
+class HashRing(object):
+    """
+    consistent hashing of keys onto nodes, every node is placed on the ring at `replicas` points,
+    a key belongs to the node of the first point at or after its hash
+
+    adding a node takes over only the keys of the arcs before its points, and removing one hands only its keys
+    to the nodes next to them, the others stay where they are
+    """
+
+    def __init__(self, nodes=(), replicas=128):
+        self.replicas = replicas
+        self._nodes = set()
+        self._points = []  # sorted hashes of points
+        self._point_nodes = []  # node of each point, aligned with _points
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    @property
+    def nodes(self):
+        return sorted(self._nodes)
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def add(self, node):
+        """
+        :return: False if the node is on the ring already
+        """
+        if node in self._nodes:
+            return False
+        self._nodes.add(node)
+        for i in range(self.replicas):
+            point = self.hash('{}#{}'.format(node, i))
+            index = bisect.bisect_left(self._points, point)
+            self._points.insert(index, point)
+            self._point_nodes.insert(index, node)
+        return True
+
+    def remove(self, node):
+        """
+        :return: False if the node is not on the ring
+        """
+        if node not in self._nodes:
+            return False
+        self._nodes.discard(node)
+        kept = list((point, point_node) for point, point_node in zip(self._points, self._point_nodes)
+                    if point_node != node)
+        self._points = list(point for point, _ in kept)
+        self._point_nodes = list(point_node for _, point_node in kept)
+        return True
+
+    def get_node(self, key):
+        """
+        :return: the node owning the key, None if the ring is empty
+        """
+        if not self._points:
+            return None
+        index = bisect.bisect_left(self._points, self.hash(key)) % len(self._points)
+        return self._point_nodes[index]
+
+
+class ClusterMembership(object):
+    """
+    nodes of a cluster sharing keys (hubs) by a hash ring, as seen by one of them (`self_url`)
+
+    every configured node is on the ring until it fails `failure_threshold` health checks in a row,
+    it is put back once it answers again, so that each node converges on the same ring as long as
+    they see the same peers, listeners are called without argument whenever the ring changes
+
+    :param node_urls: origins of all nodes, e.g. http://10.0.0.1:8888, this node included or not
+    """
+
+    def __init__(self, self_url, node_urls, replicas=128, failure_threshold=3):
+        self.self_url = self_url
+        self.node_urls = sorted(set(node_urls) | {self_url})
+        self.failure_threshold = failure_threshold
+        self._ring = HashRing(self.node_urls, replicas)
+        self._failures = {}  # k: peer url, v: consecutive failed checks
+        self._listeners = []
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def get_owner(self, key):
+        return self._ring.get_node(key)
+
+    def get_remote_owner(self, key):
+        """
+        :return: url of the peer owning the key, None if it is owned by this node
+        """
+        owner = self._ring.get_node(key)
+        return None if owner == self.self_url else owner
+
+    def is_local(self, key):
+        return self.get_remote_owner(key) is None
+
+    def get_peers(self, alive_only=True):
+        return list(node_url for node_url in self.node_urls
+                    if node_url != self.self_url and (not alive_only or node_url in self._ring))
+
+    def on_check(self, node_url, success):
+        """
+        record a health check of a peer
+        :return: True if the ring is changed by it
+        """
+        if success:
+            self._failures.pop(node_url, None)
+            changed = self._ring.add(node_url)
+        else:
+            self._failures[node_url] = self._failures.get(node_url, 0) + 1
+            changed = self._failures[node_url] >= self.failure_threshold and self._ring.remove(node_url)
+        if changed:
+            for listener in self._listeners:
+                listener()
+        return changed
+
+    def get_stats(self):
+        return {
+            'self': self.self_url,
+            'nodes': dict((node_url, {'alive': node_url in self._ring, 'failures': self._failures.get(node_url, 0)})
+                          for node_url in self.node_urls),
+        }
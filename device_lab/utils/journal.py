@@ -0,0 +1,189 @@
+import os
+import gzip
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from utils.managers import BaseLockManager
+from utils.misc import new_random_string
+
+logger = logging.getLogger(__name__)
+
+
+class LockJournal(object):
+    """
+    lock state of in-process lock managers kept in an append-only journal and a compacted snapshot
+
+    lock events are buffered and appended in batch by a single writer thread, so that no request waits for disk,
+    once the journal grows over `compact_threshold` records, the current lock state is written as the snapshot
+    and the journal is started over
+    on startup the snapshot is loaded and the journal is replayed on top of it, locks past expiry are dropped
+
+    NOTE: records buffered at a crash are lost, and appends are not fsync-ed, they survive restart of the process
+    but not of the host
+    """
+    SNAPSHOT_NAME = 'locks.snapshot'
+    JOURNAL_NAME = 'locks.journal'
+
+    def __init__(self, directory, flush_interval=0.05, compact_threshold=10000, executor=None):
+        os.makedirs(directory, exist_ok=True)
+        self._snapshot_path = os.path.join(directory, self.SNAPSHOT_NAME)
+        self._journal_path = os.path.join(directory, self.JOURNAL_NAME)
+        self._flush_interval = flush_interval
+        self._compact_threshold = compact_threshold
+        # NOTE: records are written in order by one thread
+        self._executor = executor or ThreadPoolExecutor(max_workers=1)
+        self._managers = {}  # k: namespace, v: lock manager
+        self._loaded = None  # k: namespace, v: {key: [expired_at, owner]}, loaded on first restore
+        self._buffer = []  # records not yet handed to the writer
+        self._flush_scheduled = False
+        self._records = 0  # records in the journal since last compaction
+        self._journal_file = None  # opened by the writer
+
+    def restore(self, namespace, manager):
+        """
+        restore lock state of the namespace into the manager, and journal its changes from now on
+        """
+        if self._loaded is None:
+            self._loaded = self._load()
+        manager.restore(self._loaded.pop(namespace, {}))
+        self._managers[namespace] = manager
+        manager.add_listener(lambda event: self._append(namespace, event))
+
+    def flush(self):
+        """
+        hand buffered records to the writer, or write a snapshot instead if the journal has grown too long
+
+        :return: Future done when they are written
+        """
+        self._flush_scheduled = False
+        records, self._buffer = self._buffer, []
+        if self._records + len(records) > self._compact_threshold:
+            # buffered records are covered by the snapshot
+            self._records = 0
+            locks = dict((namespace, manager.dump()) for namespace, manager in self._managers.items())
+            return self._run(self._write_snapshot, locks)
+        if not records:
+            future = Future()
+            future.set_result(None)
+            return future
+        self._records += len(records)
+        return self._run(self._write_records, records)
+
+    def _append(self, namespace, event):
+        if event.type in (BaseLockManager.ACQUIRED, BaseLockManager.REFRESHED):
+            self._buffer.append([namespace, event.key, event.expired_at, event.owner])
+        else:
+            self._buffer.append([namespace, event.key, None, None])
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            IOLoop.current().call_later(self._flush_interval, self.flush)
+
+    def _run(self, func, *args):
+        return IOLoop.current().run_in_executor(self._executor, func, *args)
+
+    def _load(self):
+        locks = {}
+        try:
+            with open(self._snapshot_path) as f:
+                locks = json.load(f)['locks']
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self._journal_path) as f:
+                for line in f:
+                    try:
+                        # records written before owners were kept have no owner
+                        namespace, key, expired_at, owner = (json.loads(line) + [None])[:4]
+                    except (ValueError, TypeError):
+                        logger.warning('skip broken record of lock journal: %s', line)
+                        continue  # e.g. partially written at a crash
+                    self._records += 1
+                    if expired_at is None:
+                        locks.get(namespace, {}).pop(key, None)
+                    else:
+                        locks.setdefault(namespace, {})[key] = [expired_at, owner]
+        except FileNotFoundError:
+            pass
+        return locks
+
+    # following methods are run by the writer
+    def _write_records(self, records):
+        if self._journal_file is None:
+            self._journal_file = open(self._journal_path, 'a')
+        self._journal_file.write(''.join(json.dumps(record) + '\n' for record in records))
+        self._journal_file.flush()
+
+    def _write_snapshot(self, locks):
+        tmp_path = self._snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'locks': locks}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+        if self._journal_file is not None:
+            self._journal_file.close()
+        self._journal_file = open(self._journal_path, 'w')
+
+
+class CapabilitySnapshotFile(object):
+    """
+    last known capabilities kept in a gzipped json file, so that a restarted process serves them
+    before its first polls are done
+
+    the file is written by a single writer thread and replaced atomically by rename
+    """
+
+    def __init__(self, path, executor=None):
+        self.path = path
+        self._executor = executor or ThreadPoolExecutor(max_workers=1)
+
+    def load(self):
+        """
+        :return: (time it is saved at, k: hub_url, v: capabilities of the hub), None if there is no valid one
+        """
+        try:
+            with gzip.open(self.path, 'rt') as f:
+                snapshot = json.load(f)
+            return snapshot['saved_at'], snapshot['hubs']
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError, EOFError) as e:
+            logger.warning('skip broken capability snapshot: %s, %s', self.path, str(e))
+            return None
+
+    def save(self, hub_caps):
+        """
+        :return: Future done when it is written
+        """
+        return IOLoop.current().run_in_executor(self._executor, self._write, time.time(), hub_caps)
+
+    # following method is run by the writer
+    def _write(self, saved_at, hub_caps):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with gzip.open(tmp_path, 'wt', compresslevel=6) as f:
+            json.dump({'saved_at': saved_at, 'hubs': hub_caps}, f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+
+def load_or_create_secret(path, length=20):
+    """
+    signing key kept in a file readable by its owner only, so that tokens stay valid across restarts
+    """
+    try:
+        with open(path) as f:
+            secret = f.read().strip()
+        if secret:
+            return secret
+    except FileNotFoundError:
+        pass
+    secret = new_random_string(length)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        f.write(secret)
+    return secret
@@ -1,50 +1,419 @@
 import time
 import uuid
+import heapq
 import logging
+import itertools
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+
+from utils.misc import parse_version, is_string_in_partially
+from utils.metrics import registry
+
+try:
+    import redis
+except ImportError:  # only required by RedisLockManager
+    redis = None
 
 logger = logging.getLogger(__name__)
 
+LOCK_SWEEP_DURATION = registry.histogram(
+    'device_lab_lock_sweep_duration_seconds', 'Time taken to release expired keys of in-process lock managers',
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+LOCK_EXPIRED = registry.counter(
+    'device_lab_lock_expired_total', 'Keys released by in-process lock managers because they are expired')
+
+LockEvent = namedtuple('LockEvent', ['type', 'key', 'expired_at', 'owner'])
+LockEvent.__new__.__defaults__ = (None, None)
+
+
+class LockConflictError(RuntimeError):
+    def __init__(self, keys):
+        super().__init__("cannot lock: {}".format(', '.join(str(key) for key in keys)))
+        self.keys = keys  # contended keys
+
+
+def acquire_all(requests, expired=5, owners=None):
+    """
+    acquire keys from different lock managers, all or nothing
+    :param requests: list of (lock_manager, key)
+    :param owners: owner of each request, see `BaseLockManager.acquire`
+    :raise LockConflictError: nothing is locked, keys of the error are the contended (lock_manager, key)
+    """
+    groups = []  # list of (lock_manager, keys, owners), keep the order of requests
+    for (manager, key), owner in zip(requests, owners or [None] * len(requests)):
+        for group_manager, keys, group_owners in groups:
+            if group_manager is manager:
+                keys.append(key)
+                group_owners.append(owner)
+                break
+        else:
+            groups.append((manager, [key], [owner]))
+
+    # check all of them first, so that every contended key is reported
+    contended = []
+    for manager, keys, _ in groups:
+        contended.extend((manager, key) for key, locked in zip(keys, manager.is_lock_many(keys)) if locked)
+    if contended:
+        raise LockConflictError(contended)
+
+    acquired = []
+    for manager, keys, group_owners in groups:
+        try:
+            manager.acquire_many(keys, expired=expired, owners=group_owners)
+        except LockConflictError as e:
+            # locked by others in between (shared backend only), roll back
+            for acquired_manager, acquired_keys, acquired_owners in acquired:
+                acquired_manager.release_many(acquired_keys, acquired_owners)
+            raise LockConflictError(list((manager, key) for key in e.keys))
+        acquired.append((manager, keys, group_owners))
+
+
+class BaseLockManager(object):
+    """
+    interface of lock backends, a key is locked exclusively until it is released or expired
+    """
+    ACQUIRED = 'acquired'
+    REFRESHED = 'refreshed'
+    RELEASED = 'released'
+    EXPIRED = 'expired'
+
+    # True if every change of lock state goes through this instance, so that listeners see all of them
+    # a shared backend only reports changes made by this process, and lock state should be checked by is_lock
+    local = True
 
-class SimpleLockManager(object):
     def __init__(self):
-        self._lock = {}  # k: key, v: expired_at
+        self._listeners = []
 
     @staticmethod
     def get_current_time():
         return time.time()
 
-    def acquire(self, key, expired=5, refresh=False):
+    def add_listener(self, listener):
+        """
+        listener will be called with a LockEvent whenever a key is acquired, refreshed, released or expired
+        """
+        self._listeners.append(listener)
+
+    def acquire(self, key, expired=5, refresh=False, owner=None):
+        """
+        :param expired: seconds to hold the lock
+        :param refresh: if True, a locked key is extended instead of raising LockConflictError, its owner is kept
+        :param owner: id of the lock holder, required by `extend` and checked by `release`
+        """
+        raise NotImplementedError
+
+    def release(self, key, owner=None):
+        """
+        :param owner: if given, the key is released only if it is held by the owner
+        :return: True if the key is released
+        """
+        raise NotImplementedError
+
+    def extend(self, key, owner, expired=5):
+        """
+        hold the key for `expired` seconds from now, only if it is held by the owner
+        :return: True if the key is extended
+        """
+        raise NotImplementedError
+
+    def is_lock(self, key):
+        raise NotImplementedError
+
+    def is_lock_many(self, keys):
+        return list(self.is_lock(key) for key in keys)
+
+    def acquire_many(self, keys, expired=5, owners=None):
+        """
+        acquire all keys or none of them
+        :param owners: owner of each key
+        :raise LockConflictError: with the contended keys
+        """
+        owners = owners or [None] * len(keys)
+        contended = list(key for key, locked in zip(keys, self.is_lock_many(keys)) if locked)
+        if contended:
+            raise LockConflictError(contended)
+        acquired = []
+        try:
+            for key, owner in zip(keys, owners):
+                self.acquire(key, expired=expired, owner=owner)
+                acquired.append((key, owner))
+        except LockConflictError:
+            for key, owner in acquired:
+                self.release(key, owner)
+            raise
+
+    def release_many(self, keys, owners=None):
+        """
+        :param owners: owner of each key, see `release`
+        :return: whether each key is released
+        """
+        return list(self.release(key, owner) for key, owner in zip(keys, owners or [None] * len(keys)))
+
+    def release_expired_keys(self):
+        """
+        :return: number of released keys
+        """
+        return 0
+
+    def _emit(self, type_, key, expired_at=None, owner=None):
+        event = LockEvent(type_, key, expired_at, owner)
+        for listener in self._listeners:
+            listener(event)
+
+
+class SimpleLockManager(BaseLockManager):
+    def __init__(self):
+        super().__init__()
+        self._lock = {}  # k: key, v: expired_at
+        self._owners = {}  # k: key, v: owner, keys locked without owner are absent
+        # min-heap of (expired_at, seq, key), entries out-dated by refresh or release are skipped lazily
+        self._expiry = []
+        self._expiry_seq = itertools.count()
+
+    def acquire(self, key, expired=5, refresh=False, owner=None):
         # non thread safe, using in single thread context
-        ts = self.get_current_time() + expired
+        current = self.get_current_time()
+        ts = current + expired
+        event = self.ACQUIRED
         if key in self._lock:
-            if not refresh:
-                raise RuntimeError("cannot lock: {}".format(key))
-            # refresh operator should not shorten the original duration
-            ts = max(self._lock[key], ts)
-        self._lock[key] = ts
+            if current > self._lock[key]:
+                # expired but not swept yet
+                self._expire(key)
+            elif not refresh:
+                raise LockConflictError([key])
+            else:
+                # refresh operator should not shorten the original duration
+                ts = max(self._lock[key], ts)
+                event = self.REFRESHED
+                owner = self._owners.get(key)
+        if self._lock.get(key) != ts:
+            self._lock[key] = ts
+            heapq.heappush(self._expiry, (ts, next(self._expiry_seq), key))
+        self._set_owner(key, owner)
+        self._emit(event, key, ts, owner)
 
-    def release(self, key):
+    def release(self, key, owner=None):
         # non thread safe, using in single thread context
-        if key in self._lock:
-            del self._lock[key]
-        else:
+        if key not in self._lock:
             logger.warning('release an un-acquired key: %s', key)
+            return False
+        if owner is not None and self._owners.get(key) != owner:
+            logger.warning('release a key held by others: %s', key)
+            return False
+        del self._lock[key]
+        self._owners.pop(key, None)
+        self._emit(self.RELEASED, key)
+        return True
+
+    def extend(self, key, owner, expired=5):
+        if not self.is_lock(key) or self._owners.get(key) != owner:
+            return False
+        ts = self.get_current_time() + expired
+        self._lock[key] = ts
+        heapq.heappush(self._expiry, (ts, next(self._expiry_seq), key))
+        self._emit(self.REFRESHED, key, ts, owner)
+        return True
 
     def is_lock(self, key):
-        return key in self._lock
+        expired_at = self._lock.get(key)
+        return expired_at is not None and self.get_current_time() <= expired_at
+
+    def dump(self):
+        """
+        :return: k: key, v: [time the lock expires at, owner]
+        """
+        return dict((key, [expired_at, self._owners.get(key)]) for key, expired_at in self._lock.items())
+
+    def restore(self, locks):
+        """
+        lock keys until the given times, those past already are dropped
+        :param locks: k: key, v: [time the lock expires at, owner], or the time only for a lock without owner
+        """
+        current = self.get_current_time()
+        for key, value in locks.items():
+            expired_at, owner = value if isinstance(value, (list, tuple)) else (value, None)
+            if expired_at < current:
+                continue
+            self._lock[key] = expired_at
+            heapq.heappush(self._expiry, (expired_at, next(self._expiry_seq), key))
+            self._set_owner(key, owner)
+            self._emit(self.ACQUIRED, key, expired_at, owner)
 
     def release_expired_keys(self):
+        with LOCK_SWEEP_DURATION.time():
+            total = self._release_expired_keys()
+        LOCK_EXPIRED.inc(total)
+        return total
+
+    def _release_expired_keys(self):
         current = self.get_current_time()
-        expired_keys = []
-        for key, expired_at in self._lock.items():
-            if current > expired_at:
-                logger.warning('found expired key: %s, %s', key, expired_at)
-                expired_keys.append(key)
-        for key in expired_keys:
-            del self._lock[key]
-        total = len(expired_keys)
+        total = 0
+        while self._expiry and self._expiry[0][0] < current:
+            expired_at, _, key = heapq.heappop(self._expiry)
+            if self._lock.get(key) != expired_at:
+                continue  # refreshed or released
+            logger.debug('found expired key: %s, %s', key, expired_at)
+            self._expire(key)
+            total += 1
+        if len(self._expiry) > 2 * len(self._lock) + 64:
+            self._compact_expiry()
         if total > 0:
             logger.warning('expired keys are released, total: %s', total)
+        return total
+
+    def _expire(self, key):
+        del self._lock[key]
+        self._owners.pop(key, None)
+        self._emit(self.EXPIRED, key)
+
+    def _set_owner(self, key, owner):
+        if owner is None:
+            self._owners.pop(key, None)
+        else:
+            self._owners[key] = owner
+
+    def _compact_expiry(self):
+        self._expiry = list((expired_at, next(self._expiry_seq), key) for key, expired_at in self._lock.items())
+        heapq.heapify(self._expiry)
+
+
+class RedisLockManager(BaseLockManager):
+    """
+    lock backend shared by processes through redis, keys are expired by redis itself
+
+    the value of a key is its owner, or NO_OWNER if it is locked without one
+    """
+    local = False
+    NO_OWNER = '1'
+
+    # KEYS: keys to lock, ARGV[1]: expired in milliseconds, ARGV[i + 1]: value of KEYS[i]
+    # return 1-based indexes of contended keys, keys are locked only if nothing is returned
+    ACQUIRE_MANY_SCRIPT = """
+local contended = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        table.insert(contended, i)
+    end
+end
+if #contended == 0 then
+    for i, key in ipairs(KEYS) do
+        redis.call('SET', key, ARGV[i + 1], 'PX', ARGV[1])
+    end
+end
+return contended
+"""
+
+    # KEYS[1]: key, ARGV[1]: expired in milliseconds
+    # refresh should not shorten the original duration
+    # return 1 if the key is extended, 0 if it is newly acquired
+    REFRESH_SCRIPT = """
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl < 0 then
+    redis.call('SET', KEYS[1], '1', 'PX', ARGV[1])
+    return 0
+end
+if ttl < tonumber(ARGV[1]) then
+    redis.call('PEXPIRE', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+    # KEYS[1]: key, ARGV[1]: owner
+    # return 1 if the key is held by the owner and deleted
+    RELEASE_OWNED_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    # KEYS[1]: key, ARGV[1]: owner, ARGV[2]: expired in milliseconds
+    # return 1 if the key is held by the owner and extended
+    EXTEND_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+    def __init__(self, client, namespace):
+        super().__init__()
+        self._client = client  # type: redis.StrictRedis
+        self._namespace = namespace
+        self._refresh = client.register_script(self.REFRESH_SCRIPT)
+        self._acquire_many = client.register_script(self.ACQUIRE_MANY_SCRIPT)
+        self._release_owned = client.register_script(self.RELEASE_OWNED_SCRIPT)
+        self._extend = client.register_script(self.EXTEND_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, namespace):
+        if redis is None:
+            raise RuntimeError("redis is required by RedisLockManager")
+        return cls(redis.StrictRedis.from_url(url), namespace)
+
+    def acquire(self, key, expired=5, refresh=False, owner=None):
+        ts = self.get_current_time() + expired
+        px = int(expired * 1000)
+        if refresh:
+            # NOTE: a key newly acquired by refresh has no owner
+            extended = self._refresh(keys=[self._get_name(key)], args=[px])
+            self._emit(self.REFRESHED if extended else self.ACQUIRED, key, ts)
+            return
+        if not self._client.set(self._get_name(key), self._get_value(owner), px=px, nx=True):
+            raise LockConflictError([key])
+        self._emit(self.ACQUIRED, key, ts, owner)
+
+    def acquire_many(self, keys, expired=5, owners=None):
+        ts = self.get_current_time() + expired
+        owners = owners or [None] * len(keys)
+        contended = self._acquire_many(keys=list(self._get_name(key) for key in keys),
+                                       args=[int(expired * 1000)] + list(self._get_value(owner) for owner in owners))
+        if contended:
+            raise LockConflictError(list(keys[int(i) - 1] for i in contended))
+        for key, owner in zip(keys, owners):
+            self._emit(self.ACQUIRED, key, ts, owner)
+
+    def release(self, key, owner=None):
+        return self.release_many([key], [owner])[0]
+
+    def release_many(self, keys, owners=None):
+        # one round-trip for all keys
+        pipe = self._client.pipeline(transaction=False)
+        for key, owner in zip(keys, owners or [None] * len(keys)):
+            if owner is None:
+                pipe.delete(self._get_name(key))
+            else:
+                self._release_owned(keys=[self._get_name(key)], args=[owner], client=pipe)
+        released = list(bool(deleted) for deleted in pipe.execute())
+        for key, deleted in zip(keys, released):
+            if deleted:
+                self._emit(self.RELEASED, key)
+            else:
+                logger.warning('release an un-acquired key or one held by others: %s', key)
+        return released
+
+    def extend(self, key, owner, expired=5):
+        ts = self.get_current_time() + expired
+        if not self._extend(keys=[self._get_name(key)], args=[owner, int(expired * 1000)]):
+            return False
+        self._emit(self.REFRESHED, key, ts, owner)
+        return True
+
+    def is_lock(self, key):
+        return bool(self._client.exists(self._get_name(key)))
+
+    def is_lock_many(self, keys):
+        # one round-trip for all keys
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.exists(self._get_name(key))
+        return list(bool(exists) for exists in pipe.execute())
+
+    def _get_name(self, key):
+        return '{}:{}'.format(self._namespace, key)
+
+    def _get_value(self, owner):
+        return self.NO_OWNER if owner is None else owner
 
 
 class SimpleStoreManager(object):
@@ -65,3 +434,350 @@ class SimpleStoreManager(object):
     @staticmethod
     def _new_token():
         return uuid.uuid4().hex
+
+
+CapabilityChangeSet = namedtuple('CapabilityChangeSet', ['hub_url', 'added', 'removed', 'changed'])
+
+
+class CapabilityEntry(object):
+    """
+    a capability reported by selenium grid, together with the fields derived from it for indexing
+    """
+    __slots__ = ('key', 'seq', 'cap', 'hub_url', 'appium_url', 'udid',
+                 'platform_name', 'device_name', 'version', 'parsed_version')
+
+    def __init__(self, cap, seq=(0, 0)):
+        detail = cap['capabilities']
+        self.cap = cap
+        self.seq = seq  # (hub order, position in hub), used to keep query result stable
+        self.hub_url = cap.get('hub_url')
+        self.appium_url = cap['appium_url']
+        self.udid = detail.get('UDID')
+        self.platform_name = detail.get('platformName')
+        self.device_name = (detail.get('deviceName') or '').lower()
+        self.version = detail.get('version')
+        self.parsed_version = parse_version(self.version)
+        self.key = (self.hub_url, self.appium_url, self.udid)
+
+    @staticmethod
+    def get_key(cap):
+        return cap.get('hub_url'), cap['appium_url'], cap['capabilities'].get('UDID')
+
+
+class CapabilityStore(object):
+    """
+    keep capabilities indexed by the conditions of capability query and track which of them are free,
+    so that the cost of a query depends on the number of matched capabilities instead of the whole fleet
+
+    a capability is free if neither its appium_url nor its udid is locked,
+    lock state is fed by `set_appium_url_locked` and `set_udid_locked`
+
+    capabilities are merged hub by hub with `apply_hub`, entries of unchanged capabilities are kept,
+    and every non-empty change is published to listeners as a CapabilityChangeSet
+    """
+
+    def __init__(self):
+        self._entries = {}  # k: entry key, v: CapabilityEntry
+        self._by_platform_name = defaultdict(set)
+        self._by_device_name = defaultdict(set)  # k: lower-cased deviceName
+        self._by_version = defaultdict(set)  # k: version string as reported
+        self._by_appium_url = defaultdict(set)
+        self._by_udid = defaultdict(set)
+        self._sorted_versions = []  # parsed versions in ascending order
+        self._sorted_version_keys = []  # entry keys aligned with _sorted_versions
+        self._locked_appium_urls = set()
+        self._locked_udids = set()
+        self._free = set()  # keys of free entries
+        self._hub_keys = {}  # k: hub_url, v: keys of entries reported by the hub
+        self._key_hubs = {}  # k: entry key, v: hub_url owning it in _hub_keys
+        self._hub_orders = {}  # k: hub_url, v: order of the hub, first seen first
+        self._next_hub_order = 1
+        self._next_position = 0
+        self._capabilities = []  # raw capabilities in hub order, rebuilt lazily after changes
+        self._listeners = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add_listener(self, listener):
+        """
+        listener will be called with a CapabilityChangeSet whenever capabilities are added, removed or changed
+        """
+        self._listeners.append(listener)
+
+    def get_all(self):
+        if self._capabilities is None:
+            self._capabilities = list(e.cap for e in sorted(self._entries.values(), key=lambda e: e.seq))
+        return self._capabilities
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def get_by_appium_url(self, appium_url):
+        return list(self._entries[k] for k in self._by_appium_url.get(appium_url, ()))
+
+    def get_by_udid(self, udid):
+        return list(self._entries[k] for k in self._by_udid.get(udid, ()))
+
+    def get_hub_urls(self):
+        return list(self._hub_keys)
+
+    def get_all_by_hub(self):
+        """
+        :return: k: hub_url, v: capabilities reported by the hub in hub order
+        """
+        return dict((hub_url, list(e.cap for e in sorted((self._entries[k] for k in keys), key=lambda e: e.seq)))
+                    for hub_url, keys in self._hub_keys.items())
+
+    def replace(self, caps):
+        removed = list(self._entries.values())
+        self._entries = {}
+        for index_ in (self._by_platform_name, self._by_device_name, self._by_version,
+                       self._by_appium_url, self._by_udid):
+            index_.clear()
+        self._free = set()
+        self._hub_keys = {}
+        self._key_hubs = {}
+        added, versions = [], []
+        for position, cap in enumerate(caps):
+            entry = CapabilityEntry(cap, (0, position))
+            if entry.key in self._entries:
+                continue
+            self._index(entry)
+            added.append(entry)
+            versions.append((entry.parsed_version, entry.seq, entry.key))
+        versions.sort(key=lambda v: v[:2])
+        self._sorted_versions = [v[0] for v in versions]
+        self._sorted_version_keys = [v[2] for v in versions]
+        self._next_position = len(caps)
+        self._capabilities = None
+        self._publish(CapabilityChangeSet(None, added, removed, []))
+
+    def apply_hub(self, hub_url, caps):
+        """
+        merge the latest capabilities reported by a hub
+        :return: CapabilityChangeSet
+        """
+        order = self._get_hub_order(hub_url)
+        old_keys = self._hub_keys.get(hub_url, set())
+        new_keys = set()
+        added, changed = [], []
+        for position, cap in enumerate(caps):
+            seq = (order, position)
+            key = CapabilityEntry.get_key(cap)
+            if key in new_keys:
+                continue
+            new_keys.add(key)
+            entry = self._entries.get(key)
+            if entry is not None and entry.cap == cap:
+                # unchanged, keep the entry and everything derived from it
+                if entry.seq != seq:
+                    entry.seq = seq
+                    self._capabilities = None
+                if key not in old_keys:
+                    self._move_to_hub(key, hub_url)
+                continue
+            if entry is not None:
+                self._remove(key)
+                entry = self._add(CapabilityEntry(cap, seq))
+                changed.append(entry)
+            else:
+                entry = self._add(CapabilityEntry(cap, seq))
+                added.append(entry)
+            self._move_to_hub(key, hub_url)
+        removed = []
+        for key in old_keys - new_keys:
+            del self._key_hubs[key]
+            removed.append(self._remove(key))
+        self._hub_keys[hub_url] = new_keys
+        change_set = CapabilityChangeSet(hub_url, added, removed, changed)
+        self._publish(change_set)
+        return change_set
+
+    def remove_hub(self, hub_url):
+        """
+        drop all capabilities reported by a hub
+        :return: CapabilityChangeSet
+        """
+        keys = self._hub_keys.pop(hub_url, set())
+        self._hub_orders.pop(hub_url, None)
+        for key in keys:
+            del self._key_hubs[key]
+        change_set = CapabilityChangeSet(hub_url, [], [self._remove(key) for key in keys], [])
+        self._publish(change_set)
+        return change_set
+
+    def add(self, cap):
+        entry = CapabilityEntry(cap, (self._get_hub_order(cap.get('hub_url')), self._next_position))
+        self._next_position += 1
+        old_entry = self._remove(entry.key)
+        self._add(entry)
+        if old_entry is None:
+            self._publish(CapabilityChangeSet(entry.hub_url, [entry], [], []))
+        else:
+            self._publish(CapabilityChangeSet(entry.hub_url, [], [], [entry]))
+        return entry
+
+    def remove(self, key):
+        entry = self._remove(key)
+        if entry is not None:
+            hub_url = self._key_hubs.pop(key, None)
+            if hub_url is not None:
+                self._hub_keys[hub_url].discard(key)
+            self._publish(CapabilityChangeSet(entry.hub_url, [], [entry], []))
+        return entry
+
+    def _add(self, entry):
+        self._index(entry)
+        i = bisect_right(self._sorted_versions, entry.parsed_version)
+        self._sorted_versions.insert(i, entry.parsed_version)
+        self._sorted_version_keys.insert(i, entry.key)
+        self._capabilities = None
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        self._discard(self._by_platform_name, entry.platform_name, key)
+        self._discard(self._by_device_name, entry.device_name, key)
+        self._discard(self._by_version, entry.version, key)
+        self._discard(self._by_appium_url, entry.appium_url, key)
+        self._discard(self._by_udid, entry.udid, key)
+        self._free.discard(key)
+        lo = bisect_left(self._sorted_versions, entry.parsed_version)
+        hi = bisect_right(self._sorted_versions, entry.parsed_version)
+        i = self._sorted_version_keys.index(key, lo, hi)
+        del self._sorted_versions[i]
+        del self._sorted_version_keys[i]
+        self._capabilities = None
+        return entry
+
+    def _move_to_hub(self, key, hub_url):
+        # a capability is owned by the hub which reports it latest
+        other_hub_url = self._key_hubs.get(key)
+        if other_hub_url is not None and other_hub_url != hub_url:
+            self._hub_keys[other_hub_url].discard(key)
+        self._key_hubs[key] = hub_url
+
+    def _get_hub_order(self, hub_url):
+        order = self._hub_orders.get(hub_url)
+        if order is None:
+            order = self._hub_orders[hub_url] = self._next_hub_order
+            self._next_hub_order += 1
+        return order
+
+    def _publish(self, change_set):
+        if not (change_set.added or change_set.removed or change_set.changed):
+            return
+        for listener in self._listeners:
+            listener(change_set)
+
+    def set_appium_url_locked(self, appium_url, locked):
+        if locked:
+            self._locked_appium_urls.add(appium_url)
+        else:
+            self._locked_appium_urls.discard(appium_url)
+        self._update_free(self._by_appium_url.get(appium_url, ()))
+
+    def set_udid_locked(self, udid, locked):
+        if locked:
+            self._locked_udids.add(udid)
+        else:
+            self._locked_udids.discard(udid)
+        self._update_free(self._by_udid.get(udid, ()))
+
+    def is_free(self, key):
+        return key in self._free
+
+    def count_free(self):
+        return len(self._free)
+
+    def query(self, platform_name=None, device_names=None, platform_versions=None,
+              min_platform_version=None, max_platform_version=None, free_only=True):
+        """
+        :return: matched entries in hub order
+        """
+        # every condition is a tuple of (estimated size, candidate keys, predicate on entry)
+        # candidates are drawn from the most selective condition and checked against the rest
+        conditions = []
+        if free_only:
+            conditions.append((len(self._free), self._free, lambda e: e.key in self._free))
+        if platform_name is not None:
+            keys = self._by_platform_name.get(platform_name, ())
+            conditions.append((len(keys), keys, lambda e: e.platform_name == platform_name))
+        if device_names:
+            keys = self._match_device_names(device_names)
+            conditions.append((len(keys), keys, lambda e: is_string_in_partially(e.device_name, device_names)))
+        if platform_versions:
+            keys = set()
+            for version in platform_versions:
+                keys.update(self._by_version.get(version, ()))
+            conditions.append((len(keys), keys, lambda e: e.version in platform_versions))
+        if min_platform_version is not None or max_platform_version is not None:
+            lo, hi = 0, len(self._sorted_versions)
+            min_parsed = max_parsed = None
+            if min_platform_version is not None:
+                min_parsed = parse_version(min_platform_version)
+                lo = bisect_left(self._sorted_versions, min_parsed)
+            if max_platform_version is not None:
+                max_parsed = parse_version(max_platform_version)
+                hi = bisect_right(self._sorted_versions, max_parsed)
+            hi = max(lo, hi)
+
+            def in_range(e):
+                return (min_parsed is None or e.parsed_version >= min_parsed) and \
+                       (max_parsed is None or e.parsed_version <= max_parsed)
+            conditions.append((hi - lo, self._sorted_version_keys[lo:hi], in_range))
+
+        if not conditions:
+            entries = list(self._entries.values())
+        else:
+            conditions.sort(key=lambda c: c[0])
+            _, keys, _ = conditions[0]
+            predicates = [c[2] for c in conditions[1:]]
+            entries = []
+            for key in keys:
+                entry = self._entries[key]
+                if all(p(entry) for p in predicates):
+                    entries.append(entry)
+        entries.sort(key=lambda e: e.seq)
+        return entries
+
+    def _index(self, entry):
+        key = entry.key
+        self._entries[key] = entry
+        self._by_platform_name[entry.platform_name].add(key)
+        self._by_device_name[entry.device_name].add(key)
+        self._by_version[entry.version].add(key)
+        self._by_appium_url[entry.appium_url].add(key)
+        self._by_udid[entry.udid].add(key)
+        if self._is_unlocked(entry):
+            self._free.add(key)
+
+    def _update_free(self, keys):
+        for key in keys:
+            if self._is_unlocked(self._entries[key]):
+                self._free.add(key)
+            else:
+                self._free.discard(key)
+
+    def _is_unlocked(self, entry):
+        return entry.appium_url not in self._locked_appium_urls and entry.udid not in self._locked_udids
+
+    def _match_device_names(self, device_names):
+        # number of distinct device names is far smaller than the fleet, so match against names instead of entries
+        keys = set()
+        for name, name_keys in self._by_device_name.items():
+            if is_string_in_partially(name, device_names):
+                keys.update(name_keys)
+        return keys
+
+    @staticmethod
+    def _discard(index_, value, key):
+        keys = index_.get(value)
+        if keys is None:
+            return
+        keys.discard(key)
+        if not keys:
+            del index_[value]
@@ -0,0 +1,209 @@
+"""
+in-process metrics, rendered in prometheus text format
+
+metrics are kept per process, every worker process serves its own
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}  # k: label values, v: child holding the value
+
+    def labels(self, *values):
+        assert len(values) == len(self.labelnames), "expect labels: {}".format(self.labelnames)
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        # metric without labels is its only child
+        return self.labels()
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        for values, child in sorted(self._children.items()):
+            for suffix, extra_labels, value in child.samples():
+                labels = list(zip(self.labelnames, values)) + extra_labels
+                lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(labels), _format_value(value)))
+        return lines
+
+
+class _CounterChild(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [('', [], self.value)]
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+
+class _GaugeChild(object):
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """
+        value is got from function when rendering, so nothing is done until it is collected
+        """
+        self.function = function
+
+    def samples(self):
+        return [('', [], self.value if self.function is None else self.function())]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default().set(value)
+
+    def inc(self, amount=1):
+        self._default().inc(amount)
+
+    def dec(self, amount=1):
+        self._default().dec(amount)
+
+    def set_function(self, function):
+        self._default().set_function(function)
+
+
+class _HistogramChild(object):
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one for +Inf
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        samples, total = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            samples.append(('_bucket', [('le', _format_value(bound))], total))
+        samples.append(('_sum', [], self.sum))
+        samples.append(('_count', [], total))
+        return samples
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._metrics = {}  # k: name, v: metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render())
+        return '\n'.join(lines) + '\n'
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError("metric is registered: {}".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + '}'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
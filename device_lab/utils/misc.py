@@ -1,3 +1,4 @@
+import re
 import string
 import secrets
 from functools import wraps
@@ -38,3 +39,14 @@ def is_string_in_partially(s, ss, case_insensitive=True):
         if _s in s:  # partial match
             return True
     return False
+
+
+def parse_version(version):
+    """
+    parse version string into a comparable tuple, e.g. '11.2.0' -> (11, 2)
+    non-digit parts are ignored and trailing zeros are stripped, so that '11' == '11.0'
+    """
+    parts = [int(p) for p in re.findall(r'\d+', version or '')]
+    while parts and parts[-1] == 0:
+        parts.pop()
+    return tuple(parts)
@@ -0,0 +1,183 @@
+import time
+from collections import defaultdict
+
+
+class BasePlacementPolicy(object):
+    """
+    order matched free capabilities of a query, the ones earlier are preferred when a capability is picked
+
+    state a policy ranks by is fed incrementally by the service, from capability changes, lock events of
+    this process and appium polls, so that ranking costs only a sort of the matched candidates
+    """
+    name = None
+
+    @staticmethod
+    def get_current_time():
+        return time.time()
+
+    def rank(self, entries):
+        """
+        :param entries: CapabilityEntry in hub order
+        :return: entries in order of preference
+        """
+        return entries
+
+    def get_generation(self):
+        """
+        ranking results are cached by the service until capabilities or locks change,
+        or until this value moves, it should move whenever the ranking changes for other reasons
+        """
+        return 0
+
+    def on_capabilities_changed(self, change_set):
+        pass
+
+    def on_appium_url_locked(self, appium_url, locked):
+        pass
+
+    def on_udid_locked(self, udid, entries, locked):
+        """
+        :param entries: CapabilityEntry of the udid, one per hub reporting it
+        """
+        pass
+
+    def on_appium_polled(self, appium_url, success):
+        pass
+
+    def get_stats(self):
+        return {}
+
+
+class HubOrderPolicy(BasePlacementPolicy):
+    """
+    first match in hub order
+    """
+    name = 'hub_order'
+
+
+class BalancedPolicy(BasePlacementPolicy):
+    """
+    spread locks over devices, appium nodes and hubs, by a score summed from (lower is better):
+
+    - failure: moving average of failed polls of the appium node, in [0, 1]
+    - load: ratio of locked devices of the hub, in [0, 1]
+    - recency: how recently the device or its appium node was locked or released, 1 right after
+      and 0 once they are idle for `idle_horizon` seconds or never used
+
+    candidates of the same score are kept in hub order,
+    cached rankings are refreshed once a failure rate moves by a tenth, and every tenth of `idle_horizon`
+
+    NOTE: with a shared lock backend only locks of this process are seen, load and recency are partial
+    """
+    name = 'balanced'
+
+    def __init__(self, failure_weight=4.0, load_weight=2.0, recency_weight=1.0, idle_horizon=600,
+                 failure_decay=0.2):
+        self.failure_weight = failure_weight
+        self.load_weight = load_weight
+        self.recency_weight = recency_weight
+        self.idle_horizon = idle_horizon
+        self.failure_decay = failure_decay  # weight of the latest poll in the moving average
+        self._udid_used_at = {}  # k: udid, v: time it was locked or released last
+        self._appium_used_at = {}  # k: appium_url, v: time it was locked or released last
+        self._failure_rates = {}  # k: appium_url, v: moving average, nodes without recent failure are absent
+        self._hub_devices = defaultdict(int)  # k: hub_url, v: number of capabilities reported
+        self._hub_locked = defaultdict(int)  # k: hub_url, v: number of locked devices
+        self._locked_udid_hubs = {}  # k: locked udid, v: hub_urls counted for it when locked
+        self._udid_refs = defaultdict(int)  # k: udid, v: number of capabilities reporting it
+        self._appium_refs = defaultdict(int)  # k: appium_url, v: number of capabilities reporting it
+        self._generation = 0  # moved by changes of failure rates
+        self._last_used_at = 0  # time any device or appium node was locked or released last
+
+    def rank(self, entries):
+        if not (self._udid_used_at or self._failure_rates or self._locked_udid_hubs):
+            return entries  # nothing is known yet
+        now = self.get_current_time()
+        return sorted(entries, key=lambda e: self.get_score(e, now))
+
+    def get_score(self, entry, now):
+        score = 0.0
+        failure_rate = self._failure_rates.get(entry.appium_url)
+        if failure_rate:
+            score += self.failure_weight * failure_rate
+        devices = self._hub_devices.get(entry.hub_url)
+        if devices:
+            score += self.load_weight * min(1.0, self._hub_locked.get(entry.hub_url, 0) / devices)
+        used_at = max(self._udid_used_at.get(entry.udid, 0), self._appium_used_at.get(entry.appium_url, 0))
+        if used_at:
+            score += self.recency_weight * max(0.0, 1 - (now - used_at) / self.idle_horizon)
+        return score
+
+    def get_generation(self):
+        now = self.get_current_time()
+        if now - self._last_used_at > self.idle_horizon:
+            return self._generation, None  # recency of every candidate is 0, it does not change with time
+        return self._generation, int(now * 10 / self.idle_horizon)
+
+    def on_capabilities_changed(self, change_set):
+        for entry in change_set.added:
+            self._hub_devices[entry.hub_url] += 1
+            self._udid_refs[entry.udid] += 1
+            self._appium_refs[entry.appium_url] += 1
+        for entry in change_set.removed:
+            self._hub_devices[entry.hub_url] -= 1
+            if self._hub_devices[entry.hub_url] <= 0:
+                del self._hub_devices[entry.hub_url]
+            # state of a device or appium node no longer reported by any hub is dropped
+            self._udid_refs[entry.udid] -= 1
+            if self._udid_refs[entry.udid] <= 0:
+                del self._udid_refs[entry.udid]
+                self._udid_used_at.pop(entry.udid, None)
+            self._appium_refs[entry.appium_url] -= 1
+            if self._appium_refs[entry.appium_url] <= 0:
+                del self._appium_refs[entry.appium_url]
+                self._appium_used_at.pop(entry.appium_url, None)
+                if self._failure_rates.pop(entry.appium_url, None) is not None:
+                    self._generation += 1
+
+    def on_appium_url_locked(self, appium_url, locked):
+        self._appium_used_at[appium_url] = self._last_used_at = self.get_current_time()
+
+    def on_udid_locked(self, udid, entries, locked):
+        self._udid_used_at[udid] = self._last_used_at = self.get_current_time()
+        if locked and udid not in self._locked_udid_hubs:
+            hub_urls = tuple(set(e.hub_url for e in entries))
+            self._locked_udid_hubs[udid] = hub_urls
+            for hub_url in hub_urls:
+                self._hub_locked[hub_url] += 1
+        elif not locked and udid in self._locked_udid_hubs:
+            # hubs counted when locked, they may report the device no longer
+            for hub_url in self._locked_udid_hubs.pop(udid):
+                self._hub_locked[hub_url] -= 1
+                if self._hub_locked[hub_url] <= 0:
+                    del self._hub_locked[hub_url]
+
+    def on_appium_polled(self, appium_url, success):
+        old_rate = self._failure_rates.get(appium_url, 0.0)
+        rate = old_rate * (1 - self.failure_decay)
+        if not success:
+            rate += self.failure_decay
+        if rate < 0.01:
+            rate = 0.0
+            self._failure_rates.pop(appium_url, None)  # recovered, forget it
+        else:
+            self._failure_rates[appium_url] = rate
+        if int(rate * 10) != int(old_rate * 10) or (rate == 0.0) != (old_rate == 0.0):
+            self._generation += 1
+
+    def get_stats(self):
+        return {
+            'hub_load': dict((hub_url, {'locked': self._hub_locked.get(hub_url, 0), 'devices': devices})
+                             for hub_url, devices in self._hub_devices.items()),
+            'failure_rates': dict(self._failure_rates),
+        }
+
+
+PLACEMENT_POLICIES = dict((policy.name, policy) for policy in (HubOrderPolicy, BalancedPolicy))
+
+
+def new_placement_policy(name):
+    try:
+        return PLACEMENT_POLICIES[name]()
+    except KeyError:
+        raise ValueError("unknown placement policy: {}".format(name))
@@ -0,0 +1,99 @@
+import random
+
+
+class PollState(object):
+    """
+    polling state of a remote, whose interval adapts to how often its data changes
+
+    the interval is halved when a poll sees a change and grows slowly while nothing changes,
+    after failures the delay backs off exponentially, and every delay is jittered so that
+    remotes polled at the same time drift apart
+    """
+
+    def __init__(self, initial_interval=10, min_interval=5, max_interval=60, max_backoff=300, jitter=0.2,
+                 rand=random.random):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.interval = min(max(initial_interval, min_interval), max_interval)
+        self.failures = 0  # consecutive failures
+        self.changed = False  # whether last successful poll saw a change
+        self.last_success = None  # time of last successful poll
+        self.last_failure = None
+        self.latency = None  # seconds taken by last poll
+        self.next_poll_at = None
+        self.handle = None  # handle of the scheduled poll
+        self._rand = rand
+
+    def on_success(self, now, latency, changed):
+        self.failures = 0
+        self.last_success = now
+        self.latency = latency
+        self.changed = changed
+        if changed:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.25)
+
+    def reset_interval(self):
+        self.interval = self.min_interval
+
+    def on_failure(self, now, latency):
+        self.failures += 1
+        self.last_failure = now
+        self.latency = latency
+
+    def get_first_delay(self):
+        # spread the first polls of remotes across one interval
+        return self.interval * self._rand()
+
+    def get_next_delay(self):
+        delay = self.interval
+        if self.failures:
+            delay = min(self.max_backoff, delay * 2 ** self.failures)
+        return delay * (1 + self.jitter * (2 * self._rand() - 1))
+
+    def to_dict(self):
+        return {
+            'interval': self.interval,
+            'failures': self.failures,
+            'changed': self.changed,
+            'last_success': self.last_success,
+            'last_failure': self.last_failure,
+            'latency': self.latency,
+            'next_poll_at': self.next_poll_at,
+        }
+
+
+class CircuitBreaker(object):
+    """
+    calls to a remote are rejected for a while after it fails `threshold` times in a row (open),
+    then one trial call is allowed (half open), its success closes the circuit and its failure opens it again
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=3, reset_timeout=60):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self, now):
+        if self.state == self.OPEN and now >= self.opened_at + self.reset_timeout:
+            self.state = self.HALF_OPEN
+        return self.state != self.OPEN
+
+    def on_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def on_failure(self, now):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            self.state = self.OPEN
+            self.opened_at = now
@@ -0,0 +1,183 @@
+import sys
+import time
+import logging
+import threading
+from collections import deque, Counter
+
+from tornado.ioloop import IOLoop
+
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = registry.histogram(
+    'device_lab_ioloop_lag_seconds', 'Delay of a callback scheduled on the IOLoop past its due time',
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+LOOP_STALLS = registry.counter('device_lab_ioloop_stalls_total', 'IOLoop lags over the stall threshold')
+
+
+def format_stack(frame, limit=64):
+    """
+    :return: frames as "file:line function", outermost first
+    """
+    stack = []
+    while frame is not None and len(stack) < limit:
+        code = frame.f_code
+        stack.append('{}:{} {}'.format(code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class LoopLagMonitor(object):
+    """
+    detect stalls of the IOLoop and what blocks it
+
+    a callback on the loop stamps every `interval` seconds when it is due next, and a watchdog thread checks
+    the stamp, once the loop is `threshold` seconds late, the stack of the loop thread is captured while it is
+    still blocked, the stall is recorded with its full lag when the loop comes back
+    a stall shorter than a watchdog round could be missed by the watchdog, it is recorded without stack
+    """
+
+    def __init__(self, threshold=0.1, interval=0.05, max_stalls=50):
+        self.threshold = threshold
+        self.interval = interval
+        self.total_stalls = 0
+        self.max_lag = 0.0
+        self._stalls = deque(maxlen=max_stalls)  # recent stalls, oldest first
+        self._lock = threading.Lock()  # guards the fields shared with the watchdog
+        self._due_at = None  # monotonic time the next beat is due
+        self._captured = None  # stall captured by the watchdog for the beat due
+        self._loop_thread_id = None
+        self._stopped = threading.Event()
+        self._handle = None
+
+    @staticmethod
+    def get_current_time():
+        return time.monotonic()
+
+    def start(self):
+        """
+        start monitoring current IOLoop, should be called on its thread
+        """
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._schedule_beat()
+        threading.Thread(target=self._watch, name='loop-lag-monitor', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._handle is not None:
+            IOLoop.current().remove_timeout(self._handle)
+            self._handle = None
+
+    def get_stats(self):
+        """
+        :return: threshold, total stalls and max lag since started, and recent stalls, latest first
+        """
+        with self._lock:
+            stalls = list(reversed(self._stalls))
+        return {
+            'threshold': self.threshold,
+            'total_stalls': self.total_stalls,
+            'max_lag': self.max_lag,
+            'stalls': stalls,
+        }
+
+    def _schedule_beat(self):
+        with self._lock:
+            self._due_at = self.get_current_time() + self.interval
+        self._handle = IOLoop.current().call_later(self.interval, self._beat)
+
+    def _beat(self):
+        lag = max(0.0, self.get_current_time() - self._due_at)
+        LOOP_LAG.observe(lag)
+        self.max_lag = max(self.max_lag, lag)
+        with self._lock:
+            stall, self._captured = self._captured, None
+        if lag >= self.threshold:
+            stall = stall or {'started_at': time.time() - lag, 'stack': None}
+            stall['lag'] = lag
+            with self._lock:
+                self._stalls.append(stall)
+            self.total_stalls += 1
+            LOOP_STALLS.inc()
+            logger.warning('IOLoop is blocked for %.3f seconds at:\n%s', lag,
+                           '\n'.join(stall['stack'] or ['unknown']))
+        self._schedule_beat()
+
+    def _watch(self):
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                due_at, captured = self._due_at, self._captured
+            blocked = self.get_current_time() - due_at
+            if captured is not None or blocked < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stall = {'started_at': time.time() - blocked, 'stack': format_stack(frame)}
+            with self._lock:
+                if self._due_at == due_at:  # the loop is still blocked on the same beat
+                    self._captured = stall
+
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+
+class SamplingProfiler(object):
+    """
+    statistical profiler sampling stacks of a thread from another thread, its cost is taking a stack
+    every interval, so that it is safe to run against a serving process for a while
+
+    samples of an idle IOLoop, which is waiting in selectors, are counted apart from the stacks
+    only one profile runs at a time
+    """
+    IDLE_FILENAMES = ('selectors.py',)
+
+    def __init__(self):
+        self._running = threading.Lock()
+
+    def sample(self, thread_id, seconds, interval=0.005, top=20):
+        """
+        take samples for `seconds`, this blocks the calling thread, run it off the IOLoop
+
+        :param thread_id: ident of the thread sampled, None for every thread but the profiler itself
+        :return: number of samples, idle ones, hot stacks with their sample counts, and hot frames by samples
+                 they are on top of stack (self) and in stack (total)
+        :raise ProfilerBusyError: if another profile is running
+        """
+        if not self._running.acquire(blocking=False):
+            raise ProfilerBusyError("another profile is running")
+        try:
+            stacks, samples, idle = Counter(), 0, 0
+            deadline = time.monotonic() + seconds
+            own_thread_id = threading.get_ident()
+            while time.monotonic() < deadline:
+                for frame_thread_id, frame in sys._current_frames().items():
+                    if frame_thread_id == own_thread_id or (thread_id is not None and frame_thread_id != thread_id):
+                        continue
+                    samples += 1
+                    if frame.f_code.co_filename.endswith(self.IDLE_FILENAMES):
+                        idle += 1
+                        continue
+                    stacks[tuple(format_stack(frame))] += 1
+                frame = None  # do not keep frames of other threads alive while sleeping
+                time.sleep(interval)
+        finally:
+            self._running.release()
+        return self._summarize(stacks, samples, idle, top)
+
+    @staticmethod
+    def _summarize(stacks, samples, idle, top):
+        self_counts, total_counts = Counter(), Counter()
+        for stack, count in stacks.items():
+            self_counts[stack[-1]] += count
+            for frame in set(stack):
+                total_counts[frame] += count
+        return {
+            'samples': samples,
+            'idle': idle,
+            'stacks': list({'count': count, 'stack': list(stack)} for stack, count in stacks.most_common(top)),
+            'frames': list({'frame': frame, 'self': count, 'total': total_counts[frame]}
+                           for frame, count in self_counts.most_common(top)),
+        }
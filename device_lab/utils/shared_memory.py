@@ -0,0 +1,270 @@
+"""
+state shared by forked worker processes through memory-mapped files
+
+cross-process exclusion is done by POSIX record locks (fcntl.lockf), which, unlike flock,
+are owned by process and are not shared by a parent and its forked children
+"""
+import os
+import json
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import hashlib
+import logging
+
+from utils.managers import BaseLockManager, LockConflictError
+
+logger = logging.getLogger(__name__)
+
+
+class _FileLock(object):
+    def __init__(self, fd):
+        self._fd = fd
+
+    def __enter__(self):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+
+class SharedMemoryLockManager(BaseLockManager):
+    """
+    lock table in a memory-mapped file of fixed-size slots, shared by processes forked after its creation
+
+    slots are addressed by open addressing (linear probing) on crc32 of the key,
+    a released slot is left as a tombstone so that probe chains are kept,
+    a slot past its deadline is expired lazily and reused by later acquire,
+    owner of a lock is kept as its md5 digest, all zero if there is none
+
+    the table outlives the processes using it, locks in an existing one are kept on open,
+    and it is compacted so that expired slots and tombstones left by the last run are dropped
+    """
+    local = False
+
+    # expired_at, length of key, key, digest of owner
+    SLOT = struct.Struct('<dH102s16s')
+    OWNER = struct.Struct('<16s')
+    OWNER_OFFSET = SLOT.size - OWNER.size
+    MAX_KEY_SIZE = 102
+    NO_OWNER = bytes(16)
+    EMPTY = 0.0
+    TOMBSTONE = -1.0
+
+    def __init__(self, path, slots=65536):
+        super().__init__()
+        self._slots = slots
+        size = self.SLOT.size * slots
+        # NOTE: an existing table may be in use by running processes, it is never truncated on open
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._mutex = _FileLock(self._fd)
+        with self._mutex:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size)
+        kept = self.compact()
+        if kept:
+            logger.info('keep %s locks of shared lock table: %s', kept, path)
+
+    def clear(self):
+        """
+        drop every lock in the table, it should be called only by the process starting the worker group
+        """
+        with self._mutex:
+            self._mm[:] = bytes(len(self._mm))
+
+    def compact(self):
+        """
+        write live locks into the table again, without expired slots and tombstones
+        :return: number of live locks
+        """
+        current = self.get_current_time()
+        with self._mutex:
+            live = []
+            for index in range(self._slots):
+                expired_at, size, raw_key, digest = self.SLOT.unpack_from(self._mm, index * self.SLOT.size)
+                if current <= expired_at:  # neither empty, tombstone nor expired
+                    live.append((raw_key[:size], expired_at, digest))
+            self._mm[:] = bytes(len(self._mm))
+            for encoded_key, expired_at, digest in live:
+                index, _ = self._find(encoded_key, current)
+                self._write(index, encoded_key, expired_at, digest)
+        return len(live)
+
+    def acquire(self, key, expired=5, refresh=False, owner=None):
+        current = self.get_current_time()
+        ts = current + expired
+        digest = self._digest(owner)
+        with self._mutex:
+            index, expired_at = self._find(self._encode(key), current)
+            event = self.ACQUIRED
+            if expired_at is not None:
+                if not refresh:
+                    raise LockConflictError([key])
+                # refresh operator should not shorten the original duration
+                ts = max(expired_at, ts)
+                event = self.REFRESHED
+                digest, owner = self._read_owner(index), None
+            self._write(index, self._encode(key), ts, digest)
+        self._emit(event, key, ts, owner)
+
+    def acquire_many(self, keys, expired=5, owners=None):
+        current = self.get_current_time()
+        ts = current + expired
+        owners = owners or [None] * len(keys)
+        encoded_keys = list(self._encode(key) for key in keys)
+        with self._mutex:
+            found = list(self._find(k, current) for k in encoded_keys)
+            contended = list(key for key, (_, expired_at) in zip(keys, found) if expired_at is not None)
+            if contended:
+                raise LockConflictError(contended)
+            for encoded_key, owner in zip(encoded_keys, owners):
+                # find again, the slot found above may be taken by a former key of the same batch
+                index, _ = self._find(encoded_key, current)
+                self._write(index, encoded_key, ts, self._digest(owner))
+        for key, owner in zip(keys, owners):
+            self._emit(self.ACQUIRED, key, ts, owner)
+
+    def release(self, key, owner=None):
+        current = self.get_current_time()
+        released = False
+        with self._mutex:
+            index, expired_at = self._find(self._encode(key), current)
+            if expired_at is not None and (owner is None or self._read_owner(index) == self._digest(owner)):
+                self.SLOT.pack_into(self._mm, index * self.SLOT.size, self.TOMBSTONE, 0, b'', self.NO_OWNER)
+                released = True
+        if released:
+            self._emit(self.RELEASED, key)
+        else:
+            logger.warning('release an un-acquired key or one held by others: %s', key)
+        return released
+
+    def extend(self, key, owner, expired=5):
+        current = self.get_current_time()
+        ts = current + expired
+        digest = self._digest(owner)
+        encoded_key = self._encode(key)
+        with self._mutex:
+            index, expired_at = self._find(encoded_key, current)
+            if expired_at is None or self._read_owner(index) != digest:
+                return False
+            self._write(index, encoded_key, ts, digest)
+        self._emit(self.REFRESHED, key, ts, owner)
+        return True
+
+    def is_lock(self, key):
+        return self.is_lock_many([key])[0]
+
+    def is_lock_many(self, keys):
+        current = self.get_current_time()
+        with self._mutex:
+            return list(self._find(self._encode(key), current)[1] is not None for key in keys)
+
+    def _find(self, encoded_key, current):
+        """
+        :return: (index, expired_at), index of the slot holding the key if it is locked,
+                 or else the first slot the key could be written into, and expired_at is None
+        """
+        start = zlib.crc32(encoded_key) % self._slots
+        free_index = None
+        for i in range(self._slots):
+            index = (start + i) % self._slots
+            expired_at, size, raw_key, _ = self.SLOT.unpack_from(self._mm, index * self.SLOT.size)
+            if expired_at == self.EMPTY:
+                return (index if free_index is None else free_index), None
+            if expired_at != self.TOMBSTONE and raw_key[:size] == encoded_key:
+                if current <= expired_at:
+                    return index, expired_at
+                return (index if free_index is None else free_index), None
+            if free_index is None and (expired_at == self.TOMBSTONE or current > expired_at):
+                free_index = index
+        if free_index is None:
+            raise RuntimeError("shared lock table is full")
+        return free_index, None
+
+    def _write(self, index, encoded_key, expired_at, digest):
+        self.SLOT.pack_into(self._mm, index * self.SLOT.size, expired_at, len(encoded_key), encoded_key, digest)
+
+    def _read_owner(self, index):
+        return self.OWNER.unpack_from(self._mm, index * self.SLOT.size + self.OWNER_OFFSET)[0]
+
+    def _digest(self, owner):
+        return self.NO_OWNER if owner is None else hashlib.md5(str(owner).encode()).digest()
+
+    def _encode(self, key):
+        encoded_key = str(key).encode()
+        if len(encoded_key) > self.MAX_KEY_SIZE:
+            encoded_key = b'sha1:' + hashlib.sha1(encoded_key).hexdigest().encode()
+        return encoded_key
+
+
+class SharedCapabilitySnapshot(object):
+    """
+    capabilities published by the leader process and loaded by the others
+
+    the snapshot is replaced atomically by rename, readers detect a new one by stat
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._loaded_stat = None
+
+    def publish(self, hub_caps):
+        """
+        :param hub_caps: k: hub_url, v: capabilities of the hub
+        """
+        tmp_path = '{}.{}.tmp'.format(self._path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(hub_caps, f)
+        os.replace(tmp_path, self._path)
+
+    def clear(self):
+        try:
+            os.remove(self._path)
+        except FileNotFoundError:
+            pass
+        self._loaded_stat = None
+
+    def load_if_changed(self):
+        """
+        :return: hub_caps published since last load, None if nothing changed
+        """
+        try:
+            st = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stat == self._loaded_stat:
+            return None
+        with open(self._path) as f:
+            hub_caps = json.load(f)
+        self._loaded_stat = stat
+        return hub_caps
+
+
+class LeaderElection(object):
+    """
+    the process holding the lock of the file is the leader, until it exits
+    """
+
+    def __init__(self, path):
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._is_leader = False
+
+    @property
+    def is_leader(self):
+        return self._is_leader
+
+    def try_acquire(self):
+        if self._is_leader:
+            return True
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        os.ftruncate(self._fd, 0)
+        os.write(self._fd, '{} {}'.format(os.getpid(), time.time()).encode())
+        self._is_leader = True
+        return True
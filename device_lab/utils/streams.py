@@ -0,0 +1,97 @@
+import json
+from collections import deque
+from datetime import timedelta
+
+import tornado.gen
+import tornado.locks
+
+
+class ServerSentEvent(object):
+    """
+    an event encoded once in server-sent events format and shared by all subscribers
+    """
+    __slots__ = ('type', 'data', '_encoded')
+
+    def __init__(self, type_, data):
+        self.type = type_
+        self.data = data
+        self._encoded = None
+
+    def encode(self):
+        if self._encoded is None:
+            self._encoded = 'event: {}\ndata: {}\n\n'.format(self.type, json.dumps(self.data)).encode()
+        return self._encoded
+
+
+class Subscriber(object):
+    """
+    buffer of events not yet consumed by a client
+
+    the buffer is bounded, once it is full buffered events are dropped and the subscriber is marked overflowed,
+    so that a slow client costs a fixed amount of memory and should resync from a snapshot
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._buffer = deque()
+        self._ready = tornado.locks.Event()
+        self._overflowed = False
+        self.closed = False
+
+    def put(self, event):
+        if self._overflowed or self.closed:
+            return
+        if len(self._buffer) >= self._max_size:
+            self._buffer.clear()
+            self._overflowed = True
+        else:
+            self._buffer.append(event)
+        self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._buffer.clear()
+        self._ready.set()
+
+    @tornado.gen.coroutine
+    def get(self, timeout=None):
+        """
+        wait for events
+
+        :param timeout: seconds to wait, None to wait forever
+        :return: (events, overflowed), events is empty on timeout
+        """
+        try:
+            yield self._ready.wait(None if timeout is None else timedelta(seconds=timeout))
+        except tornado.gen.TimeoutError:
+            return [], False
+        self._ready.clear()
+        events, overflowed = list(self._buffer), self._overflowed
+        self._buffer.clear()
+        self._overflowed = False
+        return events, overflowed
+
+
+class EventBroadcaster(object):
+    """
+    fan events out to subscribers, nothing is done when there is no event
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, max_size=1000):
+        subscriber = Subscriber(max_size)
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+        subscriber.close()
+
+    def publish(self, event):
+        for subscriber in self._subscribers:
+            subscriber.put(event)
@@ -0,0 +1,151 @@
+import time
+import asyncio
+import inspect
+import logging
+from collections import deque
+
+import tornado.locks
+from tornado.ioloop import IOLoop
+
+from utils.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+JOB_DURATION = registry.histogram(
+    'device_lab_background_job_duration_seconds', 'Time taken by a cycle of background jobs',
+    labelnames=('job',))
+JOB_CYCLES = registry.counter(
+    'device_lab_background_job_cycles_total', 'Cycles of background jobs by outcome, skipped ones included',
+    labelnames=('job', 'outcome'))
+
+
+class CycleResult(object):
+    """
+    outcome of one cycle of a periodic task, result is what the task returns
+    """
+    __slots__ = ('seq', 'started_at', 'duration', 'outcome', 'result', 'error')
+    OK = 'ok'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, seq, started_at):
+        self.seq = seq
+        self.started_at = started_at
+        self.duration = None
+        self.outcome = None
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class FetchPool(object):
+    """
+    run coroutines with at most `concurrency` of them at the same time, the others wait in arrival order
+    """
+
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.running = 0
+        self._semaphore = tornado.locks.Semaphore(concurrency)
+
+    async def run(self, func, *args):
+        async with self._semaphore:
+            self.running += 1
+            try:
+                return await func(*args)
+            finally:
+                self.running -= 1
+
+    async def map(self, func, items):
+        """
+        :return: results in order of items, exception raised for an item is returned in place of its result
+        """
+        return await asyncio.gather(*(self.run(func, item) for item in items), return_exceptions=True)
+
+
+class PeriodicTask(object):
+    """
+    run a function or coroutine function every period on current IOLoop
+
+    a tick is skipped while the cycle started by an earlier tick is running, so that cycles are never stacked,
+    and a cycle running longer than timeout is cancelled, outcomes of recent cycles are kept for inspection
+    """
+
+    def __init__(self, name, func, period, timeout=None, history_size=10):
+        """
+        :param timeout: seconds a cycle may run, the period by default
+        """
+        self.name = name
+        self.period = period
+        self.timeout = period if timeout is None else timeout
+        self.skipped = 0
+        self._func = func
+        self._history = deque(maxlen=history_size)
+        self._running = None  # future of running cycle
+        self._handle = None
+        self._next_at = None
+        self._next_seq = 0
+
+    @property
+    def running(self):
+        return self._running is not None
+
+    def start(self, run_now=True):
+        self._next_at = IOLoop.current().time() + (0 if run_now else self.period)
+        self._handle = IOLoop.current().call_at(self._next_at, self._tick)
+
+    def stop(self):
+        if self._handle is not None:
+            IOLoop.current().remove_timeout(self._handle)
+            self._handle = None
+        if self._running is not None:
+            self._running.cancel()
+
+    def get_stats(self):
+        return {
+            'period': self.period,
+            'timeout': self.timeout,
+            'running': self.running,
+            'skipped': self.skipped,
+            'cycles': list(cycle.to_dict() for cycle in self._history),
+        }
+
+    def _tick(self):
+        now = IOLoop.current().time()
+        # ticks missed while IOLoop is blocked are not replayed
+        self._next_at = max(self._next_at + self.period, now)
+        self._handle = IOLoop.current().call_at(self._next_at, self._tick)
+        if self._running is not None:
+            self.skipped += 1
+            JOB_CYCLES.labels(self.name, 'skipped').inc()
+            logger.warning('last cycle of %s is still running, skip this one', self.name)
+            return
+        self._running = asyncio.ensure_future(self._run_cycle())
+
+    async def _run_cycle(self):
+        cycle = CycleResult(self._next_seq, time.time())
+        self._next_seq += 1
+        started = time.perf_counter()
+        try:
+            result = self._func()
+            if inspect.isawaitable(result):
+                result = await asyncio.wait_for(result, self.timeout)
+            cycle.outcome, cycle.result = CycleResult.OK, result
+        except asyncio.TimeoutError:
+            cycle.outcome, cycle.error = CycleResult.CANCELLED, 'not finished in {} seconds'.format(self.timeout)
+            logger.error('cycle of %s is cancelled, %s', self.name, cycle.error)
+        except asyncio.CancelledError:
+            cycle.outcome, cycle.error = CycleResult.CANCELLED, 'stopped'
+            raise
+        except Exception as e:
+            cycle.outcome, cycle.error = CycleResult.FAILED, str(e)
+            logger.exception('cycle of %s fails', self.name)
+        finally:
+            cycle.duration = time.perf_counter() - started
+            self._history.append(cycle)
+            self._running = None
+            JOB_DURATION.labels(self.name).observe(cycle.duration)
+            JOB_CYCLES.labels(self.name, cycle.outcome).inc()
+        return cycle
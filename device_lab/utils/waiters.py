@@ -0,0 +1,193 @@
+import time
+import heapq
+from collections import defaultdict
+
+# priority classes, a waiter of a higher class is always served before those of lower classes
+PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+DEFAULT_PRIORITY = 'normal'
+DEFAULT_TEAM = 'default'
+
+
+class QueueFullError(RuntimeError):
+    def __init__(self, msg, queued):
+        super().__init__(msg)
+        self.queued = queued  # number of waiters counted against the exceeded limit
+
+
+class Waiter(object):
+    __slots__ = ('seq', 'filter_key', 'payload', 'done', 'priority', 'team', 'start', 'order', 'queued_at')
+
+    def __init__(self, seq, filter_key, payload, priority=DEFAULT_PRIORITY, team=DEFAULT_TEAM):
+        self.seq = seq  # arrival order
+        self.filter_key = filter_key
+        self.payload = payload
+        self.done = False
+        self.priority = priority
+        self.team = team
+        self.start = 0.0  # virtual start time of fair share
+        self.order = (0, 0.0, seq)  # smaller one is served first
+        self.queued_at = None
+
+
+class WaiterQueue(object):
+    """
+    queue of waiters grouped by the filter they wait for, served by priority class,
+    then by weighted fair share between teams, then first come first served
+
+    fair share is start-time fair queuing within each priority class: a waiter is tagged on arrival with
+    a virtual finish time, 1 / weight of its team after the later of its team's last tag and the virtual time,
+    which is moved to the start tag of each served waiter, so that a team with more waiters queued
+    is interleaved with the others in proportion to their weights instead of being served all first
+
+    waiters of the same filter are kept in a heap by that order, and filters are indexed by an index key
+    (e.g. platform name), so that when a resource is freed only the filters which could match it are visited
+    a removed waiter is marked done and dropped lazily once it reaches the head of its heap
+
+    :param team_weights: k: team, v: weight, teams not listed weigh `default_weight`
+    :param max_size: max number of waiters, and `max_team_size` max number of them from a team, None for no limit
+    """
+
+    def __init__(self, team_weights=None, default_weight=1.0, max_size=None, max_team_size=None):
+        self.team_weights = dict(team_weights or {})
+        self.default_weight = default_weight
+        self.max_size = max_size
+        self.max_team_size = max_team_size
+        self._groups = {}  # k: filter key, v: heap of (order, Waiter)
+        self._index_keys = {}  # k: filter key, v: index key
+        self._by_index_key = defaultdict(set)  # k: index key, v: filter keys
+        self._virtual_times = defaultdict(float)  # k: priority class
+        self._finish_tags = {}  # k: (priority class, team), v: finish tag of its last waiter, while it has waiters
+        self._class_team_sizes = defaultdict(int)  # k: (priority class, team), v: number of waiters
+        self._team_sizes = defaultdict(int)  # k: team, v: number of waiters
+        self._priority_sizes = defaultdict(int)  # k: priority class, v: number of waiters
+        self._next_seq = 0
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @staticmethod
+    def get_current_time():
+        return time.time()
+
+    def add(self, filter_key, index_key, payload, priority=DEFAULT_PRIORITY, team=DEFAULT_TEAM):
+        """
+        :raise QueueFullError: if the queue or the share of the team is full
+        """
+        if self.max_size is not None and self._size >= self.max_size:
+            raise QueueFullError("wait queue is full", self._size)
+        if self.max_team_size is not None and self._team_sizes.get(team, 0) >= self.max_team_size:
+            raise QueueFullError("wait queue of team is full: {}".format(team), self._team_sizes[team])
+        waiter = Waiter(self._next_seq, filter_key, payload, priority, team)
+        self._next_seq += 1
+        rank = PRIORITIES[priority]
+        waiter.start = max(self._virtual_times[rank], self._finish_tags.get((rank, team), 0.0))
+        finish = waiter.start + 1.0 / self.team_weights.get(team, self.default_weight)
+        self._finish_tags[(rank, team)] = finish
+        waiter.order = (rank, finish, waiter.seq)
+        waiter.queued_at = self.get_current_time()
+        group = self._groups.get(filter_key)
+        if group is None:
+            group = self._groups[filter_key] = []
+            self._index_keys[filter_key] = index_key
+            self._by_index_key[index_key].add(filter_key)
+        heapq.heappush(group, (waiter.order, waiter))
+        self._count(waiter, 1)
+        return waiter
+
+    def remove(self, waiter):
+        """
+        :return: False if the waiter has been popped or removed already
+        """
+        if waiter.done:
+            return False
+        waiter.done = True
+        self._count(waiter, -1)
+        self._trim(waiter.filter_key)
+        return True
+
+    def has_waiter(self, filter_key):
+        return filter_key in self._groups
+
+    def peek(self, filter_key):
+        """
+        :return: the waiter of the filter to be served first, None if there is no one
+        """
+        group = self._groups.get(filter_key)
+        return group[0][1] if group else None
+
+    def pop(self, filter_key):
+        _, waiter = heapq.heappop(self._groups[filter_key])
+        waiter.done = True
+        self._count(waiter, -1)
+        rank = PRIORITIES[waiter.priority]
+        if waiter.start > self._virtual_times[rank]:
+            self._virtual_times[rank] = waiter.start
+        tag_key = (rank, waiter.team)
+        if self._finish_tags.get(tag_key, 0.0) <= self._virtual_times[rank]:
+            self._finish_tags.pop(tag_key, None)  # no earlier than virtual time, same as absent
+        self._trim(filter_key)
+        return waiter
+
+    def get_filter_keys(self, index_keys=None):
+        """
+        :param index_keys: only filters indexed by these keys are returned, None for all
+        :return: filter keys with waiters
+        """
+        if index_keys is None:
+            return list(self._groups)
+        filter_keys = set()
+        for index_key in index_keys:
+            filter_keys.update(self._by_index_key.get(index_key, ()))
+        return list(filter_keys)
+
+    def get_stats(self):
+        """
+        :return: number of waiters by priority class and by team, with the seconds the oldest one has waited,
+                 it walks through every waiter
+        """
+        now = self.get_current_time()
+        teams = {}
+        for group in self._groups.values():
+            for _, waiter in group:
+                if waiter.done:
+                    continue
+                stats = teams.setdefault(waiter.team, {'queued': 0, 'max_wait': 0.0})
+                stats['queued'] += 1
+                stats['max_wait'] = max(stats['max_wait'], now - waiter.queued_at)
+        return {
+            'queued': self._size,
+            'max_size': self.max_size,
+            'max_team_size': self.max_team_size,
+            'priorities': dict((name, self._priority_sizes.get(rank, 0)) for name, rank in PRIORITIES.items()),
+            'teams': teams,
+        }
+
+    def _count(self, waiter, delta):
+        self._size += delta
+        rank = PRIORITIES[waiter.priority]
+        self._priority_sizes[rank] += delta
+        self._team_sizes[waiter.team] += delta
+        if not self._team_sizes[waiter.team]:
+            del self._team_sizes[waiter.team]
+        tag_key = (rank, waiter.team)
+        self._class_team_sizes[tag_key] += delta
+        if not self._class_team_sizes[tag_key]:
+            # a team without waiters starts over from virtual time, whether they are served, timed out or cancelled
+            del self._class_team_sizes[tag_key]
+            self._finish_tags.pop(tag_key, None)
+
+    def _trim(self, filter_key):
+        group = self._groups.get(filter_key)
+        if group is None:
+            return
+        while group and group[0][1].done:
+            heapq.heappop(group)
+        if group:
+            return
+        del self._groups[filter_key]
+        index_key = self._index_keys.pop(filter_key)
+        filter_keys = self._by_index_key[index_key]
+        filter_keys.discard(filter_key)
+        if not filter_keys:
+            del self._by_index_key[index_key]